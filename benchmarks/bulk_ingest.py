@@ -0,0 +1,83 @@
+"""
+Compare the buffered multi-row INSERT path with the COPY bulk load path
+
+Loads the same generated ram_stats rows through both paths into a temporary
+copy of the table and prints rows/sec for each. The database credentials are
+read from the same environment variables as the monitor itself.
+
+Usage:
+    python3 benchmarks/bulk_ingest.py --rows 100000
+"""
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'server_monitor'
+))
+
+from packages.file import file  # noqa: E402
+from packages.logger import logger  # noqa: E402
+from packages.postgredb import postgredb  # noqa: E402
+
+
+# Initiate logger
+log = logger.get(app_name='logs', enable_logs_file=False)
+
+
+def generate_rows(rows_count):
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    for index in range(rows_count):
+        created = start + timedelta(seconds=index)
+        yield [
+            created.isoformat(sep=' ', timespec='microseconds'), 'benchmark',
+            15.5, 7.25, 8.25, 53.2, 2.0, 1.5, 0.5, 25.0
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    project_abs_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', 'server_monitor'
+    )
+    table_query = file.read(os.path.join(
+        project_abs_path, 'data/input/queries/tables/ram_stats.txt'
+    ))
+    insert_query = file.read(os.path.join(
+        project_abs_path, 'data/input/queries/insert/ram_stats.txt'
+    ))
+
+    db = postgredb.PostgreSQLDB(
+        host=os.getenv('DB_HOSTNAME'),
+        db_name=os.getenv('DB_NAME'),
+        username=os.getenv('DB_USERNAME'),
+        password=os.getenv('DB_PASSWORD')
+    )
+
+    # The temporary table shadows the real one for this session only
+    db.run_query(query=table_query.replace(
+        'CREATE TABLE IF NOT EXISTS', 'CREATE TEMP TABLE'
+    ))
+
+    writer = postgredb.BufferedWriter(
+        db=db, max_rows=args.rows + 1, max_bytes=float('inf'),
+        max_age_seconds=float('inf')
+    )
+    for values_list in generate_rows(args.rows):
+        writer.add(insert_query=insert_query, values_list=values_list)
+    writer.flush()
+
+    db.run_query(query='TRUNCATE ram_stats')
+    db.commit()
+
+    db.copy_insert_rows(insert_query=insert_query, rows=generate_rows(args.rows))
+
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Compare the per-sample cost of the psutil and procfs system backends
+
+Times the CPU and RAM collectors, and the raw backend reads behind them, with
+each backend and prints the mean microseconds per call.
+
+Usage:
+    python3 benchmarks/collector_backends.py --samples 2000
+"""
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'server_monitor'
+))
+
+from packages.system import system  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=int, default=2000)
+    args = parser.parse_args()
+
+    print('{0:<28}{1:>12}{2:>12}'.format('call (us/sample)', 'psutil', 'procfs'))
+
+    backends = {
+        name: system.get_backend(name) for name in ('psutil', 'procfs')
+    }
+    samplers = {
+        name: system.CpuSampler(min_window_seconds=0, backend=backend)
+        for name, backend in backends.items()
+    }
+
+    calls = {
+        'get_cpu_stats': lambda name: system.get_cpu_stats(
+            sampler=samplers[name]
+        ),
+        'get_ram_stats': lambda name: system.get_ram_stats(
+            backend=backends[name]
+        ),
+        'cpu_times(percpu=True)': lambda name: backends[name].cpu_times(
+            percpu=True
+        ),
+        'virtual_memory()': lambda name: backends[name].virtual_memory(),
+        'swap_memory()': lambda name: backends[name].swap_memory(),
+        'cpu_freq()': lambda name: backends[name].cpu_freq(),
+        'getloadavg()': lambda name: backends[name].getloadavg(),
+        'disk_io_counters()': lambda name: backends[name].disk_io_counters(),
+    }
+
+    for call_name, call in calls.items():
+        timings = []
+        for name in backends:
+            seconds = timeit.timeit(lambda: call(name), number=args.samples)
+            timings.append(seconds / args.samples * 1e6)
+        print('{0:<28}{1:>12.1f}{2:>12.1f}'.format(call_name, *timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Measure the agent to aggregator throughput with simulated agents
+
+Starts an aggregator and many simulated agents on localhost. Each agent
+sends ram_stats-shaped frames and waits for their acknowledgement like the
+real agent does, and the rows are loaded into a temporary copy of the table.
+Prints rows/sec and frames/sec. The database credentials are read from the
+same environment variables as the monitor itself; --discard drops the rows
+instead, to measure the protocol alone, and --asyncpg writes them through
+the asyncpg pool into a scratch table that is dropped at the end.
+
+Usage:
+    python3 benchmarks/wire_throughput.py --agents 1000 --frames 10
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'server_monitor'
+))
+
+from packages.file import file  # noqa: E402
+from packages.wire import wire  # noqa: E402
+from packages.logger import logger  # noqa: E402
+from packages.postgredb import postgredb  # noqa: E402
+from packages.asyncpostgredb import asyncpostgredb  # noqa: E402
+
+
+# Initiate logger
+log = logger.get(app_name='logs', enable_logs_file=False)
+
+project_abs_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'server_monitor'
+)
+
+SCRATCH_TABLE = 'wire_benchmark_ram_stats'
+
+
+class DiscardDB:
+    """
+    Database stand-in that drops the batches, to time the protocol alone
+    """
+
+    closed = False
+
+    def load_batch(self, queries_rows):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def connect_temp_db():
+    # The temporary table shadows the real one for this session only
+    db = postgredb.PostgreSQLDB(
+        host=os.getenv('DB_HOSTNAME'),
+        db_name=os.getenv('DB_NAME'),
+        username=os.getenv('DB_USERNAME'),
+        password=os.getenv('DB_PASSWORD')
+    )
+    table_query = file.read(os.path.join(
+        project_abs_path, 'data/input/queries/tables/ram_stats.txt'
+    ))
+    db.run_query(query=table_query.replace(
+        'CREATE TABLE IF NOT EXISTS', 'CREATE TEMP TABLE'
+    ))
+    db.commit()
+    return db
+
+
+def create_scratch_table(insert_query):
+    # The pool connections do not share a temporary table
+    db = postgredb.PostgreSQLDB(
+        host=os.getenv('DB_HOSTNAME'),
+        db_name=os.getenv('DB_NAME'),
+        username=os.getenv('DB_USERNAME'),
+        password=os.getenv('DB_PASSWORD')
+    )
+    table_query = file.read(os.path.join(
+        project_abs_path, 'data/input/queries/tables/ram_stats.txt'
+    ))
+    db.run_query(query='DROP TABLE IF EXISTS ' + SCRATCH_TABLE)
+    db.run_query(query=table_query.replace('ram_stats', SCRATCH_TABLE))
+    db.commit()
+    return db, insert_query.replace('ram_stats', SCRATCH_TABLE)
+
+
+def generate_frame(agent_index, frame_index, rows_per_frame):
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc) + timedelta(
+        seconds=(agent_index * 100000 + frame_index) * rows_per_frame
+    )
+    rows = []
+    for index in range(rows_per_frame):
+        created = start + timedelta(seconds=index)
+        rows.append([
+            created.isoformat(sep=' ', timespec='microseconds'),
+            'agent-{0}'.format(agent_index),
+            15.5, 7.25, 8.25, 53.2, 2.0, 1.5, 0.5, 25.0
+        ])
+    return wire.encode_frame(wire.ROWS, {'ram_stats': rows})
+
+
+async def run_agent(port, agent_index, frames_count, rows_per_frame):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    header_size = len(wire.encode_frame(wire.ACK))
+    for frame_index in range(frames_count):
+        writer.write(generate_frame(agent_index, frame_index, rows_per_frame))
+        frame_type, length = wire.decode_header(
+            await reader.readexactly(header_size)
+        )
+        await reader.readexactly(length)
+        if frame_type != wire.ACK:
+            raise RuntimeError('frame was not written')
+    writer.close()
+    await writer.wait_closed()
+
+
+async def run(args):
+    insert_query = file.read(os.path.join(
+        project_abs_path, 'data/input/queries/insert/ram_stats.txt'
+    ))
+    scratch_db = None
+    async_db = None
+    if args.asyncpg:
+        scratch_db, insert_query = create_scratch_table(insert_query)
+        async_db = asyncpostgredb.AsyncPostgreSQLDB(
+            host=os.getenv('DB_HOSTNAME'),
+            db_name=os.getenv('DB_NAME'),
+            username=os.getenv('DB_USERNAME'),
+            password=os.getenv('DB_PASSWORD'),
+            max_size=args.pool_size, max_in_flight=args.pool_size
+        )
+
+    aggregator = wire.Aggregator(
+        connect=DiscardDB if args.discard or args.asyncpg else connect_temp_db,
+        insert_queries={'ram_stats': insert_query},
+        batch_rows=args.batch_rows, flush_interval_seconds=0.2,
+        async_db=async_db
+    )
+
+    stop_event = asyncio.Event()
+    serve_task = asyncio.create_task(aggregator.serve(
+        bind_address='127.0.0.1', port=args.port, stop_event=stop_event
+    ))
+    await asyncio.sleep(0.5)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[
+        run_agent(args.port, agent_index, args.frames, args.rows_per_frame)
+        for agent_index in range(args.agents)
+    ])
+    duration = time.perf_counter() - start_time
+
+    stop_event.set()
+    await serve_task
+
+    if scratch_db is not None:
+        scratch_db.run_query(query='DROP TABLE ' + SCRATCH_TABLE)
+        scratch_db.commit()
+        scratch_db.close()
+
+    rows_count = args.agents * args.frames * args.rows_per_frame
+    print('{0} agents, {1} frames of {2} rows each'.format(
+        args.agents, args.agents * args.frames, args.rows_per_frame
+    ))
+    print('{0} rows in {1} seconds: {2} rows/s, {3} frames/s'.format(
+        rows_count, round(duration, 3), round(rows_count / duration, 2),
+        round(args.agents * args.frames / duration, 2)
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--agents', type=int, default=1000)
+    parser.add_argument('--frames', type=int, default=10)
+    parser.add_argument('--rows-per-frame', type=int, default=10)
+    parser.add_argument('--batch-rows', type=int, default=10000)
+    parser.add_argument('--port', type=int, default=9107)
+    parser.add_argument('--discard', action='store_true')
+    parser.add_argument('--asyncpg', action='store_true')
+    parser.add_argument('--pool-size', type=int, default=4)
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
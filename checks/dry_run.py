@@ -0,0 +1,53 @@
+"""
+Smoke check of the dry run
+
+Runs the monitor with --dry-run, without database credentials, and fails
+unless it collects one snapshot and exits cleanly, and unless --dry-run
+with --aggregator is refused as a usage error.
+
+Usage:
+    python3 checks/dry_run.py
+"""
+import os
+import sys
+import subprocess
+
+
+main_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'server_monitor',
+    '__main__.py'
+)
+
+
+def main():
+    # The dry run must not need the database environment
+    environment = {
+        name: value for name, value in os.environ.items()
+        if not name.startswith('DB_')
+    }
+    completed = subprocess.run(
+        [sys.executable, main_path, '--dry-run'], env=environment,
+        capture_output=True, text=True, timeout=120
+    )
+    output = completed.stdout + completed.stderr
+
+    if completed.returncode != 0 or 'Traceback' in output or \
+            'Finished program execution' not in output:
+        print(output)
+        print('dry run failed')
+        sys.exit(1)
+
+    # The aggregator needs the database a dry run does without
+    completed = subprocess.run(
+        [sys.executable, main_path, '--dry-run', '--aggregator'],
+        env=environment, capture_output=True, text=True, timeout=120
+    )
+    if completed.returncode != 2 or 'Traceback' in completed.stderr:
+        print(completed.stdout + completed.stderr)
+        print('dry run failed: --aggregator was not refused')
+        sys.exit(1)
+    print('dry run passed')
+
+
+if __name__ == '__main__':
+    main()
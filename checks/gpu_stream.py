@@ -0,0 +1,60 @@
+"""
+Smoke check of the streamed GPU collector
+
+Starts a GpuStream on checks/fake-nvidia-smi and fails unless no GPU stats
+are reported before the first readings, and the readings of both fake GPUs
+are then parsed.
+
+Usage:
+    python3 checks/gpu_stream.py
+"""
+import os
+import sys
+import time
+
+checks_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(checks_path, '..', 'server_monitor'))
+
+from packages.system import system  # noqa: E402
+
+
+def fail(message):
+    print(message)
+    print('GPU stream failed')
+    sys.exit(1)
+
+
+def main():
+    stream = system.GpuStream(
+        loop_ms=100, command=os.path.join(checks_path, 'fake-nvidia-smi'),
+        stale_seconds=5
+    )
+
+    # No row until nvidia-smi printed its first readings
+    if system.get_gpu_stats(stream=stream) is not None:
+        fail('GPU stats reported before the first readings')
+
+    stream.start()
+    try:
+        deadline = time.monotonic() + 10
+        while len(stream.latest()) < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        readings = stream.latest()
+        gpu_stats = system.get_gpu_stats(stream=stream)
+    finally:
+        stream.close()
+
+    if [reading['index'] for reading in readings] != [0, 1]:
+        fail('expected the readings of GPUs 0 and 1, got {0}'.format(readings))
+    if readings[0]['name'] != 'Fake GPU, 16GB' or \
+            readings[0]['power_draw_watts'] != 120.5:
+        fail('GPU 0 reading was not parsed: {0}'.format(readings[0]))
+    if readings[1]['power_draw_watts'] is not None:
+        fail('GPU 1 power draw should be missing: {0}'.format(readings[1]))
+    if gpu_stats['gpus_count'] != 2 or gpu_stats['gpu_temperature'] != 61:
+        fail('unexpected GPU stats: {0}'.format(gpu_stats))
+    print('GPU stream passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,166 +1,1068 @@
 import os
-import yaml
+import time
 import json
+import signal
+import argparse
+import platform
+import functools
+import threading
 import traceback
-from dotenv import load_dotenv
+from datetime import datetime
+from packages.startup import startup
 from packages.file import file
 from packages.logger import logger
-from packages.system import system
-from packages.postgredb import postgredb
+from packages.spool import spool
+from packages.ticker import ticker
+from packages.collector import collector
+from packages.ringbuffer import ringbuffer
 from packages.datetimetools import datetimetools
 
+# The modules that only some modes or settings use are imported on first
+# use; --startup-profile reports their import time
+yaml = startup.lazy_import('yaml')
+dotenv = startup.lazy_import('dotenv')
+asyncio = startup.lazy_import('asyncio')
+system = startup.lazy_import('packages.system.system')
+partitions = startup.lazy_import('packages.partitions.partitions')
+rollup = startup.lazy_import('packages.rollup.rollup')
+alerts = startup.lazy_import('packages.alerts.alerts')
+exporter = startup.lazy_import('packages.exporter.exporter')
+wire = startup.lazy_import('packages.wire.wire')
+schema = startup.lazy_import('packages.schema.schema')
+postgredb = startup.lazy_import('packages.postgredb.postgredb')
+deadband = startup.lazy_import('packages.deadband.deadband')
+asyncpostgredb = startup.lazy_import('packages.asyncpostgredb.asyncpostgredb')
+
 
 # Initiate logger
 log = logger.get(app_name='logs', enable_logs_file=False)
 
-# Load environment variables from the specified file
+# The environment variables file, loaded when the database is used
 dotenv_path = '/server-monitor/env_vars.txt'
-load_dotenv(dotenv_path)
 
 
-def main():
+def parse_args(argv=None):
+    """
+    Parse the command line arguments
+    Returns namespace with the following attributes:
+        - daemon: Keep the process resident and collect in a loop
+        - interval: Seconds between two collection cycles in daemon mode,
+            overriding the intervals of config.yaml
+        - agent: `host:port` of the aggregator to send the rows to, instead
+            of writing them to the database
+        - aggregator: Receive the agents rows and write them to the database
+        - dry_run: Collect one snapshot and log it without writing it
+        - startup_profile: Log the import and initialization time of each
+            startup step
+    """
+
+    parser = argparse.ArgumentParser(
+        prog='server_monitor',
+        description='Collect server resources stats into PostgreSQL'
+    )
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='run as a long-running process instead of a single cycle'
+    )
+    parser.add_argument(
+        '--interval', type=float, default=None,
+        help='seconds between collection cycles in daemon mode, for every '
+             'collector (defaults to collectors.intervals, then '
+             'daemon.interval_seconds in config.yaml)'
+    )
+
+    # Where the rows go; an aggregator needs the database, which an agent
+    # and a dry run do without
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument(
+        '--agent', metavar='HOST:PORT', default=None,
+        help='send the rows to the aggregator at HOST:PORT'
+    )
+    mode_group.add_argument(
+        '--aggregator', action='store_true',
+        help='receive the agents rows and write them to the database'
+    )
+    mode_group.add_argument(
+        '--dry-run', action='store_true',
+        help='collect one snapshot and log it without writing it anywhere'
+    )
+    parser.add_argument(
+        '--startup-profile', action='store_true',
+        help='log the import and initialization time of each startup step'
+    )
+    return parser.parse_args(argv)
 
-    log.info('Start program execution')
-    project_abs_path = file.caller_dir_path()
 
+def load_config(project_abs_path):
     # Import configurations
     config_path = os.path.join(project_abs_path, 'config.yaml')
     with open(config_path) as config_file:
-        config = yaml.safe_load(config_file)
-    # Create a database instance
-    db = postgredb.PostgreSQLDB(
-        host = os.getenv('DB_HOSTNAME'),
-        db_name = os.getenv('DB_NAME'),
-        username = os.getenv('DB_USERNAME'),
-        password = os.getenv('DB_PASSWORD')
-    )
+        # The C loader, when PyYAML was built with it, is much faster
+        return yaml.load(
+            config_file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        )
+
 
-    log.info('start creating database\'s tables')
+def load_insert_queries(project_abs_path, config):
+    """
+    Read all insert queries once
+    Returns dictionary of table name to insert query text
+    """
 
-    # Create all tables if not already exist
-    # Loop over all queries paths
-    for query_path in config['queries']['create_tables_paths']:
+    insert_queries = dict()
+    for table_name, query_path in config['queries']['insert_paths'].items():
+        insert_queries[table_name] = file.read(
+            path=os.path.join(project_abs_path, query_path)
+        )
+    return insert_queries
 
-        # Read query
-        query = file.read(os.path.join(project_abs_path, query_path))
 
-        # Execute query
-        db.run_query(query=query)
+def load_schema_queries(project_abs_path, config):
+    """
+    Read the create tables queries of the schema mode once
+    Returns list of the queries texts
+    """
 
-        # Commit the transaction
-        db.commit()
+    # Pick the tables definitions of the schema mode
+    if config['schema']['mode'] == 'partitioned':
+        queries_paths = config['queries']['partitioned_tables_paths']
+    else:
+        queries_paths = config['queries']['create_tables_paths']
 
-    log.info('finished creating database\'s tables')
+    return [
+        file.read(os.path.join(project_abs_path, query_path))
+        for query_path in queries_paths
+    ]
 
-    # Get current timestamp
-    current_timestamp = datetimetools.get_current_timestamp()
 
-    log.info('start system profile')
+def connect_db(config, schema_queries):
+    """
+    Connect to the database and create its tables unless they are current
+    Returns PostgreSQLDB instance, or None if the database is unreachable
+    """
+
+    try:
+        # Create a database instance
+        db = postgredb.PostgreSQLDB(
+            host = os.getenv('DB_HOSTNAME'),
+            db_name = os.getenv('DB_NAME'),
+            username = os.getenv('DB_USERNAME'),
+            password = os.getenv('DB_PASSWORD'),
+            connect_timeout = config['database']['connect_timeout_seconds'],
+            reconnect_attempts = config['database']['reconnect_attempts'],
+            backoff_base_seconds = config['database']['backoff_base_seconds'],
+            backoff_max_seconds = config['database']['backoff_max_seconds'],
+            liveness_check_seconds = \
+                config['database']['liveness_check_seconds'],
+            keepalives_idle = config['database']['keepalives_idle_seconds'],
+            keepalives_interval = \
+                config['database']['keepalives_interval_seconds'],
+            keepalives_count = config['database']['keepalives_count'],
+            tcp_user_timeout = config['database']['tcp_user_timeout_ms'],
+            prepared_statements = config['database']['prepared_statements']
+        )
+    except Exception as e:
+        log.error('could not connect to the database: {0}'.format(e))
+        return None
+
+    try:
+        # Create all tables if not already exist
+        create_tables(db, schema_queries, config)
+    except Exception as e:
+        log.error('could not create the database\'s tables: {0}'.format(e))
+        db.close()
+        return None
+
+    return db
+
 
-    system_profile_dict = system.get_system_profile()
-    log.info(system_profile_dict)
+def connect_agent(aggregator_address, config):
+    """
+    Connect to the aggregator
+    Returns wire.AgentConnection instance, or None if it is unreachable
+    """
 
-    # Insert into the database
-    profile_insert_query = file.read(
-        path=os.path.join(
-            project_abs_path, 'data/input/queries/insert/system_profile.txt'
+    address, port = aggregator_address.rsplit(':', 1)
+    try:
+        return wire.AgentConnection(
+            address=address, port=int(port),
+            connect_timeout=config['wire']['connect_timeout_seconds'],
+            ack_timeout=config['wire']['ack_timeout_seconds']
         )
+    except OSError as e:
+        log.error('could not connect to the aggregator: {0}'.format(e))
+        return None
+
+
+def open_spool(project_abs_path, config):
+    # Relative spool paths are relative to the project directory
+    return spool.Spool(
+        dir_path=os.path.join(project_abs_path, config['spool']['path']),
+        max_bytes=config['spool']['max_bytes'],
+        segment_bytes=config['spool']['segment_bytes'],
+        fsync_policy=config['spool']['fsync_policy'],
+        fsync_interval_seconds=config['spool']['fsync_interval_seconds']
     )
-    values_list = [
-        current_timestamp,
-        system_profile_dict['os'],
-        system_profile_dict['system_name'],
-        system_profile_dict['os_release'],
-        system_profile_dict['os_version'],
-        system_profile_dict['processor_arch'],
-        system_profile_dict['processor_type'],
-        system_profile_dict['physical_cores'],
-        system_profile_dict['logical_cores']
+
+
+def rewind_rollups(db, batch, config):
+    """
+    Move the rollups watermarks back to the oldest row of a batch of late
+    rows, so their buckets are rolled up again
+
+    Inputs:
+        db: PostgreSQLDB instance
+        batch: Dictionary of table name to list of rows
+        config: The configurations
+    """
+
+    if not config['rollup']['enabled']:
+        return
+
+    # The batches merge the frames of several agents, so the rows of a
+    # table are not in time order
+    timestamps = [
+        values_list[0] for rows in batch.values() for values_list in rows
     ]
-    log.info('start inserting system profile data into the database')
-    db.insert(insert_query=profile_insert_query, values_list=values_list)
+    if not timestamps:
+        return
+    oldest_time = min(
+        datetimetools.parse_timestamp(
+            timestamp, config['schema']['legacy_timezone']
+        )
+        for timestamp in timestamps
+    )
+    rollup.rewind(
+        db=db, tables=config['rollup']['tables'], since=oldest_time
+    )
+
+
+def convert_legacy_timestamps(batch, legacy_timezone):
+    """
+    Stamp the rows spooled before the timestamptz schema, whose naive
+    timestamps are in `legacy_timezone`, with UTC timestamps
+
+    Inputs:
+        batch: Dictionary of table name to list of rows, changed in place
+        legacy_timezone: The time zone of the naive timestamps
+    """
+
+    for rows in batch.values():
+        for index, values_list in enumerate(rows):
+            moment = datetime.fromisoformat(values_list[0])
+            if moment.tzinfo is not None:
+                continue
+            moment = moment.replace(
+                tzinfo=datetimetools.get_zone(legacy_timezone)
+            )
+            rows[index] = [
+                datetimetools.get_utc_timestamp(moment.timestamp())
+            ] + list(values_list[1:])
 
-    log.info('finished system profile')
 
-    log.info('start CPU stats')
+def replay_spool(writer, rows_spool, insert_queries, config):
+    """
+    Drain spooled rows into the database with bulk loads, a bounded number
+    of batches per call so a long outage does not stall the collection
+    """
 
-    cpu_stats_dict = system.get_cpu_stats()
-    log.info(cpu_stats_dict)
+    db = writer.db
+    if db is None or rows_spool.is_empty():
+        return
 
-    # Insert into the database
-    cpu_insert_query = file.read(
-        path=os.path.join(
-            project_abs_path, 'data/input/queries/insert/cpu_stats.txt'
+    # Rows that can never be written, e.g. a malformed timestamp or a value
+    # out of its column range, are dead lettered instead of blocking the
+    # spool; a lost connection stops the replay until the next call
+    if isinstance(db, postgredb.PostgreSQLDB):
+        permanent_errors = postgredb.get_permanent_errors() + (IndexError,)
+    else:
+        permanent_errors = (
+            ValueError, TypeError, IndexError, wire.RejectedRowsError
         )
+
+    def _load_batch(batch):
+        convert_legacy_timestamps(batch, config['schema']['legacy_timezone'])
+        try:
+            db.load_batch({
+                insert_queries[table_name]: rows
+                for table_name, rows in batch.items()
+            })
+        except Exception:
+            db.rollback()
+            raise
+
+        # The aggregator rewinds the rollups for the rows of its agents
+        if isinstance(db, postgredb.PostgreSQLDB):
+            rewind_rollups(db, batch, config)
+
+    try:
+        rows_spool.replay(
+            handler=_load_batch,
+            batch_rows=config['spool']['replay_batch_rows'],
+            max_batches=config['spool']['replay_max_batches'],
+            permanent_errors=permanent_errors
+        )
+    except Exception as e:
+        log.error('could not replay the spool: {0}'.format(e))
+        db.rollback()
+
+
+def create_tables(db, schema_queries, config):
+    """
+    Create the tables, and the rollup tables, unless the schema registry
+    records this exact schema as applied; then maintain the partitions
+    """
+
+    def _apply(db):
+        log.info('start creating database\'s tables')
+
+        # Create all tables if not already exist
+        for query in schema_queries:
+            db.run_query(query=query)
+            db.commit()
+
+        # Convert the naive timestamps of the tables created before
+        for table_name in config['queries']['insert_paths']:
+            schema.migrate_timestamptz(
+                db, table_name, 'created', config['schema']['legacy_timezone']
+            )
+            db.commit()
+
+        if config['rollup']['enabled']:
+            rollup.create_tables(
+                db, config['rollup']['tables'],
+                legacy_timezone=config['schema']['legacy_timezone']
+            )
+
+        log.info('finished creating database\'s tables')
+
+    schema.ensure(
+        db=db,
+        name='server_monitor',
+        version=schema.get_version(
+            ddl_texts=schema_queries,
+            settings={
+                'mode': config['schema']['mode'],
+                'rollup': config['rollup']['tables']
+                if config['rollup']['enabled'] else None,
+            }
+        ),
+        apply=_apply
     )
-    cpu_values_list = [
-        current_timestamp,
-        cpu_stats_dict['current_cpu_freq_ghz'],
-        cpu_stats_dict['cpu_usage_percent']
-    ]
-    log.info('start inserting CPU stats data into the database')
-    db.insert(insert_query=cpu_insert_query, values_list=cpu_values_list)
 
-    log.info('finished CPU stats')
+    maintain_partitions(db, config)
+
+
+def maintain_partitions(db, config):
+    """
+    Create the upcoming partitions and drop the expired ones, in the
+    partitioned schema mode
+    """
+
+    if config['schema']['mode'] != 'partitioned':
+        return
 
-    log.info('start RAM memory stats')
+    partitions.maintain(
+        db=db,
+        tables_names=config['schema']['partitioned_tables'],
+        interval=config['schema']['partition_interval'],
+        premake=config['schema']['premake_partitions'],
+        retention_days=config['schema']['retention_days'],
+        now=datetimetools.get_utc_now()
+    )
+
+
+def run_rollup(writer, config):
+    """
+    Roll the new raw rows up into the rollup tables
+    The buffered rows are written first, so every complete bucket is whole.
+    """
 
-    ram_stats_dict = system.get_ram_stats()
-    log.info(ram_stats_dict)
+    if not config['rollup']['enabled'] or writer.db is None:
+        return
 
-    # Insert into the database
-    ram_insert_query = file.read(
-        path=os.path.join(
-            project_abs_path, 'data/input/queries/insert/ram_stats.txt'
+    try:
+        writer.flush()
+        rollup.run(
+            db=writer.db,
+            tables=config['rollup']['tables'],
+            now=datetimetools.get_utc_now(),
+            max_buckets=config['rollup']['max_buckets']
         )
+    except Exception as e:
+        log.error('could not roll up the stats: {0}'.format(e))
+        if writer.db is not None:
+            writer.db.rollback()
+
+
+def _create_cpu_collector(config):
+    # Take the first CPU times snapshot now; the first CPU sample then
+    # covers the startup instead of blocking for its own window
+    cpu_sampler = system.CpuSampler(
+        backend=system.get_backend(config['system']['backend']),
+        busy_core_threshold_percent=config['cpu']['busy_core_threshold_percent']
     )
-    ram_values_list = [
-        current_timestamp,
-        ram_stats_dict['total_ram_gb'],
-        ram_stats_dict['free_ram_gb'],
-        ram_stats_dict['used_ram_gb'],
-        ram_stats_dict['ram_usage_percent'],
-        ram_stats_dict['total_swap_gb'],
-        ram_stats_dict['free_swap_gb'],
-        ram_stats_dict['used_swap_gb'],
-        ram_stats_dict['swap_usage_percent']
-    ]
-    log.info('start inserting RAM memory data into the database')
-    db.insert(insert_query=ram_insert_query, values_list=ram_values_list)
-
-    log.info('finished RAM memory stats')
-
-    log.info('start Storage stats stats')
-
-    storage_stats_dict = system.get_disk_stats()
-    storage_stats_dict['total_storage_gb'] = storage_stats_dict['partitions_list'][0]['partition_total_gb']
-    storage_stats_dict['used_storage_gb'] = storage_stats_dict['partitions_list'][0]['partition_used_gb']
-    storage_stats_dict['free_storage_gb'] = storage_stats_dict['partitions_list'][0]['partition_free_gb']
-    storage_stats_dict['storage_usage_percent'] = storage_stats_dict['partitions_list'][0]['partition_percentage']
-    log.info(storage_stats_dict)
-
-    # Insert into the database
-    storage_insert_query = file.read(
-        path=os.path.join(
-            project_abs_path, 'data/input/queries/insert/storage_stats.txt'
-        )
-    )
-    storage_values_list = [
-        current_timestamp,
-        storage_stats_dict['total_storage_gb'],
-        storage_stats_dict['used_storage_gb'],
-        storage_stats_dict['free_storage_gb'],
-        storage_stats_dict['storage_usage_percent'],
-        storage_stats_dict['partitions_count'],
-        json.dumps(storage_stats_dict['partitions_list']),
-    ]
-    log.info('start inserting Storage stats data into the database')
+    return functools.partial(system.get_cpu_stats, sampler=cpu_sampler)
 
-    db.insert(
-        insert_query=storage_insert_query, values_list=storage_values_list
+
+def _create_storage_collector(config):
+    partition_cache = system.PartitionCache(
+        all_partitions=config['storage']['all_partitions'],
+        include_fstypes=config['storage']['include_fstypes'],
+        exclude_fstypes=config['storage']['exclude_fstypes'],
+        include_mountpoints=config['storage']['include_mountpoints'],
+        exclude_mountpoints=config['storage']['exclude_mountpoints'],
+        usage_timeout_seconds=config['storage']['usage_timeout_seconds'],
+        refresh_seconds=config['storage']['refresh_seconds']
+    )
+    return functools.partial(
+        system.get_disk_stats, partition_cache=partition_cache
     )
 
-    log.info('finished Storage stats stats')
+
+def _create_gpu_collector(config):
+    if config['gpu']['source'] == 'gputil':
+        return system.get_gpu_stats
+
+    # One nvidia-smi child streams the readings for the whole run
+    gpu_stream = system.GpuStream(
+        loop_ms=config['gpu']['loop_ms'],
+        command=config['gpu']['command'],
+        stale_seconds=config['gpu']['stale_seconds'],
+        restart_seconds=config['gpu']['restart_seconds']
+    ).start()
+    return functools.partial(system.get_gpu_stats, stream=gpu_stream)
+
+
+def get_collector_registry():
+    """
+    Returns CollectorRegistry of all collectors; the name of a collector is
+    also the name of the table it fills
+    """
+
+    registry = collector.CollectorRegistry()
+    registry.register(
+        'system_profile', lambda config: system.get_system_profile
+    )
+    registry.register('cpu_stats', _create_cpu_collector)
+    registry.register('ram_stats', lambda config: functools.partial(
+        system.get_ram_stats,
+        backend=system.get_backend(config['system']['backend'])
+    ))
+    registry.register('storage_stats', _create_storage_collector)
+    registry.register('gpu_stats', _create_gpu_collector)
+    return registry
+
+
+def get_enabled_collectors(config):
+    """
+    Returns list of the collectors enabled in config.yaml
+    """
+
+    names = list(config['collectors']['enabled'])
+    if config['gpu']['enabled'] and 'gpu_stats' not in names:
+        names.append('gpu_stats')
+    return names
+
+
+def log_startup_profile():
+    log.info('startup profile:')
+    for line in startup.get_report():
+        log.info(line)
+
+
+def buffer_row(writer, insert_queries, change_filter, table_name,
+               values_list):
+    # Rows the change filter finds unchanged are not written
+    if change_filter is not None and \
+            not change_filter.accept(table_name, values_list):
+        return
+    writer.add(insert_query=insert_queries[table_name], values_list=values_list)
+
+
+def collect_cycle(
+        writer, insert_queries, engine, collectors, host_name, recent_samples,
+        alert_engine, change_filter=None, timestamp=None
+):
+    """
+    Collect one snapshot of every collector and buffer it for the database
+    The collectors run concurrently; the ones that fail or time out are
+    skipped for this cycle. The samples are also kept in `recent_samples`,
+    a dictionary of collector name to the RingBuffer read by the exporter,
+    possibly empty, and evaluated by the
+    alert rules as soon as they are collected. The rows of the series that
+    did not change are dropped by the optional deadband.ChangeFilter.
+    The rows are stamped with `timestamp`, the UTC timestamp of the tick,
+    or else the current time.
+
+    Returns the collection dictionary of CollectionEngine.collect()
+    """
+
+    # Get current timestamp
+    current_timestamp = timestamp or datetimetools.get_utc_timestamp()
+    sample_time = time.monotonic()
+
+    log.info('start collecting stats')
+
+    collection = engine.collect(collectors)
+
+    # A collector returns None while it has no sample yet, e.g. the GPU
+    # stream before nvidia-smi printed its first readings
+    results = {
+        name: values for name, values in collection['results'].items()
+        if values is not None
+    }
+    collection['results'] = results
+
+    log.info('finished collecting stats in {0} seconds'.format(
+        collection['durations']
+    ))
+
+    # Evaluate the alert rules before anything else
+    for name, values in results.items():
+        alert_engine.evaluate(
+            collector_name=name, values=values, sample_time=sample_time,
+            timestamp=current_timestamp
+        )
+
+    if 'system_profile' in results:
+
+        system_profile_dict = results['system_profile']
+        log.info(system_profile_dict)
+
+        # Insert into the database
+        values_list = [
+            current_timestamp,
+            host_name,
+            system_profile_dict['os'],
+            system_profile_dict['system_name'],
+            system_profile_dict['os_release'],
+            system_profile_dict['os_version'],
+            system_profile_dict['processor_arch'],
+            system_profile_dict['processor_type'],
+            system_profile_dict['physical_cores'],
+            system_profile_dict['logical_cores']
+        ]
+        log.info('start buffering system profile data for the database')
+        buffer_row(
+            writer=writer, insert_queries=insert_queries,
+            change_filter=change_filter, table_name='system_profile',
+            values_list=values_list
+        )
+
+    if 'cpu_stats' in results:
+
+        cpu_stats_dict = results['cpu_stats']
+        log.info(cpu_stats_dict)
+
+        # Insert into the database
+        cpu_values_list = [
+            current_timestamp,
+            host_name,
+            cpu_stats_dict['current_cpu_freq_ghz'],
+            cpu_stats_dict['cpu_usage_percent'],
+            cpu_stats_dict['max_core_usage_percent'],
+            cpu_stats_dict['core_usage_stddev'],
+            cpu_stats_dict['busy_cores_count'],
+            cpu_stats_dict['per_core_usage_percent'].tolist(),
+            cpu_stats_dict['per_core_freq_ghz'].tolist()
+        ]
+        log.info('start buffering CPU stats data for the database')
+        buffer_row(
+            writer=writer, insert_queries=insert_queries,
+            change_filter=change_filter, table_name='cpu_stats',
+            values_list=cpu_values_list
+        )
+
+    if 'ram_stats' in results:
+
+        ram_stats_dict = results['ram_stats']
+        log.info(ram_stats_dict)
+
+        # Insert into the database
+        ram_values_list = [
+            current_timestamp,
+            host_name,
+            ram_stats_dict['total_ram_gb'],
+            ram_stats_dict['free_ram_gb'],
+            ram_stats_dict['used_ram_gb'],
+            ram_stats_dict['ram_usage_percent'],
+            ram_stats_dict['total_swap_gb'],
+            ram_stats_dict['free_swap_gb'],
+            ram_stats_dict['used_swap_gb'],
+            ram_stats_dict['swap_usage_percent']
+        ]
+        log.info('start buffering RAM memory data for the database')
+        buffer_row(
+            writer=writer, insert_queries=insert_queries,
+            change_filter=change_filter, table_name='ram_stats',
+            values_list=ram_values_list
+        )
+
+    if 'storage_stats' in results:
+
+        storage_stats_dict = results['storage_stats']
+
+        # The first readable partition is the headline of the storage stats;
+        # fall back to the totals of all partitions if none is readable
+        available_partitions = [
+            partition
+            for partition in storage_stats_dict['partitions_list']
+            if partition['partition_available']
+        ]
+        if available_partitions:
+            storage_stats_dict['total_storage_gb'] = available_partitions[0]['partition_total_gb']
+            storage_stats_dict['used_storage_gb'] = available_partitions[0]['partition_used_gb']
+            storage_stats_dict['free_storage_gb'] = available_partitions[0]['partition_free_gb']
+            storage_stats_dict['storage_usage_percent'] = available_partitions[0]['partition_percentage']
+        log.info(storage_stats_dict)
+
+        # Insert into the database
+        storage_values_list = [
+            current_timestamp,
+            host_name,
+            storage_stats_dict['total_storage_gb'],
+            storage_stats_dict['used_storage_gb'],
+            storage_stats_dict['free_storage_gb'],
+            storage_stats_dict['storage_usage_percent'],
+            storage_stats_dict['partitions_count'],
+            json.dumps(storage_stats_dict['partitions_list']),
+        ]
+        log.info('start buffering Storage stats data for the database')
+        buffer_row(
+            writer=writer, insert_queries=insert_queries,
+            change_filter=change_filter, table_name='storage_stats',
+            values_list=storage_values_list
+        )
+
+        # One row per partition, written in the same flush
+        for partition in storage_stats_dict['partitions_list']:
+            buffer_row(
+                writer=writer, insert_queries=insert_queries,
+                change_filter=change_filter, table_name='partition_stats',
+                values_list=[
+                    current_timestamp,
+                    host_name,
+                    partition['partition_mountpoint'],
+                    partition['partition_name'],
+                    partition['partition_fstype'],
+                    partition['partition_available'],
+                    partition['partition_total_gb'],
+                    partition['partition_used_gb'],
+                    partition['partition_free_gb'],
+                    partition['partition_percentage'],
+                ]
+            )
+
+    if 'gpu_stats' in results:
+
+        gpu_stats_dict = results['gpu_stats']
+        log.info(gpu_stats_dict)
+
+        # Insert into the database
+        gpu_values_list = [
+            current_timestamp,
+            host_name,
+            gpu_stats_dict['gpus_count'],
+            gpu_stats_dict['gpu_temperature'],
+            gpu_stats_dict['total_gpu_gb'],
+            gpu_stats_dict['total_used_gpu_gb'],
+            gpu_stats_dict['total_free_gpu_gb'],
+            gpu_stats_dict['gpu_usage_percentage'],
+            gpu_stats_dict['gpu_utilization_percent'],
+            json.dumps(gpu_stats_dict['gpus_list']),
+        ]
+        log.info('start buffering GPU stats data for the database')
+        buffer_row(
+            writer=writer, insert_queries=insert_queries,
+            change_filter=change_filter, table_name='gpu_stats',
+            values_list=gpu_values_list
+        )
+
+    # Keep the recent samples in memory
+    for name, recent_buffer in recent_samples.items():
+        if name in results:
+            recent_buffer.append(results[name], sample_time=sample_time)
+
+    return collection
+
+
+def get_intervals(collectors, config, interval=None):
+    """
+    Returns dictionary of collector name to its interval seconds: `interval`
+    for every collector when given, e.g. by --interval, or else the one in
+    `collectors.intervals`, and `daemon.interval_seconds` for the others; a
+    null interval runs the collector at startup only
+    """
+
+    if interval is not None:
+        return {name: interval for name in collectors}
+
+    return {
+        name: config['collectors']['intervals'].get(
+            name, config['daemon']['interval_seconds']
+        )
+        for name in collectors
+    }
+
+
+def run_daemon(
+        writer, rows_spool, insert_queries, engine, collectors, host_name,
+        recent_samples, alert_engine, metrics_server, intervals, connect,
+        maintain_database, config, change_filter=None
+):
+    """
+    Run the collectors until SIGTERM or SIGINT, each one on its interval
+    from `intervals`, see get_intervals(). The collectors run on the ticks of drift-free clocks, aligned on
+    the multiples of their intervals with `daemon.align_ticks`; those due
+    on the same tick are collected in one cycle, and their rows are
+    stamped with the tick time.
+    While the database, or the aggregator, is unreachable, the rows go to
+    the spool and `connect` is retried every
+    `database.reconnect_interval_seconds`. The partitions and rollups are
+    maintained when `maintain_database` is set.
+    """
+
+    # Set by the signal handlers to leave the loop after the current cycle
+    stop_event = threading.Event()
+
+    def _request_stop(signum, frame):
+        log.info('received signal {0}, stopping'.format(signum))
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+
+    log.info('start daemon mode with intervals {0}'.format(intervals))
+
+    next_reconnect_time = time.monotonic()
+    next_maintenance_time = (
+        time.monotonic() + config['schema']['maintenance_interval_seconds']
+    )
+    next_rollup_time = time.monotonic() + config['rollup']['interval_seconds']
+
+    scheduler = ticker.Scheduler(
+        intervals=intervals, align=config['daemon']['align_ticks']
+    )
+
+    # The latest results of every collector, for the scrape response
+    latest_results = dict()
+    latest_durations = dict()
+
+    while True:
+
+        # Sleep until the next collectors fall due; wakes up early on stop
+        scheduled = scheduler.wait(stop_event)
+        if scheduled is None:
+            break
+        tick_time, due_names = scheduled
+
+        cycle_start = time.monotonic()
+
+        # Forget a connection that broke during the previous cycle
+        if writer.db is not None and writer.db.closed:
+            log.error('lost the database connection')
+            writer.db = None
+            next_reconnect_time = cycle_start
+
+        # Retry the connection while the database is unreachable
+        if writer.db is None and cycle_start >= next_reconnect_time:
+            writer.db = connect()
+            next_reconnect_time = (
+                cycle_start + config['database']['reconnect_interval_seconds']
+            )
+
+        try:
+            collection = collect_cycle(
+                writer=writer, insert_queries=insert_queries, engine=engine,
+                collectors={name: collectors[name] for name in due_names},
+                host_name=host_name, recent_samples=recent_samples,
+                alert_engine=alert_engine, change_filter=change_filter,
+                timestamp=datetimetools.get_utc_timestamp(tick_time)
+            )
+            latest_results.update(collection['results'])
+            latest_durations.update(collection['durations'])
+
+            # Render the scrape response once per cycle
+            if metrics_server is not None:
+                metrics_server.update(exporter.render(
+                    results=latest_results, host_name=host_name,
+                    durations=latest_durations,
+                    recent_samples=recent_samples,
+                    window_seconds=config['recent_samples']['window_seconds'],
+                    percent=config['recent_samples']['percent']
+                ))
+        except Exception as e:
+            # Keep the daemon alive
+            log.error(e)
+            log.error('Error Traceback: \n {0}'.format(traceback.format_exc()))
+
+        # Catch up on the rows spooled while the database was unreachable
+        replay_spool(
+            writer=writer, rows_spool=rows_spool,
+            insert_queries=insert_queries, config=config
+        )
+
+        # Keep the partitions ahead of time and drop the expired ones
+        if maintain_database and writer.db is not None and \
+                cycle_start >= next_maintenance_time:
+            try:
+                maintain_partitions(writer.db, config)
+            except Exception as e:
+                log.error('could not maintain the partitions: {0}'.format(e))
+                writer.db.rollback()
+            next_maintenance_time = (
+                cycle_start + config['schema']['maintenance_interval_seconds']
+            )
+
+        if maintain_database and cycle_start >= next_rollup_time:
+            run_rollup(writer=writer, config=config)
+            next_rollup_time = cycle_start + config['rollup']['interval_seconds']
+
+    log.info('finished daemon mode, missed deadlines: {0}'.format(
+        scheduler.missed_counts
+    ))
+
+
+def run_aggregator(config, insert_queries, schema_queries):
+    """
+    Receive the agents rows and write them to the database until SIGTERM or
+    SIGINT; the aggregator also maintains the partitions and rollups
+    """
+
+    def _maintain(db):
+        maintain_partitions(db, config)
+        if config['rollup']['enabled']:
+            rollup.run(
+                db=db,
+                tables=config['rollup']['tables'],
+                now=datetimetools.get_utc_now(),
+                max_buckets=config['rollup']['max_buckets']
+            )
+
+    # Write the batches through an asyncpg pool when configured
+    async_db = None
+    if config['wire']['writer'] == 'asyncpg':
+        async_db = asyncpostgredb.AsyncPostgreSQLDB(
+            host=os.getenv('DB_HOSTNAME'),
+            db_name=os.getenv('DB_NAME'),
+            username=os.getenv('DB_USERNAME'),
+            password=os.getenv('DB_PASSWORD'),
+            min_size=config['wire']['pool_min_size'],
+            max_size=config['wire']['pool_max_size'],
+            statement_timeout_seconds=config['wire'][
+                'statement_timeout_seconds'
+            ],
+            max_in_flight=config['wire']['max_in_flight_batches'],
+            connect_timeout=config['database']['connect_timeout_seconds']
+        )
+
+    aggregator = wire.Aggregator(
+        connect=functools.partial(connect_db, config, schema_queries),
+        insert_queries=insert_queries,
+        batch_rows=config['wire']['batch_rows'],
+        flush_interval_seconds=config['wire']['flush_interval_seconds'],
+        maintenance=_maintain,
+        maintenance_interval_seconds=config['rollup']['interval_seconds'],
+        on_batch=functools.partial(rewind_rollups, config=config),
+        async_db=async_db,
+        permanent_errors=(
+            postgredb.get_permanent_errors() if async_db is None
+            else asyncpostgredb.get_permanent_errors()
+        )
+    )
+
+    async def _serve():
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop_event.set)
+        await aggregator.serve(
+            bind_address=config['wire']['bind_address'],
+            port=config['wire']['port'], stop_event=stop_event
+        )
+
+    asyncio.run(_serve())
+    log.info('aggregated {0} rows'.format(aggregator.rows_count))
+
+
+def main(argv=None):
+
+    args = parse_args(argv)
+
+    log.info('Start program execution')
+    project_abs_path = file.caller_dir_path()
+
+    # Import configurations and all insert queries once
+    with startup.measure('init', 'config'):
+        config = load_config(project_abs_path)
+        insert_queries = load_insert_queries(project_abs_path, config)
+
+    # Only the database needs the credentials of the environment file and
+    # the tables definitions
+    if not args.agent and not args.dry_run:
+        with startup.measure('init', 'environment'):
+            dotenv.load_dotenv(dotenv_path)
+            schema_queries = load_schema_queries(project_abs_path, config)
+
+    if args.aggregator:
+        run_aggregator(config, insert_queries, schema_queries)
+        log.info('Finished program execution')
+        return
+
+    # Run the collectors concurrently, each one within its timeout
+    with startup.measure('init', 'collection engine'):
+        engine = collector.CollectionEngine(
+            max_workers=config['collectors']['max_workers'],
+            timeout_seconds=config['collectors']['timeout_seconds'],
+            timeouts=config['collectors']['timeouts']
+        )
+
+    # Build the enabled collectors only, importing what they need
+    collectors = get_collector_registry().create(
+        names=get_enabled_collectors(config), config=config
+    )
+
+    if args.dry_run:
+        try:
+            collection = engine.collect(collectors)
+            log.info(json.dumps(collection['results'], default=list))
+        finally:
+            engine.close()
+        if args.startup_profile:
+            log_startup_profile()
+        log.info('Finished program execution')
+        return
+
+    # Agents send their rows to the aggregator instead of the database
+    if args.agent:
+        connect = functools.partial(connect_agent, args.agent, config)
+    else:
+        connect = functools.partial(connect_db, config, schema_queries)
+
+    # Every row is tagged with the host it was collected on
+    host_name = platform.node()
+
+    # The last samples of each collector stay in memory for the exporter
+    recent_samples = dict()
+    if args.daemon and config['exporter']['enabled']:
+        recent_samples = {
+            name: ringbuffer.RingBuffer(
+                fields=fields, capacity=config['recent_samples']['capacity']
+            )
+            for name, fields in config['recent_samples']['fields'].items()
+        }
+
+    # Alert on the samples as they are collected
+    with startup.measure('init', 'alert engine'):
+        alert_engine = alerts.AlertEngine(
+            rules=[
+                alerts.Rule(**rule_config)
+                for rule_config in config['alerts']['rules']
+            ] if config['alerts']['enabled'] else [],
+            sink=alerts.get_sink(config['alerts']['sink'], project_abs_path),
+            host_name=host_name,
+            repeat_seconds=config['alerts']['repeat_seconds']
+        )
+
+    # Skip the rows of the slow moving series that did not change
+    change_filter = None
+    if config['deadband']['enabled']:
+
+        # The rollups and the series average every row; skipped rows would
+        # bias them
+        deadband_tables = dict()
+        for table_name, settings in config['deadband']['tables'].items():
+            if table_name in config['rollup']['tables']:
+                log.warning('{0} is rolled up, writing all its rows despite '
+                            'its deadband'.format(table_name))
+                continue
+            deadband_tables[table_name] = settings
+
+        with startup.measure('init', 'change filter'):
+            change_filter = deadband.ChangeFilter(
+                tables=deadband_tables,
+                insert_queries=insert_queries,
+                state_path=os.path.join(
+                    project_abs_path, config['deadband']['state_path']
+                )
+            )
+
+    # Rows that cannot reach the database are kept in the spool
+    with startup.measure('init', 'spool'):
+        rows_spool = open_spool(project_abs_path, config)
+
+    # Buffer the rows to write them with one commit per flush
+    with startup.measure('init', 'aggregator connection' if args.agent
+                         else 'database connection'):
+        writer = postgredb.BufferedWriter(
+            db=connect(),
+            max_rows=config['writer']['max_rows'],
+            max_bytes=config['writer']['max_bytes'],
+            max_age_seconds=config['writer']['max_age_seconds'],
+            fallback=rows_spool
+        )
+
+    metrics_server = None
+
+    try:
+        if args.daemon:
+            # An explicit --interval runs every collector on it
+            intervals = get_intervals(
+                collectors=collectors, config=config, interval=args.interval
+            )
+
+            # Serve the latest values to Prometheus
+            if config['exporter']['enabled']:
+                with startup.measure('init', 'metrics server'):
+                    metrics_server = exporter.MetricsServer(
+                        bind_address=config['exporter']['bind_address'],
+                        port=config['exporter']['port']
+                    )
+            if args.startup_profile:
+                log_startup_profile()
+            run_daemon(
+                writer=writer, rows_spool=rows_spool,
+                insert_queries=insert_queries, engine=engine,
+                collectors=collectors, host_name=host_name,
+                recent_samples=recent_samples, alert_engine=alert_engine,
+                metrics_server=metrics_server, intervals=intervals,
+                connect=connect, maintain_database=not args.agent,
+                config=config, change_filter=change_filter
+            )
+        else:
+            collect_cycle(
+                writer=writer, insert_queries=insert_queries, engine=engine,
+                collectors=collectors, host_name=host_name,
+                recent_samples=recent_samples, alert_engine=alert_engine,
+                change_filter=change_filter
+            )
+            replay_spool(
+                writer=writer, rows_spool=rows_spool,
+                insert_queries=insert_queries, config=config
+            )
+
+        # Write whatever is still buffered
+        writer.flush()
+
+        # The rows are written or spooled; remember them as the last ones
+        if change_filter is not None:
+            change_filter.save()
+            log.info('wrote {0} changed rows, skipped {1} unchanged'.format(
+                change_filter.written_count, change_filter.skipped_count
+            ))
+        if not args.agent:
+            run_rollup(writer=writer, config=config)
+        if args.startup_profile and not args.daemon:
+            log_startup_profile()
+    finally:
+        if writer.db is not None:
+            writer.db.close()
+        rows_spool.close()
+        engine.close()
+        alert_engine.close()
+        if metrics_server is not None:
+            metrics_server.close()
 
     log.info('Finished program execution')
 
@@ -0,0 +1,309 @@
+import os
+import json
+import math
+import logging
+from packages.startup import startup
+from packages.collector import collector
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+# Only the webhook sink needs the HTTP client
+urllib_request = startup.lazy_import('urllib.request')
+
+FIRING = 'firing'
+RESOLVED = 'resolved'
+
+
+class Rule:
+    """
+    Alert rule on one field of a collector's output
+
+    The rule turns each sample into a signal, compares it with `above` or
+    `below`, and fires once the breach lasted `for_seconds`. A firing rule
+    resolves only when the signal crosses back `clear`, which keeps a value
+    hovering around the threshold from flapping.
+
+    Inputs:
+        name: The alert name, also its deduplication key
+        collector: The collector whose samples are evaluated, e.g. ram_stats
+        field: The field of the collector output
+        type: `threshold` uses the value itself, `rate` its change per
+            minute, and `ewma` its distance from the exponentially weighted
+            moving average in standard deviations
+        above: Breach when the signal is above this
+        below: Breach when the signal is below this
+        clear: Resolve when the signal is back below (or above) this;
+            defaults to the threshold
+        for_seconds: How long the breach must last before firing
+        alpha: The EWMA smoothing factor
+        warmup_samples: The EWMA samples to learn from before evaluating
+    """
+
+    types = ('threshold', 'rate', 'ewma')
+
+    def __init__(
+            self, name, collector, field, type='threshold', above=None,
+            below=None, clear=None, for_seconds=0, alpha=0.1,
+            warmup_samples=30
+    ):
+        if type not in self.types:
+            raise ValueError('Unknown alert rule type: {0}'.format(type))
+        if (above is None) == (below is None):
+            raise ValueError(
+                'Alert rule {0} needs either above or below'.format(name)
+            )
+
+        self.name = name
+        self.collector = collector
+        self.field = field
+        self.type = type
+        self.above = above
+        self.below = below
+        self.threshold = above if above is not None else below
+        self.clear = self.threshold if clear is None else clear
+        self.for_seconds = for_seconds
+        self.alpha = alpha
+        self.warmup_samples = warmup_samples
+
+        self.firing = False
+        self._breach_start = None
+
+        # Previous sample of the rate rules
+        self._last_value = None
+        self._last_time = None
+
+        # Moving average and variance of the EWMA rules
+        self._mean = None
+        self._variance = 0.0
+        self._samples_count = 0
+
+    def _signal(self, value, sample_time):
+        """
+        Returns the signal of a sample, or None while there is not enough
+        history to compute it
+        """
+
+        if self.type == 'threshold':
+            return value
+
+        if self.type == 'rate':
+            signal = None
+            if self._last_time is not None and sample_time > self._last_time:
+                signal = (value - self._last_value) / \
+                         (sample_time - self._last_time) * 60
+            self._last_value = value
+            self._last_time = sample_time
+            return signal
+
+        # Compare with the history, then learn from the sample
+        signal = None
+        if self._mean is None:
+            self._mean = value
+        else:
+            if self._samples_count >= self.warmup_samples:
+                deviation = math.sqrt(self._variance)
+                signal = abs(value - self._mean) / deviation \
+                    if deviation > 0 else 0.0
+            difference = value - self._mean
+            increment = self.alpha * difference
+            self._mean += increment
+            self._variance = (1 - self.alpha) * (
+                self._variance + difference * increment
+            )
+        self._samples_count += 1
+        return signal
+
+    def _is_breached(self, signal):
+        if self.above is not None:
+            return signal > self.above
+        return signal < self.below
+
+    def _is_cleared(self, signal):
+        if self.above is not None:
+            return signal <= self.clear
+        return signal >= self.clear
+
+    def evaluate(self, value, sample_time):
+        """
+        Evaluate one sample
+
+        Inputs:
+            value: The field value
+            sample_time: The time.monotonic() of the sample
+
+        Returns tuple of (FIRING or RESOLVED or None, signal)
+        """
+
+        signal = self._signal(value, sample_time)
+        if signal is None:
+            return None, signal
+
+        if self.firing:
+            if self._is_cleared(signal):
+                self.firing = False
+                self._breach_start = None
+                return RESOLVED, signal
+            return None, signal
+
+        if not self._is_breached(signal):
+            self._breach_start = None
+            return None, signal
+
+        if self._breach_start is None:
+            self._breach_start = sample_time
+        if sample_time - self._breach_start >= self.for_seconds:
+            self.firing = True
+            return FIRING, signal
+        return None, signal
+
+
+class FileSink:
+    """
+    Append the notifications to a file as JSON lines
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def send(self, notification):
+        with open(self.path, 'a') as alerts_file:
+            alerts_file.write(json.dumps(notification) + '\n')
+
+    def close(self):
+        pass
+
+
+class WebhookSink:
+    """
+    POST the notifications as JSON to a webhook
+    The requests run on a background thread, so a slow endpoint does not
+    hold the collection back.
+    """
+
+    def __init__(self, url, timeout_seconds=5):
+        self.url = url
+        self.timeout_seconds = timeout_seconds
+        self._pool = collector.DaemonThreadPool(max_workers=1, name='webhook')
+
+    def _post(self, notification):
+        request = urllib_request.Request(
+            self.url, data=json.dumps(notification).encode('utf8'),
+            headers={'Content-Type': 'application/json'}, method='POST'
+        )
+        try:
+            with urllib_request.urlopen(request, timeout=self.timeout_seconds):
+                pass
+        except Exception as e:
+            log.error('could not send alert {0} to the webhook: {1}'.format(
+                notification['rule'], e
+            ))
+
+    def send(self, notification):
+        self._pool.submit(self._post, notification)
+
+    def close(self):
+        self._pool.shutdown()
+
+
+class AlertEngine:
+    """
+    Evaluate the rules on each collected sample and notify the changes
+
+    Only the transitions are notified, firing then resolved, so a rule
+    breached for hours sends one notification; a firing alert is repeated
+    every `repeat_seconds` when set.
+
+    Inputs:
+        rules: List of Rule
+        sink: Object with a `send(notification)` method
+        host_name: The host reported in the notifications
+        repeat_seconds: Repeat period of a firing alert; None notifies once
+    """
+
+    def __init__(self, rules, sink, host_name=None, repeat_seconds=None):
+        self.sink = sink
+        self.host_name = host_name
+        self.repeat_seconds = repeat_seconds
+
+        # Collector name -> its rules
+        self._rules = dict()
+        for rule in rules:
+            self._rules.setdefault(rule.collector, []).append(rule)
+
+        # Rule name -> time of its last notification
+        self._notified = dict()
+
+    def evaluate(self, collector_name, values, sample_time, timestamp=None):
+        """
+        Evaluate the rules of a collector on its output
+
+        Inputs:
+            collector_name: The collector name
+            values: The collector output dictionary
+            sample_time: The time.monotonic() of the sample
+            timestamp: The timestamp reported in the notifications
+
+        Returns list of the sent notifications
+        """
+
+        notifications = []
+        for rule in self._rules.get(collector_name, []):
+
+            value = values.get(rule.field)
+            if value is None:
+                continue
+
+            state, signal = rule.evaluate(value, sample_time)
+
+            # Repeat a firing alert once its repeat period is over
+            if state is None and rule.firing and \
+                    self.repeat_seconds is not None and \
+                    sample_time - self._notified[rule.name] >= \
+                    self.repeat_seconds:
+                state = FIRING
+            if state is None:
+                continue
+
+            self._notified[rule.name] = sample_time
+
+            notification = {
+                'rule': rule.name,
+                'state': state,
+                'host': self.host_name,
+                'collector': collector_name,
+                'field': rule.field,
+                'type': rule.type,
+                'value': value,
+                'signal': round(signal, 2),
+                'threshold': rule.threshold,
+                'timestamp': timestamp,
+            }
+            log.warning('alert {0} is {1}: {2} {3} = {4}'.format(
+                rule.name, state, rule.type, rule.field, value
+            ))
+            self.sink.send(notification)
+            notifications.append(notification)
+
+        return notifications
+
+    def close(self):
+        self.sink.close()
+
+
+def get_sink(sink_config, project_abs_path):
+    """
+    Create the sink of the `alerts` section of config.yaml
+    Relative file paths are relative to the project directory.
+    """
+
+    if sink_config['type'] == 'file':
+        return FileSink(os.path.join(project_abs_path, sink_config['path']))
+    if sink_config['type'] == 'webhook':
+        return WebhookSink(
+            url=sink_config['url'],
+            timeout_seconds=sink_config['timeout_seconds']
+        )
+    raise ValueError('Unknown alert sink: {0}'.format(sink_config['type']))
@@ -0,0 +1,204 @@
+import time
+import decimal
+import asyncio
+import logging
+import functools
+import asyncpg
+from datetime import datetime
+from packages.postgredb import postgredb
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+
+def _to_datetime(value):
+    # The collectors timestamps are strings; asyncpg needs datetime objects
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def parse_insert_query(insert_query):
+    """
+    Rewrite a single row insert query for asyncpg
+
+    Inputs:
+        insert_query: Query like `INSERT INTO table (col, ...)
+            VALUES (timestamptz %s, %s, ...)`
+
+    Returns tuple of:
+        - table name
+        - list of the columns
+        - the insert statement with $n placeholders
+        - list of the converter of each value, or None to send it as is
+    """
+
+    table_name, columns_list, statement, types_list = \
+        postgredb.get_prepared_insert(insert_query)
+    converters = [
+        _to_datetime if type_name in ('timestamp', 'timestamptz') else None
+        for type_name in types_list
+    ]
+    return table_name, columns_list, statement, converters
+
+
+def get_permanent_errors():
+    """
+    Returns tuple of the exception types of rows that can never be written,
+    like postgredb.get_permanent_errors(); asyncpg encodes the values on
+    the client, raising ValueError, or decimal.InvalidOperation for a text
+    sent to a numeric column
+    """
+
+    return (
+        ValueError, TypeError, decimal.InvalidOperation, asyncpg.DataError,
+        asyncpg.IntegrityConstraintViolationError
+    )
+
+
+def _convert_rows(rows, converters):
+    if not any(converters):
+        return rows
+    return [
+        [
+            value if converter is None else converter(value)
+            for converter, value in zip(converters, values_list)
+        ]
+        for values_list in rows
+    ]
+
+
+class AsyncPostgreSQLDB:
+    """
+    asyncio PostgreSQL client with a connection pool
+
+    The batches are loaded with binary COPY. The row inserts are sent with
+    executemany(), which prepares each statement once per connection and
+    pipelines the rows without waiting for each one. At most `max_in_flight`
+    batches are written at the same time; the next ones wait for a free
+    slot.
+
+    Inputs:
+        host, db_name, username, password: The connection parameters
+        min_size: The connections opened with the pool
+        max_size: The maximum number of connections
+        statement_timeout_seconds: Server side timeout of each statement
+        max_in_flight: The number of batches written concurrently
+        connect_timeout: Seconds to wait for a connection
+    """
+
+    def __init__(
+            self, host, db_name, username, password, min_size=1, max_size=4,
+            statement_timeout_seconds=30, max_in_flight=4,
+            connect_timeout=None
+    ):
+        self.host = host
+        self.db_name = db_name
+        self.username = username
+        self.password = password
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_timeout_seconds = statement_timeout_seconds
+        self.max_in_flight = max_in_flight
+        self.connect_timeout = connect_timeout
+        self.pool = None
+        self._in_flight = None
+
+    async def open(self):
+        self.pool = await asyncpg.create_pool(
+            host=self.host,
+            database=self.db_name,
+            user=self.username,
+            password=self.password,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            timeout=self.connect_timeout,
+            server_settings={
+                'statement_timeout': str(
+                    int(self.statement_timeout_seconds * 1000)
+                ),
+                'TimeZone': 'UTC'
+            }
+        )
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        return self
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def insert_rows(self, insert_query, rows, connection=None,
+                          on_conflict_do_nothing=False):
+        """
+        Insert rows shaped for one of the insert queries
+
+        Inputs:
+            insert_query: The single row insert query
+            rows: List of values lists
+            connection: The connection of the current transaction; one from
+                the pool is used when None
+            on_conflict_do_nothing: Skip the rows that already exist
+        """
+
+        _, _, statement, converters = parse_insert_query(insert_query)
+        if on_conflict_do_nothing:
+            statement += ' ON CONFLICT DO NOTHING'
+        rows = _convert_rows(rows, converters)
+
+        if connection is not None:
+            await connection.executemany(statement, rows)
+            return
+        async with self.pool.acquire() as connection:
+            await connection.executemany(statement, rows)
+
+    async def copy_insert_rows(self, insert_query, rows, connection):
+        """
+        Bulk load rows shaped for one of the insert queries with binary COPY
+        """
+
+        table_name, columns_list, _, converters = parse_insert_query(
+            insert_query
+        )
+        await connection.copy_records_to_table(
+            table_name, records=_convert_rows(rows, converters),
+            columns=columns_list
+        )
+
+    async def load_batch(self, queries_rows):
+        """
+        Bulk load rows of several tables with COPY in one transaction, like
+        PostgreSQLDB.load_batch(); if some rows already exist, the batch is
+        inserted again with the prepared statements, skipping them
+
+        Inputs:
+            queries_rows: Dictionary of insert query to list of rows
+        """
+
+        async with self._in_flight:
+            start_time = time.perf_counter()
+            async with self.pool.acquire() as connection:
+                try:
+                    async with connection.transaction():
+                        for insert_query, rows in queries_rows.items():
+                            await self.copy_insert_rows(
+                                insert_query, rows, connection
+                            )
+                except asyncpg.UniqueViolationError:
+                    log.warning(
+                        'batch overlaps existing rows, skipping duplicates'
+                    )
+                    async with connection.transaction():
+                        for insert_query, rows in queries_rows.items():
+                            await self.insert_rows(
+                                insert_query, rows, connection=connection,
+                                on_conflict_do_nothing=True
+                            )
+
+            rows_count = sum(len(rows) for rows in queries_rows.values())
+            duration = time.perf_counter() - start_time
+            log.info('inserted {0} rows in {1} seconds ({2} rows/s)'.format(
+                rows_count, round(duration, 3),
+                round(rows_count / duration if duration > 0 else 0, 2)
+            ))
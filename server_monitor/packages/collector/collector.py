@@ -0,0 +1,204 @@
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future, TimeoutError
+from packages.startup import startup
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+
+class DaemonThreadPool:
+    """
+    Bounded thread pool made of daemon threads
+
+    Unlike ThreadPoolExecutor, whose workers are joined at interpreter exit,
+    a task stuck in a syscall (e.g. a stale network mount) cannot keep the
+    process from exiting.
+
+    Inputs:
+        max_workers: The number of worker threads
+        name: The prefix of the worker threads names
+    """
+
+    def __init__(self, max_workers=4, name='pool'):
+        self._tasks = queue.SimpleQueue()
+        self._threads = []
+        for index in range(max_workers):
+            thread = threading.Thread(
+                target=self._work, name='{0}_{1}'.format(name, index),
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+
+            # None is the shutdown marker
+            if task is None:
+                return
+
+            future, function, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = function(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Schedule `function(*args, **kwargs)`
+        Returns concurrent.futures.Future of the call
+        """
+
+        future = Future()
+        self._tasks.put((future, function, args, kwargs))
+        return future
+
+    def shutdown(self):
+        # Idle workers exit; busy ones are abandoned with the process
+        for _ in self._threads:
+            self._tasks.put(None)
+
+
+class CollectionEngine:
+    """
+    Run the collectors concurrently with a timeout for each of them
+
+    A collector that exceeds its timeout keeps running in the background and
+    is reported as timed out; it is not started again until it returns, so
+    a hung collector holds at most one worker.
+
+    Inputs:
+        max_workers: The number of collectors running at the same time
+        timeout_seconds: The default timeout of a collector
+        timeouts: Dictionary of collector name to its own timeout
+    """
+
+    def __init__(self, max_workers=4, timeout_seconds=5.0, timeouts=None):
+        self.timeout_seconds = timeout_seconds
+        self.timeouts = timeouts or dict()
+        self._pool = DaemonThreadPool(max_workers=max_workers, name='collector')
+
+        # Collector name -> future of a run that outlived its timeout
+        self._in_flight = dict()
+
+    @staticmethod
+    def _timed_call(function):
+        start_time = time.perf_counter()
+        result = function()
+        return result, time.perf_counter() - start_time
+
+    def collect(self, collectors):
+        """
+        Run the collectors and wait for them up to their timeouts
+
+        Inputs:
+            collectors: Dictionary of collector name to a callable without
+                arguments
+
+        Returns dictionary with the following keys:
+            - results: Dictionary of collector name to its output
+            - durations: Dictionary of collector name to its run seconds
+            - timed_out: List of the collectors that did not finish in time
+            - failed: Dictionary of collector name to its raised exception
+        """
+
+        start_time = time.monotonic()
+
+        # Initialize the output dictionary
+        output_dict = dict()
+        output_dict['results'] = dict()
+        output_dict['durations'] = dict()
+        output_dict['timed_out'] = []
+        output_dict['failed'] = dict()
+
+        # Start all collectors; skip the ones still stuck in a previous cycle
+        futures = dict()
+        for name, function in collectors.items():
+            stuck_future = self._in_flight.get(name)
+            if stuck_future is not None and not stuck_future.done():
+                output_dict['timed_out'].append(name)
+                continue
+            self._in_flight.pop(name, None)
+            futures[name] = self._pool.submit(self._timed_call, function)
+
+        # Wait for each collector until its own deadline
+        for name, future in futures.items():
+            deadline = start_time + self.timeouts.get(name, self.timeout_seconds)
+            try:
+                result, duration = future.result(
+                    timeout=max(0.0, deadline - time.monotonic())
+                )
+            except TimeoutError:
+                output_dict['timed_out'].append(name)
+                self._in_flight[name] = future
+            except Exception as e:
+                output_dict['failed'][name] = e
+            else:
+                output_dict['results'][name] = result
+                output_dict['durations'][name] = round(duration, 4)
+
+        if output_dict['timed_out']:
+            log.warning('collectors timed out: {0}'.format(
+                ', '.join(output_dict['timed_out'])
+            ))
+        for name, error in output_dict['failed'].items():
+            log.error('collector {0} failed: {1}'.format(name, error))
+
+        return output_dict
+
+    def close(self):
+        self._pool.shutdown()
+
+
+class CollectorRegistry:
+    """
+    Collectors registered by name with a factory building each of them
+
+    A factory receives the configuration and returns the collector callable.
+    It runs only when its collector is enabled, so the modules a collector
+    depends on, e.g. a GPU library, are imported only on the hosts using it.
+    """
+
+    def __init__(self):
+        # Collector name -> factory, in registration order
+        self._factories = dict()
+
+    def register(self, name, factory):
+        self._factories[name] = factory
+
+    def names(self):
+        return list(self._factories)
+
+    def create(self, names, config):
+        """
+        Build the enabled collectors
+
+        Inputs:
+            names: The enabled collectors names
+            config: The configuration passed to the factories
+
+        Returns dictionary of collector name to its callable, in the
+        registration order
+        """
+
+        unknown_names = set(names) - set(self._factories)
+        if unknown_names:
+            raise ValueError('Unknown collectors: {0}'.format(
+                ', '.join(sorted(unknown_names))
+            ))
+
+        collectors = dict()
+        for name, factory in self._factories.items():
+            if name in names:
+                with startup.measure('init', name):
+                    collectors[name] = factory(config)
+        return collectors
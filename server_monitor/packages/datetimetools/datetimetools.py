@@ -1,22 +1,61 @@
 from zoneinfo import ZoneInfo
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import functools
 import logging
 
 # Import logger
 log = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def get_zone(name):
+    # Loading a time zone reads its tzdata file
+    return ZoneInfo(name)
+
+
 def get_current_timestamp(
         output_format='%Y-%m-%d %H:%M:%S',
         target_timezone='Africa/Cairo'
 ):
     current_timestamp = str(datetime.now(
-        tz=ZoneInfo(target_timezone)).strftime(output_format))
+        tz=get_zone(target_timezone)).strftime(output_format))
     return current_timestamp
 
 
 def get_current_timestamp_obj(target_timezone='Africa/Cairo'):
-    return datetime.now(tz=ZoneInfo(target_timezone))
+    return datetime.now(tz=get_zone(target_timezone))
+
+
+def get_utc_now():
+    return datetime.now(tz=timezone.utc)
+
+
+def get_utc_timestamp(epoch=None):
+    """
+    Format a sample timestamp for the timestamptz columns, in UTC with
+    microseconds, e.g. `2024-01-31 22:00:00.250000+00:00`
+
+    Inputs:
+        epoch: Seconds since the epoch; defaults to now
+    """
+
+    if epoch is None:
+        moment = datetime.now(tz=timezone.utc)
+    else:
+        moment = datetime.fromtimestamp(epoch, tz=timezone.utc)
+    return moment.isoformat(sep=' ', timespec='microseconds')
+
+
+def parse_timestamp(value, naive_timezone='UTC'):
+    """
+    Parse a sample timestamp into an aware datetime; timestamps without
+    offset, written before the timestamptz columns, are in `naive_timezone`
+    """
+
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=get_zone(naive_timezone))
+    return moment
 
 
 def get_today_date(output_format='%Y-%m-%d'):
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import numbers
+import hashlib
+import logging
+from packages.postgredb import postgredb
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+
+def _moved(value, last_value, absolute=None, relative=None):
+    """
+    Returns True if a metric moved out of its deadband since the last
+    written value; without deadband, any change counts
+    """
+
+    numeric = all(
+        isinstance(item, numbers.Real) and not isinstance(item, bool)
+        for item in (value, last_value)
+    )
+    if not numeric:
+        return value != last_value
+
+    delta = abs(value - last_value)
+    if absolute is None and relative is None:
+        return delta != 0
+    if absolute is not None and delta > absolute:
+        return True
+    if relative is not None and delta > relative * abs(last_value):
+        return True
+    return False
+
+
+class Deadband:
+    """
+    Change detection settings of one table
+
+    Inputs:
+        columns: The columns of the table insert query, in order
+        key_columns: The columns identifying a series besides the host,
+            e.g. the mountpoint of partition_stats
+        metrics: Dictionary of column to its deadband, with `absolute`
+            and/or `relative` (a fraction of the last written value); the
+            row is written when any of them moves beyond its deadband
+        ignore_columns: Columns that do not trigger a write on their own,
+            e.g. a JSON copy of values held by another table
+        heartbeat_seconds: Write the row at least this often even when
+            nothing changed; None writes unchanged rows never again
+        time_column: The timestamp column, never compared
+    """
+
+    def __init__(
+            self, columns, key_columns=None, metrics=None,
+            ignore_columns=None, heartbeat_seconds=3600,
+            time_column='created'
+    ):
+        self.columns = columns
+        self.key_columns = ['host'] + list(key_columns or [])
+        self.metrics = metrics or dict()
+        self.heartbeat_seconds = heartbeat_seconds
+
+        # Every other column is compared exactly through a fingerprint
+        skipped_columns = set(self.key_columns) | set(self.metrics) | \
+            set(ignore_columns or []) | {time_column}
+        self.exact_columns = [
+            column for column in columns if column not in skipped_columns
+        ]
+
+        for column in list(self.key_columns) + list(self.metrics):
+            if column not in columns:
+                raise ValueError('Unknown column: {0}'.format(column))
+
+
+class ChangeFilter:
+    """
+    Drop the rows of slow moving series that did not change
+
+    Each row is compared with the last row written for the same table,
+    host and key columns. It is written only when one of its metrics moved
+    beyond its deadband, another column changed, or the heartbeat expired.
+    The gaps between two written rows repeat the previous one, so the
+    series is a step function the readers rebuild with
+    query.get_step_series(). The tables without settings are always
+    written.
+
+    The last written rows are kept in a JSON state file, so that single
+    runs started by cron compare with the previous run.
+
+    Inputs:
+        tables: Dictionary of table name to the Deadband keyword arguments,
+            like `deadband.tables` in config.yaml
+        insert_queries: Dictionary of table name to its insert query
+        state_path: The state file; None keeps the state in memory only
+    """
+
+    def __init__(self, tables, insert_queries, state_path=None):
+        self.state_path = state_path
+        self.deadbands = dict()
+        for table_name, settings in tables.items():
+            _, columns_list, _ = postgredb.parse_insert_query(
+                insert_queries[table_name]
+            )
+            self.deadbands[table_name] = Deadband(
+                columns=columns_list, **(settings or dict())
+            )
+
+        # Series key -> dict of fingerprint, metrics values and write time
+        self._last_rows = dict()
+        self.written_count = 0
+        self.skipped_count = 0
+
+        if state_path is not None:
+            self.load()
+
+    def accept(self, table_name, values_list, now=None):
+        """
+        Returns True if the row has to be written, and records it as the
+        last written row of its series
+        """
+
+        deadband = self.deadbands.get(table_name)
+        if deadband is None:
+            return True
+        if now is None:
+            now = time.time()
+
+        row = dict(zip(deadband.columns, values_list))
+        key = json.dumps(
+            [table_name] + [row[column] for column in deadband.key_columns],
+            default=str
+        )
+        fingerprint = hashlib.sha1(json.dumps(
+            [row[column] for column in deadband.exact_columns], default=str
+        ).encode('utf8')).hexdigest()
+
+        last_row = self._last_rows.get(key)
+        changed = (
+            last_row is None
+            or last_row['fingerprint'] != fingerprint
+            or (deadband.heartbeat_seconds is not None
+                and now - last_row['time'] >= deadband.heartbeat_seconds)
+            or any(
+                _moved(
+                    row[column], last_row['values'].get(column),
+                    band.get('absolute'), band.get('relative')
+                )
+                for column, band in deadband.metrics.items()
+            )
+        )
+        if not changed:
+            self.skipped_count += 1
+            return False
+
+        self._last_rows[key] = {
+            'fingerprint': fingerprint,
+            'values': {column: row[column] for column in deadband.metrics},
+            'time': now
+        }
+        self.written_count += 1
+        return True
+
+    def load(self):
+        try:
+            with open(self.state_path) as state_file:
+                self._last_rows = json.load(state_file)
+        except FileNotFoundError:
+            self._last_rows = dict()
+        except ValueError as e:
+            # Start over, writing every series once
+            log.warning('ignoring the unreadable deadband state: {0}'.format(e))
+            self._last_rows = dict()
+
+    def save(self, now=None):
+        """
+        Write the state file atomically, dropping the series whose heartbeat
+        expired since they would be written anyway
+        """
+
+        if self.state_path is None:
+            return
+        if now is None:
+            now = time.time()
+
+        last_rows = dict()
+        for key, last_row in self._last_rows.items():
+            deadband = self.deadbands.get(json.loads(key)[0])
+            if deadband is None:
+                continue
+            if deadband.heartbeat_seconds is not None and \
+                    now - last_row['time'] >= deadband.heartbeat_seconds:
+                continue
+            last_rows[key] = last_row
+
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump(last_rows, state_file)
+        os.replace(temp_path, self.state_path)
@@ -0,0 +1,273 @@
+import math
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+_PREFIX = 'server_monitor_'
+
+# Collector name -> list of (output field, metric name, help text) gauges
+_GAUGES = {
+    'cpu_stats': [
+        ('cpu_usage_percent', 'cpu_usage_percent', 'CPU usage'),
+        ('cpu_user_percent', 'cpu_user_percent', 'CPU time in user mode'),
+        ('cpu_system_percent', 'cpu_system_percent',
+         'CPU time in kernel mode'),
+        ('cpu_iowait_percent', 'cpu_iowait_percent',
+         'CPU time waiting for I/O'),
+        ('cpu_steal_percent', 'cpu_steal_percent',
+         'CPU time stolen by the hypervisor'),
+        ('current_cpu_freq_ghz', 'cpu_frequency_ghz',
+         'Average current CPU frequency'),
+        ('max_core_usage_percent', 'cpu_max_core_usage_percent',
+         'Usage of the busiest core'),
+        ('busy_cores_count', 'cpu_busy_cores', 'Cores above the busy threshold'),
+        ('load_average_1m', 'load_average_1m', 'Load average over 1 minute'),
+        ('load_average_5m', 'load_average_5m', 'Load average over 5 minutes'),
+        ('load_average_15m', 'load_average_15m',
+         'Load average over 15 minutes'),
+    ],
+    'ram_stats': [
+        ('total_ram_gb', 'ram_total_gb', 'Total RAM'),
+        ('used_ram_gb', 'ram_used_gb', 'Used RAM'),
+        ('free_ram_gb', 'ram_free_gb', 'Free RAM'),
+        ('ram_usage_percent', 'ram_usage_percent', 'RAM usage'),
+        ('total_swap_gb', 'swap_total_gb', 'Total swap'),
+        ('used_swap_gb', 'swap_used_gb', 'Used swap'),
+        ('swap_usage_percent', 'swap_usage_percent', 'Swap usage'),
+    ],
+    'storage_stats': [
+        ('storage_usage_percent', 'storage_usage_percent',
+         'Usage of the headline partition'),
+        ('partitions_count', 'storage_partitions', 'Monitored partitions'),
+    ],
+    'gpu_stats': [
+        ('gpus_count', 'gpus', 'GPUs count'),
+        ('gpu_temperature', 'gpu_max_temperature_celsius',
+         'Highest GPU temperature'),
+        ('gpu_utilization_percent', 'gpu_average_utilization_percent',
+         'Average GPU compute utilization'),
+    ],
+}
+
+# Per item gauges of the lists in the collectors outputs:
+# collector name -> (list field, labels of an item, list of gauges)
+_ITEM_GAUGES = {
+    'storage_stats': (
+        'partitions_list',
+        lambda partition: [
+            ('device', partition['partition_name']),
+            ('mountpoint', partition['partition_mountpoint']),
+            ('fstype', partition['partition_fstype']),
+        ],
+        [
+            ('partition_available', 'partition_available',
+             'Whether the partition usage could be read'),
+            ('partition_total_gb', 'partition_total_gb', 'Partition size'),
+            ('partition_used_gb', 'partition_used_gb', 'Partition used space'),
+            ('partition_free_gb', 'partition_free_gb', 'Partition free space'),
+            ('partition_percentage', 'partition_usage_percent',
+             'Partition usage'),
+        ]
+    ),
+    'gpu_stats': (
+        'gpus_list',
+        lambda gpu: [('gpu', gpu['id']), ('name', gpu['name'])],
+        [
+            ('total_memory_gb', 'gpu_memory_total_gb', 'GPU memory size'),
+            ('used_memory_gb', 'gpu_memory_used_gb', 'GPU used memory'),
+            ('usage_percentage', 'gpu_memory_usage_percent',
+             'GPU memory usage'),
+            ('temperature', 'gpu_temperature_celsius', 'GPU temperature'),
+            ('utilization_percent', 'gpu_utilization_percent',
+             'GPU compute utilization'),
+            ('power_draw_watts', 'gpu_power_draw_watts', 'GPU power draw'),
+        ]
+    ),
+}
+
+# Per core arrays of the CPU stats: output field, metric name, help text
+_CORE_GAUGES = [
+    ('per_core_usage_percent', 'cpu_core_usage_percent', 'Usage of a core'),
+    ('per_core_freq_ghz', 'cpu_core_frequency_ghz', 'Frequency of a core'),
+]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, _escape(value)) for name, value in labels
+    ) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    return repr(value)
+
+
+class _Family:
+    """
+    Samples of one metric, written together under its TYPE and HELP lines
+    """
+
+    def __init__(self, name, help_text):
+        self.name = _PREFIX + name
+        self.help_text = help_text
+        self.lines = []
+
+    def add(self, labels, value):
+        if value is None:
+            return
+        self.lines.append('{0}{1} {2}'.format(
+            self.name, _format_labels(labels), _format_value(value)
+        ))
+
+
+def render(results, host_name, durations=None, recent_samples=None,
+           window_seconds=300, percent=95):
+    """
+    Render the outputs of a collection cycle in the OpenMetrics text format
+
+    Inputs:
+        results: Dictionary of collector name to its output
+        host_name: The value of the `host` label
+        durations: Dictionary of collector name to its run seconds
+        recent_samples: Dictionary of collector name to its RingBuffer,
+            whose fields are summarized over the last `window_seconds`
+        window_seconds: The window of the recent samples statistics
+        percent: The percentile reported besides min, max and mean
+
+    Returns bytes of the whole exposition, ending with `# EOF`
+    """
+
+    host_label = [('host', host_name)]
+    families = []
+
+    for collector_name, gauges in _GAUGES.items():
+        values = results.get(collector_name)
+        if values is None:
+            continue
+        for field, name, help_text in gauges:
+            family = _Family(name, help_text)
+            family.add(host_label, values.get(field))
+            families.append(family)
+
+    for collector_name, (list_field, get_labels, gauges) in \
+            _ITEM_GAUGES.items():
+        values = results.get(collector_name)
+        if values is None:
+            continue
+        for field, name, help_text in gauges:
+            family = _Family(name, help_text)
+            for item in values[list_field]:
+                family.add(host_label + get_labels(item), item.get(field))
+            families.append(family)
+
+    cpu_stats = results.get('cpu_stats')
+    if cpu_stats is not None:
+        for field, name, help_text in _CORE_GAUGES:
+            family = _Family(name, help_text)
+            for core, value in enumerate(cpu_stats[field]):
+                family.add(host_label + [('core', core)], value)
+            families.append(family)
+
+    if recent_samples:
+        family = _Family(
+            'recent_value', 'Statistics of a field over the last {0} '
+            'seconds'.format(window_seconds)
+        )
+        for collector_name, recent_buffer in recent_samples.items():
+            for field in recent_buffer.fields:
+                labels = host_label + [
+                    ('collector', collector_name), ('field', field)
+                ]
+                summary = recent_buffer.summary(field, window_seconds)
+                for stat in ('min', 'max', 'mean'):
+                    family.add(labels + [('stat', stat)], summary[stat])
+                family.add(
+                    labels + [('stat', 'p{0}'.format(percent))],
+                    recent_buffer.percentile(field, percent, window_seconds)
+                )
+        families.append(family)
+
+    if durations:
+        family = _Family(
+            'collector_duration_seconds', 'Run time of the last collection'
+        )
+        for collector_name, duration in durations.items():
+            family.add(host_label + [('collector', collector_name)], duration)
+        families.append(family)
+
+    lines = []
+    for family in families:
+        if not family.lines:
+            continue
+        lines.append('# TYPE {0} gauge'.format(family.name))
+        lines.append('# HELP {0} {1}'.format(family.name, family.help_text))
+        lines.extend(family.lines)
+    lines.append('# EOF\n')
+    return '\n'.join(lines).encode('utf8')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        # The exposition was rendered by the collection cycle
+        payload = self.server.payload
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class MetricsServer:
+    """
+    HTTP endpoint serving the last rendered exposition at /metrics
+
+    A scrape only writes the bytes rendered by the last collection cycle; it
+    never triggers a collection.
+
+    Inputs:
+        bind_address: The address to listen on
+        port: The port to listen on
+    """
+
+    def __init__(self, bind_address='0.0.0.0', port=9105):
+        self._server = ThreadingHTTPServer((bind_address, port), _MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.payload = b'# EOF\n'
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name='metrics_server',
+            daemon=True
+        )
+        self._thread.start()
+        log.info('serving metrics on {0}:{1}'.format(bind_address, port))
+
+    def update(self, payload):
+        # Swapping the reference is atomic for the request threads
+        self._server.payload = payload
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
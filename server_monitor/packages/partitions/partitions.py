@@ -0,0 +1,228 @@
+import re
+import logging
+from datetime import datetime, timedelta, timezone
+from packages.schema import schema
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+intervals = ('day', 'week')
+
+
+def partition_start(moment, interval='day'):
+    """
+    Get the start of the partition holding `moment`; weeks start on Monday
+    Returns datetime, in the time zone of `moment`
+    """
+
+    day_start = datetime(
+        moment.year, moment.month, moment.day, tzinfo=moment.tzinfo
+    )
+    if interval == 'day':
+        return day_start
+    if interval == 'week':
+        return day_start - timedelta(days=day_start.weekday())
+    raise ValueError('Unknown partition interval: {0}'.format(interval))
+
+
+def partition_end(start, interval='day'):
+    if interval == 'day':
+        return start + timedelta(days=1)
+    return start + timedelta(weeks=1)
+
+
+def partition_name(table_name, start):
+    return '{0}_p{1}'.format(table_name, start.strftime('%Y%m%d'))
+
+
+def is_partitioned(db, table_name):
+    db.run_query(
+        "SELECT relkind FROM pg_class "
+        "WHERE relname = '{0}' AND relkind IN ('r', 'p')".format(table_name)
+    )
+    rows = db.fetch_results()
+    return bool(rows) and rows[0][0] == 'p'
+
+
+def get_partitions(db, table_name):
+    """
+    Get the range partitions of a table
+    Returns list of tuples of (partition name, upper bound UTC datetime)
+    """
+
+    db.run_query(
+        "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) "
+        "FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = '{0}'".format(table_name)
+    )
+
+    partitions_list = []
+    for name, bound in db.fetch_results():
+        # The default partition has no upper bound
+        match = re.search(r"TO \('([^']+)'\)", bound)
+        if match is None:
+            continue
+        # The bounds are printed in the session time zone, which is UTC
+        upper_bound = datetime.fromisoformat(match.group(1)[:19]).replace(
+            tzinfo=timezone.utc
+        )
+        partitions_list.append((name, upper_bound))
+    return partitions_list
+
+
+def _create_partition(db, table_name, name, start, end):
+    """
+    Create one range partition; the rows of its range that landed in the
+    default partition, e.g. while the maintenance was late, would make the
+    creation fail, so the default partition is detached and they are moved
+    into the new partition before it is attached again
+    """
+
+    default_name = '{0}_default'.format(table_name)
+    range_filter = "created >= '{0}' AND created < '{1}'".format(
+        start.isoformat(' '), end.isoformat(' ')
+    )
+
+    db.run_query(
+        'SELECT count(*) FROM {0} WHERE {1}'.format(default_name, range_filter)
+    )
+    rows_count = db.fetch_results()[0][0]
+
+    if rows_count:
+        db.run_query('ALTER TABLE {0} DETACH PARTITION {1}'.format(
+            table_name, default_name
+        ))
+
+    db.run_query(
+        "CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} "
+        "FOR VALUES FROM ('{2}') TO ('{3}')".format(
+            name, table_name, start.isoformat(' '), end.isoformat(' ')
+        )
+    )
+
+    if rows_count:
+        db.run_query(
+            'WITH moved AS (DELETE FROM {0} WHERE {1} RETURNING *) '
+            'INSERT INTO {2} SELECT * FROM moved'.format(
+                default_name, range_filter, name
+            )
+        )
+        log.warning('moved {0} rows of {1} from {2} into {3}'.format(
+            rows_count, table_name, default_name, name
+        ))
+        db.run_query('ALTER TABLE {0} ATTACH PARTITION {1} DEFAULT'.format(
+            table_name, default_name
+        ))
+
+
+def ensure_partitions(db, table_name, interval='day', premake=3, now=None):
+    """
+    Create the partitions of the current period and the `premake` next ones,
+    and the default partition catching the rows outside of them
+    A partition that cannot be created is logged and skipped, so the next
+    ones, and the other tables, are still maintained.
+
+    Returns the number of created partitions
+    """
+
+    now = now or datetime.now(tz=timezone.utc)
+    existing = {name for name, _ in get_partitions(db, table_name)}
+
+    db.run_query(
+        'CREATE TABLE IF NOT EXISTS {0}_default '
+        'PARTITION OF {0} DEFAULT'.format(table_name)
+    )
+    db.commit()
+
+    created_count = 0
+    start = partition_start(now, interval)
+    for _ in range(premake + 1):
+        end = partition_end(start, interval)
+        name = partition_name(table_name, start)
+        if name not in existing:
+            # Each partition in its own transaction
+            try:
+                _create_partition(db, table_name, name, start, end)
+                db.commit()
+                created_count += 1
+            except Exception as e:
+                db.rollback()
+                log.error('could not create the partition {0}: {1}'.format(
+                    name, e
+                ))
+        start = end
+
+    return created_count
+
+
+def drop_expired_partitions(db, table_name, retention_days, now=None):
+    """
+    Drop the partitions whose whole range is older than the retention, and
+    delete the expired rows that landed in the default partition
+
+    Returns list of the dropped partitions names
+    """
+
+    now = now or datetime.now(tz=timezone.utc)
+    cutoff = now - timedelta(days=retention_days)
+
+    dropped_list = []
+    for name, upper_bound in get_partitions(db, table_name):
+        if upper_bound <= cutoff:
+            db.run_query('DROP TABLE IF EXISTS {0}'.format(name))
+            dropped_list.append(name)
+
+    db.run_query(
+        "DELETE FROM {0}_default WHERE created < '{1}'".format(
+            table_name, cutoff.isoformat(' ')
+        )
+    )
+
+    db.commit()
+    return dropped_list
+
+
+def maintain(db, tables_names, interval='day', premake=3, retention_days=None,
+             now=None):
+    """
+    Create the upcoming partitions and drop the expired ones of each table
+    A table created before the partitioned mode was enabled is left as is.
+    """
+
+    for table_name in tables_names:
+
+        if not is_partitioned(db, table_name):
+            log.warning(
+                '{0} is not a partitioned table; it was created in the plain '
+                'schema mode and has to be migrated by hand'.format(table_name)
+            )
+            continue
+
+        if schema.get_column_type(db, table_name, 'created') != \
+                'timestamp with time zone':
+            log.warning(
+                '{0} is partitioned on a naive timestamp; it was created '
+                'before the timestamptz schema and has to be migrated by '
+                'hand'.format(table_name)
+            )
+            continue
+
+        created_count = ensure_partitions(
+            db, table_name, interval=interval, premake=premake, now=now
+        )
+        if created_count:
+            log.info('created {0} partitions of {1}'.format(
+                created_count, table_name
+            ))
+
+        if retention_days:
+            dropped_list = drop_expired_partitions(
+                db, table_name, retention_days=retention_days, now=now
+            )
+            if dropped_list:
+                log.info('dropped expired partitions: {0}'.format(
+                    ', '.join(dropped_list)
+                ))
@@ -1,43 +1,432 @@
+import io
+import re
+import csv
+import time
+import random
 import logging
-import psycopg2 as postgres
+import functools
+import contextlib
+from packages.startup import startup
 
 
 # Import logger
 log = logging.getLogger(__name__)
 
+# psycopg2 is imported on the first database call, so the agents and the
+# dry runs, which only buffer rows, do not load it
+postgres = startup.lazy_import('psycopg2')
+extras = startup.lazy_import('psycopg2.extras')
+extensions = startup.lazy_import('psycopg2.extensions')
+
+# libpq options of the TCP keepalives: constructor argument -> option
+_KEEPALIVE_OPTIONS = {
+    'keepalives_idle': 'keepalives_idle',
+    'keepalives_interval': 'keepalives_interval',
+    'keepalives_count': 'keepalives_count',
+    'tcp_user_timeout': 'tcp_user_timeout',
+}
+
+
+def _reconnecting(method):
+    """
+    Run a method again on a new connection if the connection dropped
+    Only a call started outside of a transaction is retried, since the
+    statements of an open transaction are lost with its connection.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.check_connection()
+        in_transaction = self._in_transaction()
+        try:
+            result = method(self, *args, **kwargs)
+        except (postgres.OperationalError, postgres.InterfaceError):
+            if in_transaction or not self.connection.closed or \
+                    not self.reconnect_attempts:
+                raise
+            log.warning('the database connection dropped, reconnecting')
+            self.reconnect()
+            result = method(self, *args, **kwargs)
+        self._mark_used()
+        return result
+
+    return wrapper
+
 
 class PostgreSQLDB:
-    def __init__(self, host, db_name, username, password):
+    """
+    PostgreSQL connection with its cursor
+
+    A dropped connection is opened again with jittered exponential backoff,
+    up to `reconnect_attempts` times, and the call that found it dropped is
+    retried when no transaction was open. A connection left idle for
+    `liveness_check_seconds` is checked with `SELECT 1` before its next use,
+    which catches a server restart or a pooler closing idle sessions before
+    the rows are sent.
+
+    Inputs:
+        host, db_name, username, password: The connection parameters
+        connect_timeout: Seconds to wait for the connection
+        reconnect_attempts: Connection attempts after a drop; 0 disables
+            the transparent reconnect
+        backoff_base_seconds: Delay before the second attempt, doubled for
+            each next one
+        backoff_max_seconds: Upper bound of the delay
+        liveness_check_seconds: Idle time after which the connection is
+            checked before use; None never checks
+        keepalives_idle, keepalives_interval, keepalives_count,
+        tcp_user_timeout: The libpq TCP options; None keeps their default
+        prepared_statements: Run insert_rows() through server-side prepared
+            statements; disable behind a pooler in transaction mode
+        timezone: The session time zone, in which the timestamptz values
+            are read and the rollup buckets truncated
+    """
+
+    def __init__(
+            self, host, db_name, username, password, connect_timeout=None,
+            reconnect_attempts=3, backoff_base_seconds=0.5,
+            backoff_max_seconds=10, liveness_check_seconds=30,
+            keepalives_idle=None, keepalives_interval=None,
+            keepalives_count=None, tcp_user_timeout=None,
+            prepared_statements=True, timezone='UTC'
+    ):
         self.host = host
         self.db_name = db_name
         self.username = username
         self.password = password
+        self.connect_timeout = connect_timeout
+        self.reconnect_attempts = reconnect_attempts
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.liveness_check_seconds = liveness_check_seconds
+        self.keepalives = {
+            'keepalives_idle': keepalives_idle,
+            'keepalives_interval': keepalives_interval,
+            'keepalives_count': keepalives_count,
+            'tcp_user_timeout': tcp_user_timeout,
+        }
+        self.prepared_statements = prepared_statements
+        self.timezone = timezone
+        self.reconnects_count = 0
+        self._named_cursors_count = 0
         self._connect()
 
     def _connect(self):
-        self.connection = postgres.connect(
-            "host={} dbname={} user={} password={}".format(
-                self.host, self.db_name, self.username, self.password
-            )
+        dsn = "host={} dbname={} user={} password={}".format(
+            self.host, self.db_name, self.username, self.password
         )
+        if self.connect_timeout:
+            dsn += ' connect_timeout={}'.format(self.connect_timeout)
+        for name, value in self.keepalives.items():
+            if value is not None:
+                dsn += ' {0}={1}'.format(_KEEPALIVE_OPTIONS[name], value)
+        if self.timezone:
+            dsn += " options='-c TimeZone={0}'".format(self.timezone)
+        self.connection = postgres.connect(dsn)
         self.cursor = self.connection.cursor()
+        self._transaction_open = False
+
+        # The prepared statements live as long as their session:
+        # (insert query, on conflict do nothing) -> statement name
+        self._prepared = dict()
+        self._mark_used()
+
+    def _mark_used(self):
+        self._last_used_time = time.monotonic()
+        if not self.connection.closed:
+            self._transaction_open = \
+                self.connection.get_transaction_status() != \
+                extensions.TRANSACTION_STATUS_IDLE
+
+    def _in_transaction(self):
+        # The status of a closed connection is unknown; use the last one
+        if self.connection.closed:
+            return self._transaction_open
+        return self.connection.get_transaction_status() != \
+            extensions.TRANSACTION_STATUS_IDLE
+
+    def reconnect(self):
+        """
+        Open a new connection, waiting a jittered and exponentially growing
+        delay between the attempts
+        Raises the error of the last attempt
+        """
+
+        if not self.connection.closed:
+            self.connection.close()
+
+        attempt = 0
+        while True:
+            try:
+                self._connect()
+            except postgres.OperationalError as e:
+                attempt += 1
+                if attempt >= max(self.reconnect_attempts, 1):
+                    raise
+                delay = random.uniform(0, min(
+                    self.backoff_max_seconds,
+                    self.backoff_base_seconds * 2 ** (attempt - 1)
+                ))
+                log.warning('reconnect attempt {0} failed, next one in {1} '
+                            'seconds: {2}'.format(attempt, round(delay, 2), e))
+                time.sleep(delay)
+                continue
+
+            self.reconnects_count += 1
+            log.info('reconnected to the database')
+            return
+
+    def check_connection(self):
+        """
+        Reconnect if the connection is closed, or if it was idle for
+        `liveness_check_seconds` and does not answer `SELECT 1`
+        A connection inside a transaction is left as it is.
+        """
+
+        if self.connection.closed:
+            if not self._transaction_open and self.reconnect_attempts:
+                self.reconnect()
+            return
+
+        if self.liveness_check_seconds is None or self._in_transaction():
+            return
+        if time.monotonic() - self._last_used_time < \
+                self.liveness_check_seconds:
+            return
+
+        try:
+            self.cursor.execute('SELECT 1')
+            self.connection.rollback()
+            self._mark_used()
+        except (postgres.OperationalError, postgres.InterfaceError) as e:
+            if not self.reconnect_attempts:
+                raise
+            log.warning('the database connection is dead: {0}'.format(e))
+            self.reconnect()
 
     def close(self):
         self.cursor.close()
         self.connection.close()
 
-    def run_query(self, query):
-        self.cursor.execute(query)
+    @property
+    def closed(self):
+        return bool(self.connection.closed)
+
+    @_reconnecting
+    def run_query(self, query, params=None):
+        self.cursor.execute(query, params)
 
     def fetch_results(self):
         return self.cursor.fetchall()
 
+    @contextlib.contextmanager
+    def reading(self):
+        """
+        Run reads, then end the transaction they opened, so the connection
+        is not left idle in transaction holding the locks of the read tables
+        A transaction open before the block is left to its owner.
+        """
+
+        self.check_connection()
+        in_transaction = self._in_transaction()
+        try:
+            yield self
+        finally:
+            if not in_transaction:
+                self.rollback()
+
+    def iter_query(self, query, params=None, itersize=2000):
+        """
+        Run a query through a server-side (named) cursor
+        The rows are fetched `itersize` at a time while they are consumed,
+        instead of loading the whole result in memory.
+
+        Yields the rows as tuples
+        """
+
+        with self.reading():
+            self._named_cursors_count += 1
+            cursor = self.connection.cursor(
+                name='server_monitor_{0}'.format(self._named_cursors_count)
+            )
+            cursor.itersize = itersize
+            try:
+                cursor.execute(query, params)
+                for row in cursor:
+                    yield row
+            finally:
+                cursor.close()
+
+    @_reconnecting
     def insert(self, insert_query, values_list):
         self.cursor.execute(insert_query, values_list)
         self.connection.commit()
 
     def commit(self):
         self.connection.commit()
+        self._mark_used()
+
+    def rollback(self):
+        # A broken connection has no transaction left to roll back
+        self._transaction_open = False
+        if not self.connection.closed:
+            self.connection.rollback()
+
+    def prepare_insert(self, insert_query, on_conflict_do_nothing=False):
+        """
+        Prepare a single row insert query as a server-side statement; it is
+        parsed and planned once per connection instead of once per call
+
+        Returns the statement name
+        """
+
+        key = (insert_query, on_conflict_do_nothing)
+        name = self._prepared.get(key)
+        if name is not None:
+            return name
+
+        table_name, _, statement, _ = get_prepared_insert(insert_query)
+        if on_conflict_do_nothing:
+            statement += ' ON CONFLICT DO NOTHING'
+        name = 'insert_{0}_{1}'.format(table_name, len(self._prepared))
+        self.cursor.execute('PREPARE {0} AS {1}'.format(name, statement))
+        self._prepared[key] = name
+        return name
+
+    @_reconnecting
+    def insert_rows(
+            self, insert_query, rows, page_size=1000,
+            on_conflict_do_nothing=False, commit=True
+    ):
+        """
+        Insert many rows shaped for one of the insert queries
+        With prepared statements, up to `page_size` EXECUTE statements are
+        sent per round trip; otherwise multi-row INSERT statements are.
+
+        Inputs:
+            insert_query: The single row insert query
+            rows: List of values lists
+            page_size: Maximum rows per round trip
+            on_conflict_do_nothing: Skip the rows that already exist
+            commit: Commit the transaction after inserting
+        """
+
+        table_name, columns_list, template = parse_insert_query(insert_query)
+
+        if self.prepared_statements:
+            name = self.prepare_insert(
+                insert_query, on_conflict_do_nothing=on_conflict_do_nothing
+            )
+            extras.execute_batch(
+                self.cursor, 'EXECUTE {0} ({1})'.format(
+                    name, ', '.join(['%s'] * len(columns_list))
+                ), rows, page_size=page_size
+            )
+        else:
+            statement = 'INSERT INTO {0} ({1}) VALUES %s'.format(
+                table_name, ', '.join(columns_list)
+            )
+            if on_conflict_do_nothing:
+                statement += ' ON CONFLICT DO NOTHING'
+            extras.execute_values(
+                self.cursor, statement, rows, template=template,
+                page_size=page_size
+            )
+        if commit:
+            self.connection.commit()
+
+    def copy_rows(
+            self, table_name, columns_list, rows, chunk_size=64*1024,
+            commit=True
+    ):
+        """
+        Bulk load rows with `COPY ... FROM STDIN` in CSV format
+        The rows are encoded lazily while PostgreSQL reads the stream, so
+        `rows` can be a generator of any length.
+
+        Inputs:
+            table_name: The table to load into
+            columns_list: The column names, in the order of each row's values
+            rows: Iterable of rows; each row is a sequence of values
+            chunk_size: Approximate size of each chunk sent to the server
+            commit: Commit the transaction after loading
+
+        Returns dictionary with the following keys:
+            - rows_count
+            - duration_seconds
+            - rows_per_second
+        """
+
+        copy_query = 'COPY {0} ({1}) FROM STDIN ' \
+                     "WITH (FORMAT csv, NULL '\\N')".format(
+                         table_name, ', '.join(columns_list)
+                     )
+        rows_stream = _CsvRowsStream(rows=rows)
+
+        # Not retried on a drop, since `rows` may be consumed already
+        self.check_connection()
+        start_time = time.perf_counter()
+        self.cursor.copy_expert(copy_query, rows_stream, size=chunk_size)
+        if commit:
+            self.connection.commit()
+        self._mark_used()
+        duration = time.perf_counter() - start_time
+
+        # Initialize the output dictionary
+        output_dict = dict()
+        output_dict['rows_count'] = rows_stream.rows_count
+        output_dict['duration_seconds'] = round(duration, 3)
+        output_dict['rows_per_second'] = round(
+            rows_stream.rows_count / duration if duration > 0 else 0, 2
+        )
+
+        log.info('copied {0} rows into {1} in {2} seconds ({3} rows/s)'.format(
+            output_dict['rows_count'], table_name,
+            output_dict['duration_seconds'], output_dict['rows_per_second']
+        ))
+
+        return output_dict
+
+    def copy_insert_rows(
+            self, insert_query, rows, chunk_size=64*1024, commit=True
+    ):
+        """
+        Bulk load rows shaped for one of the insert queries with COPY
+        Returns the same dictionary as copy_rows()
+        """
+
+        table_name, columns_list, _ = parse_insert_query(insert_query)
+        return self.copy_rows(
+            table_name=table_name, columns_list=columns_list, rows=rows,
+            chunk_size=chunk_size, commit=commit
+        )
+
+    @_reconnecting
+    def load_batch(self, queries_rows):
+        """
+        Bulk load rows of several tables with COPY in one transaction
+        If some rows already exist, e.g. a batch that was written before its
+        sender could record it, the batch is inserted again skipping them.
+
+        Inputs:
+            queries_rows: Dictionary of insert query to list of rows
+        """
+
+        try:
+            for insert_query, rows in queries_rows.items():
+                self.copy_insert_rows(
+                    insert_query=insert_query, rows=rows, commit=False
+                )
+            self.connection.commit()
+        except postgres.IntegrityError:
+            self.connection.rollback()
+            log.warning('batch overlaps existing rows, skipping duplicates')
+            for insert_query, rows in queries_rows.items():
+                self.insert_rows(
+                    insert_query=insert_query, rows=rows,
+                    on_conflict_do_nothing=True, commit=False
+                )
+            self.connection.commit()
 
     def get_all_databases(self):
         all_dbs_query = 'SELECT datname FROM pg_database ' \
@@ -68,3 +457,243 @@ class PostgreSQLDB:
 
     def drop_table(self, table_name):
         self.cursor.execute('DROP TABLE {0}'.format(table_name))
+
+
+class _CsvRowsStream:
+    """
+    File-like object that encodes rows to CSV as COPY reads them
+    """
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+        self.rows_count = 0
+
+    @staticmethod
+    def _copy_value(value):
+        # NULL marker of the COPY command
+        if value is None:
+            return '\\N'
+        # PostgreSQL array literal
+        if isinstance(value, (list, tuple)):
+            return '{' + ','.join(
+                'NULL' if item is None else str(item) for item in value
+            ) + '}'
+        return value
+
+    def read(self, size=-1):
+
+        # Encode rows until the requested size is available
+        for row in self._rows:
+            self._writer.writerow([self._copy_value(value) for value in row])
+            self.rows_count += 1
+            if 0 < size <= self._buffer.tell():
+                break
+
+        # Hand over the encoded chunk and reuse the buffer
+        chunk = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return chunk
+
+
+@functools.lru_cache(maxsize=None)
+def get_permanent_errors():
+    """
+    Returns tuple of the exception types of rows that can never be written,
+    e.g. a malformed value or a NOT NULL violation, as opposed to a lost
+    connection
+    """
+
+    return (ValueError, TypeError, postgres.DataError, postgres.IntegrityError)
+
+
+def parse_insert_query(insert_query):
+    """
+    Split a single row insert query into its parts
+
+    Inputs:
+        insert_query: Query like `INSERT INTO table (col, ...) VALUES (%s, ...)`
+
+    Returns tuple of:
+        - table name
+        - list of the column names
+        - values template; the parenthesized part after VALUES
+    """
+
+    match = re.match(
+        r'\s*INSERT\s+INTO\s+(\w+)\s*\((.*?)\)\s*VALUES\s*(\(.*\))\s*;?\s*$',
+        insert_query, flags=re.IGNORECASE | re.DOTALL
+    )
+    if match is None:
+        raise ValueError('Unsupported insert query: {0}'.format(insert_query))
+
+    table_name, columns, template = match.groups()
+    columns_list = [column.strip() for column in columns.split(',')]
+    return table_name, columns_list, template
+
+
+@functools.lru_cache(maxsize=None)
+def get_prepared_insert(insert_query):
+    """
+    Rewrite a single row insert query with the positional parameters of a
+    prepared statement, e.g. `VALUES (timestamp %s, %s)` becomes
+    `VALUES ($1::timestamp, $2)`
+
+    Returns tuple of:
+        - table name
+        - list of the column names
+        - the INSERT statement
+        - list of the type of each value in the template, or None
+    """
+
+    table_name, columns_list, template = parse_insert_query(insert_query)
+
+    placeholders = []
+    types_list = []
+    for index, item in enumerate(template.strip('()').split(',')):
+        match = re.match(r'\s*(\w+)\s+%s\s*$', item)
+        if match is None:
+            placeholders.append('${0}'.format(index + 1))
+            types_list.append(None)
+            continue
+        placeholders.append('${0}::{1}'.format(index + 1, match.group(1)))
+        types_list.append(match.group(1).lower())
+
+    statement = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+        table_name, ', '.join(columns_list), ', '.join(placeholders)
+    )
+    return table_name, columns_list, statement, types_list
+
+
+class BufferedWriter:
+    """
+    Buffer rows per table and write them with multi-row inserts
+
+    All buffered tables are written inside one transaction with a single
+    commit. A flush is triggered by whichever limit is reached first.
+
+    Inputs:
+        db: The PostgreSQLDB instance to write through; None while the
+            database is unreachable
+        max_rows: Flush when this many rows are buffered
+        max_bytes: Flush when the buffered values reach this approximate size
+        max_age_seconds: Flush when the oldest buffered row is this old
+        page_size: Maximum rows per INSERT statement
+        fallback: Object with an `append(table_name, values_list)` method,
+            e.g. a Spool, that takes over the rows of a failed flush
+    """
+
+    def __init__(
+            self, db, max_rows=100, max_bytes=1024*1024, max_age_seconds=60,
+            page_size=1000, fallback=None
+    ):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.page_size = page_size
+        self.fallback = fallback
+
+        # Table name -> (insert query, list of rows)
+        self._buffers = dict()
+        self._rows_count = 0
+        self._bytes_count = 0
+        self._oldest_row_time = None
+
+    def __len__(self):
+        return self._rows_count
+
+    def add(self, insert_query, values_list):
+        """
+        Buffer one row, flushing all tables if a limit is reached
+        """
+
+        table_name = parse_insert_query(insert_query)[0]
+        if table_name not in self._buffers:
+            self._buffers[table_name] = (insert_query, [])
+        self._buffers[table_name][1].append(values_list)
+
+        self._rows_count += 1
+        self._bytes_count += sum(len(str(value)) for value in values_list)
+        if self._oldest_row_time is None:
+            self._oldest_row_time = time.monotonic()
+
+        if self.is_due():
+            self.flush()
+
+    def is_due(self):
+        if self._rows_count == 0:
+            return False
+        if self._rows_count >= self.max_rows:
+            return True
+        if self._bytes_count >= self.max_bytes:
+            return True
+        age = time.monotonic() - self._oldest_row_time
+        return age >= self.max_age_seconds
+
+    def drain(self):
+        """
+        Remove all buffered rows
+        Yields tuple of (table name, values list)
+        """
+
+        buffers = self._buffers
+        self._buffers = dict()
+        self._rows_count = 0
+        self._bytes_count = 0
+        self._oldest_row_time = None
+
+        for table_name, (_, rows) in buffers.items():
+            for values_list in rows:
+                yield table_name, values_list
+
+    def flush(self):
+        """
+        Write all buffered rows in one transaction
+        If the transaction fails, the rows move to the fallback when there is
+        one; otherwise they stay buffered and the error is raised.
+
+        Returns the number of written rows
+        """
+
+        if self._rows_count == 0:
+            return 0
+
+        start_time = time.perf_counter()
+        try:
+            if self.db is None:
+                raise ConnectionError('The database is not connected')
+            for insert_query, rows in self._buffers.values():
+                if rows:
+                    self.db.insert_rows(
+                        insert_query=insert_query, rows=rows,
+                        page_size=self.page_size, commit=False
+                    )
+            self.db.commit()
+        except Exception as e:
+            if self.db is not None:
+                self.db.rollback()
+            if self.fallback is None:
+                raise
+            log.error('could not flush {0} rows, moving them to {1}: {2}'.format(
+                self._rows_count, type(self.fallback).__name__, e
+            ))
+            for table_name, values_list in self.drain():
+                self.fallback.append(table_name, values_list)
+            return 0
+
+        rows_count = self._rows_count
+        duration = time.perf_counter() - start_time
+        log.info('flushed {0} buffered rows in {1} seconds ({2} rows/s)'.format(
+            rows_count, round(duration, 3),
+            round(rows_count / duration if duration > 0 else 0, 2)
+        ))
+
+        self._buffers.clear()
+        self._rows_count = 0
+        self._bytes_count = 0
+        self._oldest_row_time = None
+
+        return rows_count
@@ -0,0 +1,250 @@
+import os
+import logging
+import collections
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+# Same fields as the psutil tuples on Linux
+cpu_times = collections.namedtuple('cpu_times', [
+    'user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal',
+    'guest', 'guest_nice'
+])
+virtual_memory = collections.namedtuple('virtual_memory', [
+    'total', 'available', 'percent', 'used', 'free', 'buffers', 'cached'
+])
+swap_memory = collections.namedtuple('swap_memory', [
+    'total', 'used', 'free', 'percent'
+])
+cpu_freq = collections.namedtuple('cpu_freq', ['current', 'min', 'max'])
+disk_io_counters = collections.namedtuple('disk_io_counters', [
+    'read_count', 'write_count', 'read_bytes', 'write_bytes', 'read_time',
+    'write_time', 'read_merged_count', 'write_merged_count', 'busy_time'
+])
+
+# /proc/diskstats counts 512 bytes sectors whatever the device sector size
+_SECTOR_SIZE = 512
+
+
+class ProcFile:
+    """
+    A /proc or /sys file kept open and read with pread() into a reused buffer
+
+    Inputs:
+        path: The path of the file
+        buffer_size: The initial buffer size; grows when the file outgrows it
+    """
+
+    def __init__(self, path, buffer_size=16*1024):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+        self._buffer = bytearray(buffer_size)
+
+    def read(self):
+        """
+        Returns the current content of the file as bytes
+        """
+
+        while True:
+            size = os.preadv(self._fd, [self._buffer], 0)
+            if size < len(self._buffer):
+                return bytes(memoryview(self._buffer)[:size])
+            self._buffer = bytearray(len(self._buffer) * 2)
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _percent(part, total):
+    if total <= 0:
+        return 0.0
+    return round(part / total * 100, 1)
+
+
+class ProcfsBackend:
+    """
+    Linux backend reading /proc directly, with the psutil functions the
+    collectors need: cpu_times(), cpu_freq(), getloadavg(), virtual_memory(),
+    swap_memory() and disk_io_counters()
+
+    The files are opened once and re-read in place, which skips the per-call
+    open and namedtuple building of psutil at high sampling frequencies.
+    """
+
+    def __init__(self):
+        self._clock_ticks = os.sysconf('SC_CLK_TCK')
+        self._stat = ProcFile('/proc/stat')
+        self._meminfo = ProcFile('/proc/meminfo')
+        self._loadavg = ProcFile('/proc/loadavg')
+        self._diskstats = ProcFile('/proc/diskstats', buffer_size=64*1024)
+
+        # Device name -> whether it is a whole disk rather than a partition
+        self._whole_disks = dict()
+
+        # Current frequency of each CPU, from cpufreq when it is exposed or
+        # else from /proc/cpuinfo
+        self._cpuinfo = None
+        self._freq_files = []
+        self._min_freq = self._max_freq = 0.0
+        cpufreq_path = '/sys/devices/system/cpu/cpu{0}/cpufreq/{1}'
+        for cpu in range(os.cpu_count() or 0):
+            try:
+                self._freq_files.append(ProcFile(
+                    cpufreq_path.format(cpu, 'scaling_cur_freq'),
+                    buffer_size=64
+                ))
+            except OSError:
+                break
+        if self._freq_files:
+            self._min_freq = self._read_khz(
+                cpufreq_path.format(0, 'cpuinfo_min_freq')
+            )
+            self._max_freq = self._read_khz(
+                cpufreq_path.format(0, 'cpuinfo_max_freq')
+            )
+        else:
+            self._cpuinfo = ProcFile('/proc/cpuinfo', buffer_size=64*1024)
+
+    @staticmethod
+    def _read_khz(path):
+        # Returns MHz like psutil
+        try:
+            with open(path, 'rb') as freq_file:
+                return int(freq_file.read()) / 1000
+        except (OSError, ValueError):
+            return 0.0
+
+    def cpu_times(self, percpu=False):
+        """
+        Returns cpu_times of all CPUs, or list of cpu_times of each CPU
+        """
+
+        ticks = self._clock_ticks
+        times_list = []
+        for line in self._stat.read().split(b'\n'):
+            if not line.startswith(b'cpu'):
+                break
+            is_total = line[3:4] == b' '
+            if is_total == percpu:
+                continue
+            fields = line.split()[1:11]
+            fields += [0] * (10 - len(fields))
+            times_list.append(
+                cpu_times(*[int(field) / ticks for field in fields])
+            )
+        return times_list if percpu else times_list[0]
+
+    def cpu_freq(self, percpu=False):
+        """
+        Returns cpu_freq in MHz, or list of cpu_freq of each CPU
+        """
+
+        if self._freq_files:
+            currents_list = [
+                int(freq_file.read()) / 1000 for freq_file in self._freq_files
+            ]
+        else:
+            currents_list = [
+                float(line.split(b':')[1])
+                for line in self._cpuinfo.read().split(b'\n')
+                if line.startswith(b'cpu MHz')
+            ]
+
+        freqs_list = [
+            cpu_freq(current, self._min_freq, self._max_freq)
+            for current in currents_list
+        ]
+        if percpu:
+            return freqs_list
+        if not freqs_list:
+            return cpu_freq(0.0, self._min_freq, self._max_freq)
+        return cpu_freq(
+            sum(freq.current for freq in freqs_list) / len(freqs_list),
+            self._min_freq, self._max_freq
+        )
+
+    def getloadavg(self):
+        fields = self._loadavg.read().split()
+        return float(fields[0]), float(fields[1]), float(fields[2])
+
+    def _meminfo_values(self):
+        # Returns dictionary of field name to bytes
+        values_dict = dict()
+        for line in self._meminfo.read().split(b'\n'):
+            fields = line.split()
+            if len(fields) >= 2:
+                values_dict[fields[0][:-1]] = int(fields[1]) * 1024
+        return values_dict
+
+    def virtual_memory(self):
+        meminfo = self._meminfo_values()
+        total = meminfo[b'MemTotal']
+        free = meminfo[b'MemFree']
+        buffers = meminfo.get(b'Buffers', 0)
+        cached = meminfo.get(b'Cached', 0) + meminfo.get(b'SReclaimable', 0)
+        available = meminfo.get(b'MemAvailable', free + cached)
+
+        # Same accounting as psutil
+        used = total - free - cached - buffers
+        if used < 0:
+            used = total - free
+
+        return virtual_memory(
+            total, available, _percent(total - available, total), used, free,
+            buffers, cached
+        )
+
+    def swap_memory(self):
+        meminfo = self._meminfo_values()
+        total = meminfo.get(b'SwapTotal', 0)
+        free = meminfo.get(b'SwapFree', 0)
+        used = total - free
+        return swap_memory(total, used, free, _percent(used, total))
+
+    def disk_io_counters(self, perdisk=False):
+        """
+        Returns disk_io_counters of all disks, or dictionary of disk name to
+        its disk_io_counters
+        """
+
+        counters_dict = dict()
+        for line in self._diskstats.read().split(b'\n'):
+            fields = line.split()
+            if len(fields) < 14:
+                continue
+
+            # Totals count whole disks only, like psutil
+            name = fields[2].decode()
+            if not perdisk:
+                if name not in self._whole_disks:
+                    self._whole_disks[name] = os.path.exists(
+                        '/sys/block/{0}'.format(name.replace('/', '!'))
+                    )
+                if not self._whole_disks[name]:
+                    continue
+
+            counters_dict[name] = disk_io_counters(
+                read_count=int(fields[3]),
+                write_count=int(fields[7]),
+                read_bytes=int(fields[5]) * _SECTOR_SIZE,
+                write_bytes=int(fields[9]) * _SECTOR_SIZE,
+                read_time=int(fields[6]),
+                write_time=int(fields[10]),
+                read_merged_count=int(fields[4]),
+                write_merged_count=int(fields[8]),
+                busy_time=int(fields[12])
+            )
+        if perdisk:
+            return counters_dict
+        return disk_io_counters(*[sum(values) for values in zip(
+            *counters_dict.values()
+        )])
+
+    def close(self):
+        for proc_file in [
+            self._stat, self._meminfo, self._loadavg, self._diskstats,
+            self._cpuinfo
+        ] + self._freq_files:
+            if proc_file is not None:
+                proc_file.close()
@@ -0,0 +1,341 @@
+import re
+import time
+import logging
+import collections
+from datetime import timedelta
+from packages.rollup import rollup
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+_IDENTIFIER = re.compile(r'^\w+$')
+
+# Bucket start of a timestamptz column, aligned on the epoch
+_BUCKET_EXPRESSION = "to_timestamp(floor(extract(epoch FROM {0}) / " \
+                     "%(resolution)s) * %(resolution)s)"
+
+
+def _check_identifier(name):
+    # Table and column names are formatted into the queries
+    if not _IDENTIFIER.match(name):
+        raise ValueError('Invalid identifier: {0}'.format(name))
+    return name
+
+
+class SeriesReader:
+    """
+    Read metric series bucketed and aggregated by PostgreSQL
+
+    A series is read from the coarsest rollup level whose buckets divide the
+    requested resolution, and from the raw rows for the part newer than the
+    level's watermark. Recent results are kept in an LRU cache for
+    `ttl_seconds`; the samples are written by the collection processes, so
+    a cached result may miss up to `ttl_seconds` of new samples.
+
+    Inputs:
+        db: PostgreSQLDB instance
+        rollup_tables: Dictionary of raw table name to its rolled up metrics,
+            like `rollup.tables` in config.yaml; None reads raw rows only
+        max_entries: The number of results kept in the cache
+        ttl_seconds: Results older than this are read again
+        stream_threshold_points: Results expected to be larger are streamed
+            through a server-side cursor and not cached
+        itersize: Rows fetched per round trip when streaming
+    """
+
+    def __init__(
+            self, db, rollup_tables=None, max_entries=128, ttl_seconds=60,
+            stream_threshold_points=10000, itersize=2000
+    ):
+        self.db = db
+        self.rollup_tables = rollup_tables or dict()
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stream_threshold_points = stream_threshold_points
+        self.itersize = itersize
+
+        # (table, metric, host, start, end, resolution) -> (time, rows)
+        self._cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _choose_level(self, table_name, metric, resolution_seconds):
+        """
+        Returns the coarsest rollup level fitting the resolution, as tuple of
+        (rollup table name, watermark), or None for the raw rows
+        """
+
+        if metric not in self.rollup_tables.get(table_name, []):
+            return None
+
+        for suffix, _, bucket_seconds in reversed(rollup.levels):
+            if resolution_seconds % bucket_seconds == 0:
+                rollup_table = rollup.rollup_table_name(table_name, suffix)
+                return rollup_table, rollup.get_watermark(self.db, rollup_table)
+        return None
+
+    def _series_query(self, table_name, metric, host, start, end,
+                      resolution_seconds):
+        """
+        Build the bucketing query of a series
+        Returns tuple of (query, params)
+        """
+
+        if end <= start:
+            raise ValueError('The range ends before it starts')
+
+        params = {
+            'start': start,
+            'end': end,
+            'host': host,
+            'resolution': resolution_seconds,
+        }
+        host_condition = '' if host is None else ' AND host = %(host)s'
+
+        # The rollup level covers the range up to its watermark
+        parts = []
+        level = self._choose_level(table_name, metric, resolution_seconds)
+        split = start
+        if level is not None and level[1] is not None:
+            rollup_table, watermark = level
+            split = max(start, min(end, watermark))
+            parts.append(
+                'SELECT {bucket} AS bucket, '
+                'sum({metric}_avg * sample_count) '
+                'FILTER (WHERE {metric}_avg IS NOT NULL) AS total, '
+                'min({metric}_min) AS minimum, '
+                'max({metric}_max) AS maximum, '
+                'sum(sample_count) '
+                'FILTER (WHERE {metric}_avg IS NOT NULL) AS samples '
+                'FROM {table} '
+                'WHERE bucket >= %(start)s AND bucket < %(split)s{host} '
+                'GROUP BY 1'.format(
+                    bucket=_BUCKET_EXPRESSION.format('bucket'),
+                    metric=metric, table=rollup_table, host=host_condition
+                )
+            )
+        params['split'] = split
+
+        if split < end:
+            parts.append(
+                'SELECT {bucket} AS bucket, '
+                'sum({metric}) AS total, '
+                'min({metric}) AS minimum, '
+                'max({metric}) AS maximum, '
+                'count({metric}) AS samples '
+                'FROM {table} '
+                'WHERE created >= %(split)s AND created < %(end)s{host} '
+                'GROUP BY 1'.format(
+                    bucket=_BUCKET_EXPRESSION.format('created'),
+                    metric=metric, table=table_name, host=host_condition
+                )
+            )
+
+        # Merge the bucket split between the rollup level and the raw rows
+        query = (
+            'SELECT bucket, sum(total) / NULLIF(sum(samples), 0), '
+            'min(minimum), max(maximum), sum(samples) '
+            'FROM ({0}) AS parts '
+            'GROUP BY bucket ORDER BY bucket'
+        ).format(' UNION ALL '.join(parts))
+        return query, params
+
+    def iter_series(self, table_name, metric, start, end, resolution_seconds,
+                    host=None):
+        """
+        Stream a series through a server-side cursor, without caching it
+        Yields tuples of (bucket, avg, min, max, samples count)
+        """
+
+        # The watermark read and the cursor share one read transaction
+        with self.db.reading():
+            query, params = self._series_query(
+                table_name=_check_identifier(table_name),
+                metric=_check_identifier(metric), host=host, start=start,
+                end=end, resolution_seconds=resolution_seconds
+            )
+            for row in self.db.iter_query(
+                    query, params, itersize=self.itersize
+            ):
+                yield row
+
+    def _read_series(self, table_name, metric, start, end,
+                     resolution_seconds, host=None):
+        """
+        Read a short series with a plain fetch
+        Returns list of tuples of (bucket, avg, min, max, samples count)
+        """
+
+        with self.db.reading():
+            query, params = self._series_query(
+                table_name=_check_identifier(table_name),
+                metric=_check_identifier(metric), host=host, start=start,
+                end=end, resolution_seconds=resolution_seconds
+            )
+            self.db.run_query(query, params)
+            return self.db.fetch_results()
+
+    def get_series(self, table_name, metric, start, end, resolution_seconds,
+                   host=None):
+        """
+        Read a metric of a table between two timestamps, one point per
+        `resolution_seconds` bucket
+
+        Inputs:
+            table_name: The raw table, e.g. cpu_stats
+            metric: The metric column, e.g. usage_percentage
+            start: The first timestamp, included
+            end: The last timestamp, excluded
+            resolution_seconds: The bucket size
+            host: Read one host only; None aggregates all hosts
+
+        Returns list of tuples of (bucket, avg, min, max, samples count); a
+        series longer than `stream_threshold_points` is returned as an
+        iterator streaming them instead, and is not cached
+        """
+
+        # Long series are streamed and would crowd the cache out
+        expected_points = (end - start).total_seconds() / resolution_seconds
+        if expected_points > self.stream_threshold_points:
+            return self.iter_series(
+                table_name=table_name, metric=metric, start=start, end=end,
+                resolution_seconds=resolution_seconds, host=host
+            )
+
+        key = (table_name, metric, host, start, end, resolution_seconds)
+        entry = self._cache.get(key)
+        if entry is not None:
+            if time.monotonic() - entry[0] < self.ttl_seconds:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._cache[key]
+        self.misses += 1
+
+        rows = self._read_series(
+            table_name=table_name, metric=metric, start=start, end=end,
+            resolution_seconds=resolution_seconds, host=host
+        )
+        self._cache[key] = (time.monotonic(), rows)
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return rows
+
+
+def get_partition_usage(db, mountpoint, start, end, host=None):
+    """
+    Read the samples of one mountpoint between two timestamps
+    Served by the (mountpoint, created) index of partition_stats.
+
+    Inputs:
+        db: PostgreSQLDB instance
+        mountpoint: The partition mountpoint, e.g. /var
+        start: The first timestamp, included
+        end: The last timestamp, excluded
+        host: Read one host only; None reads all hosts
+
+    Returns list of tuples of (created, host, used_gb, free_gb, usage_percent)
+    """
+
+    query = 'SELECT created, host, used_gb, free_gb, usage_percent ' \
+            'FROM partition_stats ' \
+            'WHERE mountpoint = %(mountpoint)s ' \
+            'AND created >= %(start)s AND created < %(end)s'
+    params = {'mountpoint': mountpoint, 'start': start, 'end': end}
+    if host is not None:
+        query += ' AND host = %(host)s'
+        params['host'] = host
+    query += ' ORDER BY created, host'
+
+    db.run_query(query, params)
+    return db.fetch_results()
+
+
+def get_fullest_partitions(db, since, limit=10, mountpoint=None):
+    """
+    Read the fullest partitions by their latest sample
+    Each (host, mountpoint) is read from the end of the primary key index.
+
+    Inputs:
+        db: PostgreSQLDB instance
+        since: Ignore the partitions without a sample since this timestamp
+        limit: The number of partitions returned
+        mountpoint: Compare one mountpoint across the hosts; None compares
+            all of them
+
+    Returns list of tuples of
+    (host, mountpoint, created, used_gb, total_gb, usage_percent), the
+    fullest first
+    """
+
+    query = 'SELECT * FROM (' \
+            'SELECT DISTINCT ON (host, mountpoint) host, mountpoint, ' \
+            'created, used_gb, total_gb, usage_percent ' \
+            'FROM partition_stats ' \
+            'WHERE created >= %(since)s AND available'
+    params = {'since': since, 'limit': limit}
+    if mountpoint is not None:
+        query += ' AND mountpoint = %(mountpoint)s'
+        params['mountpoint'] = mountpoint
+    query += ' ORDER BY host, mountpoint, created DESC) latest ' \
+             'ORDER BY usage_percent DESC LIMIT %(limit)s'
+
+    db.run_query(query, params)
+    return db.fetch_results()
+
+
+def get_step_series(db, table_name, metric, host, start, end, keys=None,
+                    max_silence_seconds=None):
+    """
+    Rebuild the step function of a metric written with a deadband
+    Each row holds its value until the next row; the row written before
+    `start` gives the value at `start`.
+
+    Inputs:
+        db: PostgreSQLDB instance
+        table_name: The raw table, e.g. storage_stats
+        metric: The metric column, e.g. used_storage_gb
+        host: The host of the series
+        start: The first timestamp, included
+        end: The last timestamp, excluded
+        keys: Dictionary of the other key columns of the series to their
+            value, e.g. {'mountpoint': '/'} for partition_stats
+        max_silence_seconds: The deadband heartbeat; a value is not held
+            longer, leaving a gap where the host wrote nothing
+
+    Returns list of tuples of (step start, step end, value)
+    """
+
+    table_name = _check_identifier(table_name)
+    metric = _check_identifier(metric)
+
+    condition = 'host = %(host)s'
+    params = {'host': host, 'start': start, 'end': end}
+    for index, (column, value) in enumerate(sorted((keys or {}).items())):
+        condition += ' AND {0} = %(key_{1})s'.format(
+            _check_identifier(column), index
+        )
+        params['key_{0}'.format(index)] = value
+
+    query = '(SELECT created, {0} FROM {1} WHERE {2} ' \
+            'AND created < %(start)s ORDER BY created DESC LIMIT 1) ' \
+            'UNION ALL ' \
+            '(SELECT created, {0} FROM {1} WHERE {2} ' \
+            'AND created >= %(start)s AND created < %(end)s) ' \
+            'ORDER BY created'.format(metric, table_name, condition)
+
+    db.run_query(query, params)
+    rows = db.fetch_results()
+
+    steps = []
+    for index, (created, value) in enumerate(rows):
+        step_end = rows[index + 1][0] if index + 1 < len(rows) else end
+        if max_silence_seconds is not None:
+            step_end = min(
+                step_end, created + timedelta(seconds=max_silence_seconds)
+            )
+        step_start = max(created, start)
+        if step_end > step_start:
+            steps.append((step_start, step_end, value))
+    return steps
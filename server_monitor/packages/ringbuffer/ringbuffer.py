@@ -0,0 +1,162 @@
+import math
+import time
+import array
+import random
+import logging
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+
+def _select(values, rank):
+    """
+    Get the value of 0-based `rank` in sorted order, without sorting, by
+    quickselect: each pass keeps the side of a random pivot holding the
+    rank, which takes linear time on average
+    """
+
+    while True:
+        pivot = random.choice(values)
+        lower = [value for value in values if value < pivot]
+        if rank < len(lower):
+            values = lower
+            continue
+        higher = [value for value in values if value > pivot]
+        equal_count = len(values) - len(lower) - len(higher)
+        if rank < len(lower) + equal_count:
+            return pivot
+        rank -= len(lower) + equal_count
+        values = higher
+
+
+class RingBuffer:
+    """
+    Fixed capacity buffer of the recent samples of one collector
+
+    Each field is a preallocated array of doubles and the samples overwrite
+    the oldest ones, so the memory stays the same however long it runs.
+    Missing values are stored as NaN and skipped by the statistics.
+
+    Inputs:
+        fields: The names of the numeric fields to keep
+        capacity: The number of samples kept
+    """
+
+    __slots__ = ('fields', 'capacity', '_times', '_columns', '_next', '_count')
+
+    def __init__(self, fields, capacity=360):
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self._times = array.array('d', bytes(8 * capacity))
+        self._columns = {
+            field: array.array('d', bytes(8 * capacity))
+            for field in self.fields
+        }
+
+        # Index of the next write, and the number of stored samples
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, values, sample_time=None):
+        """
+        Store one sample
+
+        Inputs:
+            values: Dictionary holding the fields, e.g. a collector output
+            sample_time: The time.monotonic() of the sample; defaults to now
+        """
+
+        index = self._next
+        self._times[index] = time.monotonic() if sample_time is None \
+            else sample_time
+        for field, column in self._columns.items():
+            value = values.get(field)
+            column[index] = math.nan if value is None else value
+
+        self._next = (index + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def _window_indexes(self, seconds=None, now=None):
+        # Indexes of the samples of the window, newest first
+        if seconds is not None:
+            oldest_time = (time.monotonic() if now is None else now) - seconds
+        index = self._next
+        for _ in range(self._count):
+            index = (index - 1) % self.capacity
+            if seconds is not None and self._times[index] < oldest_time:
+                return
+            yield index
+
+    def values(self, field, seconds=None, now=None):
+        """
+        Get the values of a field over the last `seconds`, or of all stored
+        samples, skipping the missing ones
+
+        Returns array of doubles, oldest first
+        """
+
+        column = self._columns[field]
+        values = array.array('d', [
+            column[index] for index in self._window_indexes(seconds, now)
+            if not math.isnan(column[index])
+        ])
+        values.reverse()
+        return values
+
+    def latest(self, field):
+        # Returns the newest value of a field, or None when empty
+        if self._count == 0:
+            return None
+        value = self._columns[field][(self._next - 1) % self.capacity]
+        return None if math.isnan(value) else value
+
+    def min(self, field, seconds=None, now=None):
+        values = self.values(field, seconds, now)
+        return min(values) if values else None
+
+    def max(self, field, seconds=None, now=None):
+        values = self.values(field, seconds, now)
+        return max(values) if values else None
+
+    def mean(self, field, seconds=None, now=None):
+        values = self.values(field, seconds, now)
+        return math.fsum(values) / len(values) if values else None
+
+    def percentile(self, field, percent, seconds=None, now=None):
+        """
+        Get the nearest-rank percentile of a field over the window, in
+        linear time on average
+        Returns float, or None when the window is empty
+        """
+
+        values = self.values(field, seconds, now)
+        if not values:
+            return None
+        rank = math.ceil(percent / 100 * len(values))
+        return _select(values, max(rank, 1) - 1)
+
+    def summary(self, field, seconds=None, now=None):
+        """
+        Get the statistics of a field from one read of the window
+        Returns dictionary with the following keys:
+            - count
+            - min
+            - max
+            - mean
+        """
+
+        values = self.values(field, seconds, now)
+
+        # Initialize the output dictionary
+        output_dict = dict()
+        output_dict['count'] = len(values)
+        output_dict['min'] = min(values) if values else None
+        output_dict['max'] = max(values) if values else None
+        output_dict['mean'] = math.fsum(values) / len(values) if values \
+            else None
+        return output_dict
@@ -0,0 +1,260 @@
+import logging
+from datetime import timedelta, timezone
+from packages.schema import schema
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+# Rollup levels, finest first: table suffix, date_trunc unit, bucket seconds
+# Each level is computed from the previous one, and the first from raw rows.
+# The buckets are truncated in the session time zone, which is UTC.
+levels = (
+    ('1m', 'minute', 60),
+    ('1h', 'hour', 3600),
+    ('1d', 'day', 86400),
+)
+
+_WATERMARKS_TABLE = 'rollup_watermarks'
+
+
+def _truncate(moment, unit):
+    # Python side of date_trunc() in the UTC session; a moment with another
+    # offset, e.g. a legacy local timestamp, would not fall on the buckets
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc)
+    moment = moment.replace(second=0, microsecond=0)
+    if unit in ('hour', 'day'):
+        moment = moment.replace(minute=0)
+    if unit == 'day':
+        moment = moment.replace(hour=0)
+    return moment
+
+
+def rollup_table_name(table_name, suffix):
+    return '{0}_{1}'.format(table_name, suffix)
+
+
+def create_tables(db, tables, legacy_timezone='Africa/Cairo'):
+    """
+    Create the rollup tables of each level and the watermarks table
+
+    Inputs:
+        db: PostgreSQLDB instance
+        tables: Dictionary of raw table name to list of its metric columns
+        legacy_timezone: The time zone of the naive buckets and watermarks
+            of the tables created before the timestamptz schema
+    """
+
+    db.run_query(
+        'CREATE TABLE IF NOT EXISTS {0} ('
+        'rollup_table VARCHAR PRIMARY KEY, '
+        'watermark TIMESTAMPTZ NOT NULL)'.format(_WATERMARKS_TABLE)
+    )
+    schema.migrate_timestamptz(
+        db, _WATERMARKS_TABLE, 'watermark', legacy_timezone
+    )
+
+    for table_name, metrics in tables.items():
+        for suffix, _, _ in levels:
+            rollup_table = rollup_table_name(table_name, suffix)
+            db.run_query(
+                'CREATE TABLE IF NOT EXISTS {0} ('
+                'host VARCHAR NOT NULL, '
+                'bucket TIMESTAMPTZ NOT NULL, '
+                'sample_count INTEGER NOT NULL, '
+                'PRIMARY KEY (host, bucket))'.format(rollup_table)
+            )
+            schema.migrate_timestamptz(
+                db, rollup_table, 'bucket', legacy_timezone
+            )
+
+            # Metrics added to the configuration later get their columns too
+            db.run_query('ALTER TABLE {0} {1}'.format(rollup_table, ', '.join(
+                'ADD COLUMN IF NOT EXISTS {0}_{1} NUMERIC'.format(metric, stat)
+                for metric in metrics
+                for stat in ('min', 'max', 'avg', 'last')
+            )))
+
+    db.commit()
+
+
+def get_watermark(db, rollup_table):
+    db.run_query(
+        'SELECT watermark FROM {0} WHERE rollup_table = %s'.format(
+            _WATERMARKS_TABLE
+        ),
+        (rollup_table,)
+    )
+    rows = db.fetch_results()
+    return rows[0][0] if rows else None
+
+
+def _set_watermark(db, rollup_table, watermark):
+    db.run_query(
+        'INSERT INTO {0} (rollup_table, watermark) VALUES (%s, %s) '
+        'ON CONFLICT (rollup_table) DO UPDATE '
+        'SET watermark = EXCLUDED.watermark'.format(_WATERMARKS_TABLE),
+        (rollup_table, watermark)
+    )
+
+
+def _get_first_time(db, table_name, time_column):
+    db.run_query('SELECT min({0}) FROM {1}'.format(time_column, table_name))
+    return db.fetch_results()[0][0]
+
+
+def _aggregate_query(source_table, rollup_table, metrics, unit, from_raw):
+    """
+    Build the query rolling the source rows between two timestamps up into
+    the buckets of the rollup table; existing buckets are recomputed
+    """
+
+    stats_columns = []
+    stats_expressions = []
+    for metric in metrics:
+        stats_columns += [
+            '{0}_min'.format(metric), '{0}_max'.format(metric),
+            '{0}_avg'.format(metric), '{0}_last'.format(metric)
+        ]
+        if from_raw:
+            stats_expressions += [
+                'min({0})'.format(metric),
+                'max({0})'.format(metric),
+                'avg({0})'.format(metric),
+                '(array_agg({0} ORDER BY created DESC))[1]'.format(metric),
+            ]
+        else:
+            # The average of averages is weighted by the samples counts
+            stats_expressions += [
+                'min({0}_min)'.format(metric),
+                'max({0}_max)'.format(metric),
+                'sum({0}_avg * sample_count) / NULLIF(sum(sample_count) '
+                'FILTER (WHERE {0}_avg IS NOT NULL), 0)'.format(metric),
+                '(array_agg({0}_last ORDER BY bucket DESC))[1]'.format(metric),
+            ]
+
+    if from_raw:
+        host_expression = "COALESCE(host, '')"
+        time_column = 'created'
+        count_expression = 'count(*)'
+    else:
+        host_expression = 'host'
+        time_column = 'bucket'
+        count_expression = 'sum(sample_count)'
+
+    return (
+        'INSERT INTO {rollup_table} (host, bucket, sample_count, {columns}) '
+        "SELECT {host}, date_trunc('{unit}', {time}), {count}, {expressions} "
+        'FROM {source_table} '
+        'WHERE {time} >= %s AND {time} < %s '
+        'GROUP BY 1, 2 '
+        'ON CONFLICT (host, bucket) DO UPDATE SET '
+        'sample_count = EXCLUDED.sample_count, {updates}'
+    ).format(
+        rollup_table=rollup_table,
+        columns=', '.join(stats_columns),
+        host=host_expression,
+        unit=unit,
+        time=time_column,
+        count=count_expression,
+        expressions=', '.join(stats_expressions),
+        source_table=source_table,
+        updates=', '.join(
+            '{0} = EXCLUDED.{0}'.format(column) for column in stats_columns
+        )
+    )
+
+
+def run(db, tables, now, max_buckets=1440):
+    """
+    Roll the new rows of each raw table up into every level
+    Only the complete buckets between a level's watermark and the watermark
+    of its source are computed, so each run reads the new rows only.
+
+    Inputs:
+        db: PostgreSQLDB instance
+        tables: Dictionary of raw table name to list of its metric columns
+        now: The current UTC datetime
+        max_buckets: Maximum buckets computed per level and run, which
+            spreads the backfill of a large table over several runs
+
+    Returns dictionary of rollup table name to its new watermark
+    """
+
+    # Initialize the output dictionary
+    output_dict = dict()
+
+    for table_name, metrics in tables.items():
+
+        # Raw rows of the current minute may still be coming
+        source_table = table_name
+        source_time_column = 'created'
+        source_watermark = _truncate(now, 'minute')
+
+        for suffix, unit, bucket_seconds in levels:
+
+            rollup_table = rollup_table_name(table_name, suffix)
+
+            lower = get_watermark(db, rollup_table)
+            if lower is None:
+                first_time = _get_first_time(
+                    db, source_table, source_time_column
+                )
+                if first_time is None:
+                    break
+                lower = _truncate(first_time, unit)
+
+            upper = min(
+                _truncate(source_watermark, unit),
+                lower + timedelta(seconds=bucket_seconds * max_buckets)
+            )
+
+            if upper > lower:
+                db.run_query(
+                    _aggregate_query(
+                        source_table=source_table, rollup_table=rollup_table,
+                        metrics=metrics, unit=unit,
+                        from_raw=source_table == table_name
+                    ),
+                    (lower, upper)
+                )
+                _set_watermark(db, rollup_table, upper)
+                output_dict[rollup_table] = upper
+                lower = upper
+
+            # The next level only reads the complete buckets of this one
+            source_table = rollup_table
+            source_time_column = 'bucket'
+            source_watermark = lower
+
+        db.commit()
+
+    if output_dict:
+        log.info('rolled up to {0}'.format(', '.join(
+            '{0} {1}'.format(rollup_table, watermark)
+            for rollup_table, watermark in output_dict.items()
+        )))
+
+    return output_dict
+
+
+def rewind(db, tables, since):
+    """
+    Move the watermarks back to `since`, so the buckets of rows that arrived
+    late, e.g. replayed from the spool, are computed again on the next run
+
+    Inputs:
+        db: PostgreSQLDB instance
+        tables: The raw tables names
+        since: The aware datetime of the oldest late row, in any time zone
+    """
+
+    for table_name in tables:
+        for suffix, unit, _ in levels:
+            db.run_query(
+                'UPDATE {0} SET watermark = LEAST(watermark, %s) '
+                'WHERE rollup_table = %s'.format(_WATERMARKS_TABLE),
+                (_truncate(since, unit), rollup_table_name(table_name, suffix))
+            )
+    db.commit()
@@ -0,0 +1,185 @@
+import json
+import hashlib
+import logging
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+_METADATA_TABLE = 'schema_metadata'
+
+# Key of the advisory lock serializing the hosts applying a schema
+_LOCK_KEY = 7305162209
+
+
+def get_version(ddl_texts, settings=None):
+    """
+    Fingerprint a schema
+
+    Inputs:
+        ddl_texts: List of the DDL queries creating the schema
+        settings: Optional JSON serializable settings the DDL also depends
+            on, e.g. the rollup metrics
+
+    Returns the version string; it changes whenever the DDL does
+    """
+
+    digest = hashlib.sha256()
+    for ddl_text in ddl_texts:
+        digest.update(ddl_text.encode('utf8'))
+        digest.update(b'\0')
+    digest.update(json.dumps(settings, sort_keys=True).encode('utf8'))
+    return digest.hexdigest()[:16]
+
+
+def get_applied_version(db, name):
+    """
+    Returns the version recorded for the schema `name`, or None if it was
+    never applied
+    """
+
+    db.run_query('SELECT to_regclass(%s) IS NOT NULL', (_METADATA_TABLE,))
+    if not db.fetch_results()[0][0]:
+        return None
+
+    db.run_query(
+        'SELECT version FROM {0} WHERE name = %s'.format(_METADATA_TABLE),
+        (name,)
+    )
+    rows = db.fetch_results()
+    return rows[0][0] if rows else None
+
+
+def ensure(db, name, version, apply):
+    """
+    Apply a schema unless the metadata table records its current version
+    An up to date database costs two catalog reads instead of the DDL. The
+    hosts starting together apply the schema one at a time.
+
+    Inputs:
+        db: PostgreSQLDB instance
+        name: The schema name
+        version: The version of get_version()
+        apply: Callable receiving the db and running the DDL
+
+    Returns True if the schema was applied
+    """
+
+    applied_version = get_applied_version(db, name)
+    db.commit()
+    if applied_version == version:
+        log.info('schema {0} is at version {1}'.format(name, version))
+        return False
+
+    db.run_query('SELECT pg_advisory_lock(%s)', (_LOCK_KEY,))
+    try:
+        # Another host may have applied it while waiting for the lock
+        if get_applied_version(db, name) == version:
+            return False
+
+        log.info('applying schema {0} version {1} over {2}'.format(
+            name, version, applied_version
+        ))
+        apply(db)
+
+        db.run_query(
+            'CREATE TABLE IF NOT EXISTS {0} ('
+            'name VARCHAR PRIMARY KEY, '
+            'version VARCHAR NOT NULL, '
+            'applied TIMESTAMP NOT NULL DEFAULT now())'.format(_METADATA_TABLE)
+        )
+        db.run_query(
+            'INSERT INTO {0} (name, version) VALUES (%s, %s) '
+            'ON CONFLICT (name) DO UPDATE '
+            'SET version = EXCLUDED.version, applied = now()'.format(
+                _METADATA_TABLE
+            ),
+            (name, version)
+        )
+        db.commit()
+        return True
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.run_query('SELECT pg_advisory_unlock(%s)', (_LOCK_KEY,))
+        db.commit()
+
+
+def get_column_type(db, table_name, column):
+    """
+    Returns the data type of a column, e.g. `timestamp with time zone`, or
+    None if the table or the column does not exist
+    """
+
+    db.run_query(
+        'SELECT data_type FROM information_schema.columns '
+        'WHERE table_schema = current_schema() '
+        'AND table_name = %s AND column_name = %s',
+        (table_name, column)
+    )
+    rows = db.fetch_results()
+    return rows[0][0] if rows else None
+
+
+def migrate_timestamptz(db, table_name, column, source_timezone):
+    """
+    Convert a naive TIMESTAMP column, written before the timestamptz schema,
+    to TIMESTAMPTZ; its values are read in `source_timezone`
+    A table keyed on the column alone is keyed on (host, column) instead,
+    so two hosts or two samples of the same second no longer collide. The
+    partition key of a partitioned table cannot change its type; those
+    tables are left to migrate by hand.
+
+    Returns True if the table was migrated
+    """
+
+    if get_column_type(db, table_name, column) != 'timestamp without time zone':
+        return False
+
+    db.run_query(
+        'SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)',
+        (table_name,)
+    )
+    if db.fetch_results()[0][0] == 'p':
+        log.warning(
+            '{0}.{1} is a naive timestamp partition key; the partitioned '
+            'table has to be migrated by hand'.format(table_name, column)
+        )
+        return False
+
+    # The primary key constraint and its columns
+    db.run_query(
+        'SELECT constraint_info.conname, attribute.attname '
+        'FROM pg_constraint constraint_info '
+        'JOIN pg_attribute attribute '
+        'ON attribute.attrelid = constraint_info.conrelid '
+        'AND attribute.attnum = ANY(constraint_info.conkey) '
+        'WHERE constraint_info.conrelid = to_regclass(%s) '
+        "AND constraint_info.contype = 'p'",
+        (table_name,)
+    )
+    key_rows = db.fetch_results()
+    key_columns = [row[1] for row in key_rows]
+
+    log.info('migrating {0}.{1} to timestamptz from {2}'.format(
+        table_name, column, source_timezone
+    ))
+    db.run_query(
+        'ALTER TABLE {0} ALTER COLUMN {1} TYPE TIMESTAMPTZ '
+        'USING {1} AT TIME ZONE %s'.format(table_name, column),
+        (source_timezone,)
+    )
+
+    if key_columns == [column]:
+        db.run_query("UPDATE {0} SET host = '' WHERE host IS NULL".format(
+            table_name
+        ))
+        db.run_query(
+            'ALTER TABLE {0} DROP CONSTRAINT {1}, '
+            'ALTER COLUMN host SET NOT NULL, '
+            'ADD PRIMARY KEY (host, {2})'.format(
+                table_name, key_rows[0][0], column
+            )
+        )
+    return True
@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import zlib
+import struct
+import logging
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+# Record header: payload length and CRC32 of the payload
+_HEADER = struct.Struct('>II')
+
+_SEGMENT_SUFFIX = '.spool'
+_OFFSET_SUFFIX = '.offset'
+_CORRUPT_SUFFIX = '.corrupt'
+_DEAD_LETTER_NAME = 'dead_letter.jsonl'
+
+
+class CorruptRecordError(Exception):
+    """
+    A segment record is truncated or fails its CRC; the records after it
+    cannot be found
+    """
+
+    def __init__(self, path, offset):
+        super().__init__('corrupted record at offset {0} of {1}'.format(
+            offset, path
+        ))
+        self.path = path
+        self.offset = offset
+
+
+class Spool:
+    """
+    Local append-only spool of rows that could not reach the database
+
+    Rows are appended to segment files as length-prefixed records; a record
+    is an 8 bytes header (payload length, CRC32) followed by the compact JSON
+    of `[table_name, values_list]`. When the spool grows beyond `max_bytes`,
+    the oldest segments are evicted first.
+
+    A segment with a corrupted record is renamed with a `.corrupt` suffix
+    once its valid records are replayed, and the rows the database rejects
+    for good are appended to `dead_letter.jsonl`, so the rest of the spool
+    keeps draining.
+
+    Inputs:
+        dir_path: The directory holding the segment files
+        max_bytes: The maximum size of all segments together
+        segment_bytes: Start a new segment when the current one reaches this
+        fsync_policy: When to fsync the current segment; `always` after each
+            append, `interval` at most every `fsync_interval_seconds`, or
+            `never` to leave it to the operating system
+        fsync_interval_seconds: The fsync period of the `interval` policy
+    """
+
+    fsync_policies = ('always', 'interval', 'never')
+
+    def __init__(
+            self, dir_path, max_bytes=256*1024*1024,
+            segment_bytes=8*1024*1024, fsync_policy='interval',
+            fsync_interval_seconds=1.0
+    ):
+        if fsync_policy not in self.fsync_policies:
+            raise ValueError('Unknown fsync policy: {0}'.format(fsync_policy))
+
+        self.dir_path = dir_path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync_policy = fsync_policy
+        self.fsync_interval_seconds = fsync_interval_seconds
+
+        # Create the spool folder if not exists
+        os.makedirs(self.dir_path, exist_ok=True)
+
+        self._fd = None
+        self._segment_size = 0
+        self._last_fsync_time = time.monotonic()
+        self._open_segment()
+
+    def _segment_path(self, sequence):
+        return os.path.join(
+            self.dir_path, '{0:012d}{1}'.format(sequence, _SEGMENT_SUFFIX)
+        )
+
+    def _segments(self):
+        """
+        Returns list of the segments sequence numbers, oldest first
+        """
+
+        sequences = []
+        for file_name in os.listdir(self.dir_path):
+            if file_name.endswith(_SEGMENT_SUFFIX):
+                sequences.append(int(file_name[:-len(_SEGMENT_SUFFIX)]))
+        return sorted(sequences)
+
+    def _open_segment(self):
+        # Continue the newest segment, or start the first one
+        segments = self._segments()
+        self._sequence = segments[-1] if segments else 1
+        self._fd = os.open(
+            self._segment_path(self._sequence),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600
+        )
+        self._segment_size = os.fstat(self._fd).st_size
+
+    def _rotate(self):
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._sequence += 1
+        self._fd = os.open(
+            self._segment_path(self._sequence),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600
+        )
+        self._segment_size = 0
+        self._evict()
+
+    def _evict(self):
+        # Drop the oldest closed segments while the spool is over its cap
+        segments = self._segments()[:-1]
+        while segments and self.size() > self.max_bytes:
+            sequence = segments.pop(0)
+            path = self._segment_path(sequence)
+            evicted_bytes = os.path.getsize(path)
+            self._remove_segment(sequence)
+            log.warning('spool is full, evicted {0} bytes of {1}'.format(
+                evicted_bytes, path
+            ))
+
+    def _remove_segment(self, sequence):
+        path = self._segment_path(sequence)
+        os.remove(path)
+        if os.path.exists(path + _OFFSET_SUFFIX):
+            os.remove(path + _OFFSET_SUFFIX)
+
+    def _quarantine_segment(self, sequence):
+        # Keep the segment for inspection, out of the replayed segments
+        path = self._segment_path(sequence)
+        os.replace(path, path + _CORRUPT_SUFFIX)
+        if os.path.exists(path + _OFFSET_SUFFIX):
+            os.remove(path + _OFFSET_SUFFIX)
+        log.error('quarantined {0} as {1}'.format(
+            path, path + _CORRUPT_SUFFIX
+        ))
+
+    def _dead_letter(self, table_name, values_list, error):
+        # One JSON line per row that can never be written
+        line = json.dumps({
+            'table': table_name, 'values': values_list, 'error': str(error)
+        }, separators=(',', ':'))
+        dead_letter_path = os.path.join(self.dir_path, _DEAD_LETTER_NAME)
+        with open(dead_letter_path, 'a') as dead_letter_file:
+            dead_letter_file.write(line + '\n')
+
+    def size(self):
+        """
+        Returns the size of all segments in bytes
+        """
+
+        return sum(
+            os.path.getsize(self._segment_path(sequence))
+            for sequence in self._segments()
+        )
+
+    def is_empty(self):
+        return self.size() == 0
+
+    def append(self, table_name, values_list):
+        """
+        Append one row to the current segment
+        """
+
+        payload = json.dumps(
+            [table_name, values_list], separators=(',', ':')
+        ).encode('utf8')
+        record = _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        if self._segment_size and \
+                self._segment_size + len(record) > self.segment_bytes:
+            self._rotate()
+
+        os.write(self._fd, record)
+        self._segment_size += len(record)
+
+        # Make the record durable according to the fsync policy
+        if self.fsync_policy == 'always':
+            os.fsync(self._fd)
+        elif self.fsync_policy == 'interval':
+            now = time.monotonic()
+            if now - self._last_fsync_time >= self.fsync_interval_seconds:
+                os.fsync(self._fd)
+                self._last_fsync_time = now
+
+    def _read_records(self, path, offset):
+        """
+        Read records of a segment starting from `offset`
+        Yields tuple of (offset after the record, table name, values list)
+        Raises CorruptRecordError on a truncated or corrupted record
+        """
+
+        with open(path, 'rb') as segment_file:
+            segment_file.seek(offset)
+            while True:
+                record_start = segment_file.tell()
+                header = segment_file.read(_HEADER.size)
+                if not header:
+                    return
+                if len(header) < _HEADER.size:
+                    raise CorruptRecordError(path, record_start)
+
+                length, checksum = _HEADER.unpack(header)
+                payload = segment_file.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    raise CorruptRecordError(path, record_start)
+
+                table_name, values_list = json.loads(payload)
+                yield segment_file.tell(), table_name, values_list
+
+    def _read_offset(self, path):
+        try:
+            with open(path + _OFFSET_SUFFIX) as offset_file:
+                return int(offset_file.read())
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, path, offset):
+        # Replace the checkpoint atomically
+        with open(path + _OFFSET_SUFFIX + '.tmp', 'w') as offset_file:
+            offset_file.write(str(offset))
+        os.replace(path + _OFFSET_SUFFIX + '.tmp', path + _OFFSET_SUFFIX)
+
+    def _handle_batch(self, handler, batch, permanent_errors):
+        """
+        Pass a batch to `handler`; if it fails for good, pass its rows one
+        by one and move the rows failing again to the dead letter file
+        Returns the number of dead lettered rows
+        """
+
+        try:
+            handler(batch)
+            return 0
+        except permanent_errors as e:
+            log.warning('replayed batch rejected, retrying its rows one by '
+                        'one: {0}'.format(e))
+
+        dead_count = 0
+        for table_name, rows in batch.items():
+            for values_list in rows:
+                try:
+                    handler({table_name: [values_list]})
+                except permanent_errors as e:
+                    self._dead_letter(table_name, values_list, e)
+                    dead_count += 1
+
+        log.error('moved {0} rejected rows to {1}'.format(
+            dead_count, os.path.join(self.dir_path, _DEAD_LETTER_NAME)
+        ))
+        return dead_count
+
+    def replay(self, handler, batch_rows=10000, max_batches=None,
+               permanent_errors=()):
+        """
+        Drain the spool into `handler` in large batches, oldest first
+
+        Inputs:
+            handler: Callable receiving a dictionary of table name to list of
+                rows; it must raise if the batch was not written
+            batch_rows: The maximum number of rows per batch
+            max_batches: Stop after this many batches; None drains everything
+            permanent_errors: Tuple of the exception types of rows that can
+                never be written; these rows go to the dead letter file, any
+                other error stops the replay
+
+        Returns the number of replayed rows
+        """
+
+        # Close the current segment so the new rows go to a fresh one
+        if self._segment_size:
+            self._rotate()
+
+        replayed_rows = 0
+        batches_count = 0
+
+        for sequence in self._segments()[:-1]:
+
+            if max_batches is not None and batches_count >= max_batches:
+                break
+
+            path = self._segment_path(sequence)
+            batch = dict()
+            batch_size = 0
+            segment_done = True
+            corrupted = None
+
+            records = self._read_records(path, self._read_offset(path))
+            try:
+                for record_end, table_name, values_list in records:
+
+                    batch.setdefault(table_name, []).append(values_list)
+                    batch_size += 1
+                    if batch_size < batch_rows:
+                        continue
+
+                    # Write the full batch and checkpoint the segment offset
+                    dead_rows = self._handle_batch(
+                        handler, batch, permanent_errors
+                    )
+                    self._write_offset(path, record_end)
+                    replayed_rows += batch_size - dead_rows
+                    batches_count += 1
+                    batch = dict()
+                    batch_size = 0
+
+                    if max_batches is not None and \
+                            batches_count >= max_batches:
+                        segment_done = False
+                        break
+            except CorruptRecordError as e:
+                # The records before the corrupted one are still written
+                log.error('stopped reading {0}: {1}'.format(path, e))
+                corrupted = e
+
+            if batch_size:
+                dead_rows = self._handle_batch(
+                    handler, batch, permanent_errors
+                )
+                replayed_rows += batch_size - dead_rows
+                batches_count += 1
+
+            # The segment cannot be read further, keep it aside
+            if corrupted is not None:
+                self._quarantine_segment(sequence)
+
+            # The whole segment reached the database
+            elif segment_done:
+                self._remove_segment(sequence)
+
+        if replayed_rows:
+            log.info('replayed {0} spooled rows'.format(replayed_rows))
+
+        return replayed_rows
+
+    def close(self):
+        os.fsync(self._fd)
+        os.close(self._fd)
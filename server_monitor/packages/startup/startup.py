@@ -0,0 +1,87 @@
+import time
+import logging
+import importlib
+import contextlib
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+# List of (kind, name, seconds) of the measured startup steps, in order
+_records = []
+
+# The startup is timed from the first import of this module
+_start_time = time.perf_counter()
+
+
+def record(kind, name, seconds):
+    _records.append((kind, name, seconds))
+
+
+@contextlib.contextmanager
+def measure(kind, name):
+    """
+    Record the run time of the block as one startup step
+
+    Inputs:
+        kind: `import` or `init`
+        name: The module or the object being initialized
+    """
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(kind, name, time.perf_counter() - start_time)
+
+
+class _LazyModule:
+    """
+    Module imported on the first access to one of its attributes
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            with measure('import', self._name):
+                self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __repr__(self):
+        return '<lazy module {0}>'.format(self._name)
+
+
+def lazy_import(name):
+    """
+    Returns a stand-in for the module `name`, imported only when one of its
+    attributes is first used; the import time is recorded as a startup step
+    """
+
+    return _LazyModule(name)
+
+
+def get_report():
+    """
+    Returns list of the report lines: each startup step with its duration,
+    the imports first, then the time elapsed since the startup began
+    An import triggered inside an init step is counted in both.
+    """
+
+    lines = []
+    for kind in ('import', 'init'):
+        for record_kind, name, seconds in _records:
+            if record_kind != kind:
+                continue
+            lines.append('{0:<7}{1:<40}{2:>9.1f} ms'.format(
+                kind, name, seconds * 1000
+            ))
+    lines.append('{0:<47}{1:>9.1f} ms'.format(
+        'total', (time.perf_counter() - _start_time) * 1000
+    ))
+    return lines
@@ -1,13 +1,42 @@
+import os
+import math
+import time
+import array
+import atexit
+import select
+import fnmatch
 import logging
 import psutil
 import platform
-import GPUtil
+import threading
+import subprocess
+from concurrent.futures import TimeoutError
+from packages.procfs import procfs
+from packages.collector import collector
 
 
 # Import logger
 log = logging.getLogger(__name__)
 
 
+def get_backend(name='psutil'):
+    """
+    Get the backend the collectors read the system counters from
+
+    Inputs:
+        name: `psutil`, or `procfs` for the native Linux /proc reader
+
+    Returns the psutil module or a procfs.ProcfsBackend; both offer the
+    same functions to the collectors
+    """
+
+    if name == 'psutil':
+        return psutil
+    if name == 'procfs':
+        return procfs.ProcfsBackend()
+    raise ValueError('Unknown system backend: {0}'.format(name))
+
+
 def get_system_profile():
     """
     Get system profile
@@ -55,18 +84,214 @@ def get_system_profile():
     return output_dict
 
 
-def get_cpu_stats():
+class CpuSampler:
+    """
+    Non-blocking CPU utilization sampler
+
+    Keeps the previous `psutil.cpu_times` snapshot and computes the
+    utilization from the deltas between two calls, so a sample returns
+    instantly instead of sleeping like `psutil.cpu_percent(interval=1)`.
+
+    Inputs:
+        min_window_seconds: The shortest window a sample may cover. Only
+            reached by sleeping when the sampler is read right after it
+            was created; later samples cover the time since the last call.
+        backend: The backend to read the CPU counters from; see get_backend()
+        busy_core_threshold_percent: The usage above which a core counts as
+            busy in `busy_cores_count`
+    """
+
+    # Modes reported on their own; absent modes on non-Linux hosts are 0
+    modes = ('user', 'system', 'iowait', 'steal')
+
+    def __init__(
+            self, min_window_seconds=0.1, backend=psutil,
+            busy_core_threshold_percent=90
+    ):
+        self.min_window_seconds = min_window_seconds
+        self.backend = backend
+        self.busy_core_threshold_percent = busy_core_threshold_percent
+        self._last_times = backend.cpu_times(percpu=True)
+        self._last_sample_time = time.monotonic()
+
+    @staticmethod
+    def _total_time(times):
+        # Guest time is already accounted in user time on Linux
+        total = sum(times)
+        total -= getattr(times, 'guest', 0)
+        total -= getattr(times, 'guest_nice', 0)
+        return total
+
+    @staticmethod
+    def _busy_time(times):
+        busy = CpuSampler._total_time(times)
+        busy -= times.idle
+        busy -= getattr(times, 'iowait', 0)
+        return busy
+
+    @staticmethod
+    def _percent(part, total):
+        if total <= 0:
+            return 0.0
+        return round(min(max(part / total * 100, 0.0), 100.0), 2)
+
+    def sample(self):
+        """
+        Get the CPU utilization since the previous sample
+        Returns dictionary with the following keys:
+            - cpu_usage_percent
+            - cpu_user_percent
+            - cpu_system_percent
+            - cpu_iowait_percent
+            - cpu_steal_percent
+            - per_core_usage_percent: array('d') of the usage of each core
+            - max_core_usage_percent
+            - core_usage_stddev
+            - busy_cores_count: The cores above busy_core_threshold_percent
+            - sample_window_seconds
+        """
+
+        # Make sure the very first sample does not cover a zero window
+        elapsed = time.monotonic() - self._last_sample_time
+        if elapsed < self.min_window_seconds:
+            time.sleep(self.min_window_seconds - elapsed)
+
+        current_times = self.backend.cpu_times(percpu=True)
+        current_sample_time = time.monotonic()
+
+        # Initialize the overall deltas
+        overall_total = 0.0
+        overall_busy = 0.0
+        overall_modes = dict.fromkeys(self.modes, 0.0)
+
+        # Initialize the per core usage array
+        per_core_usage = array.array('d')
+
+        # Loop over the cores' current and previous times
+        for last, current in zip(self._last_times, current_times):
+
+            total_delta = self._total_time(current) - self._total_time(last)
+            busy_delta = self._busy_time(current) - self._busy_time(last)
+            per_core_usage.append(self._percent(busy_delta, total_delta))
+
+            overall_total += total_delta
+            overall_busy += busy_delta
+            for mode in self.modes:
+                overall_modes[mode] += (
+                    getattr(current, mode, 0) - getattr(last, mode, 0)
+                )
+
+        # Initialize the output dictionary
+        output_dict = dict()
+
+        # Add current CPU usage percentage
+        output_dict['cpu_usage_percent'] = self._percent(
+            overall_busy, overall_total
+        )
+
+        # Add the usage percentage of each CPU mode
+        for mode in self.modes:
+            output_dict['cpu_{0}_percent'.format(mode)] = self._percent(
+                overall_modes[mode], overall_total
+            )
+
+        # Add the usage percentage of each core and its spread
+        output_dict['per_core_usage_percent'] = per_core_usage
+        output_dict.update(
+            _spread_stats(per_core_usage, self.busy_core_threshold_percent)
+        )
+
+        # Add the length of the window the sample covers
+        output_dict['sample_window_seconds'] = round(
+            current_sample_time - self._last_sample_time, 3
+        )
+
+        # Keep the current snapshot for the next sample
+        self._last_times = current_times
+        self._last_sample_time = current_sample_time
+
+        return output_dict
+
+
+def _spread_stats(per_core_usage, busy_threshold):
+    """
+    Get the spread of the per core usage; a pegged core stays visible even
+    when the average of many cores is low
+    Returns dictionary with the following keys:
+        - max_core_usage_percent
+        - core_usage_stddev
+        - busy_cores_count
+    """
+
+    # Initialize the output dictionary
+    output_dict = dict()
+
+    cores_count = len(per_core_usage)
+    if cores_count == 0:
+        output_dict['max_core_usage_percent'] = 0.0
+        output_dict['core_usage_stddev'] = 0.0
+        output_dict['busy_cores_count'] = 0
+        return output_dict
+
+    # Each reduction runs over the whole array in C
+    mean = math.fsum(per_core_usage) / cores_count
+    squares_mean = math.fsum(map(
+        float.__mul__, per_core_usage, per_core_usage
+    )) / cores_count
+
+    output_dict['max_core_usage_percent'] = max(per_core_usage)
+    output_dict['core_usage_stddev'] = round(
+        math.sqrt(max(squares_mean - mean * mean, 0.0)), 2
+    )
+    output_dict['busy_cores_count'] = sum(map(
+        float(busy_threshold).__lt__, per_core_usage
+    ))
+
+    return output_dict
+
+
+# Shared sampler of get_cpu_stats() calls that do not pass their own
+_default_cpu_sampler = None
+
+
+def get_cpu_stats(sampler=None):
     """
     Get CPU statistics
+
+    Inputs:
+        sampler: The CpuSampler to read the usage from; defaults to a
+            module-wide psutil sampler created on the first call. The
+            frequencies and load averages come from the sampler's backend.
+
     Returns dictionary with the following keys:
         - max_cpu_freq_ghz
         - min_cpu_freq_ghz
         - current_cpu_freq_ghz
+        - per_core_freq_ghz: array('d') of the current frequency of each core
+        - load_average_1m
+        - load_average_5m
+        - load_average_15m
         - cpu_usage_percent
+        - cpu_user_percent
+        - cpu_system_percent
+        - cpu_iowait_percent
+        - cpu_steal_percent
+        - per_core_usage_percent
+        - max_core_usage_percent
+        - core_usage_stddev
+        - busy_cores_count
+        - sample_window_seconds
     """
 
+    global _default_cpu_sampler
+
+    if sampler is None:
+        if _default_cpu_sampler is None:
+            _default_cpu_sampler = CpuSampler()
+        sampler = _default_cpu_sampler
+
     # CPU frequencies
-    cpufreq = psutil.cpu_freq()
+    cpufreq = sampler.backend.cpu_freq()
 
     # Initialize the output dictionary
     output_dict = dict()
@@ -80,11 +305,20 @@ def get_cpu_stats():
     # Add current CPU frequency
     output_dict['current_cpu_freq_ghz'] = round(cpufreq.current/1000, 1)
 
-    # Add current CPU usage percentage
-    output_dict['cpu_usage_percent'] = round(
-        psutil.cpu_percent(interval=1, percpu=False),
-        2  # Two digits after the decimal points
-    )
+    # Add current frequency of each core
+    output_dict['per_core_freq_ghz'] = array.array('d', [
+        round(core_freq.current/1000, 2)
+        for core_freq in sampler.backend.cpu_freq(percpu=True)
+    ])
+
+    # Add the load averages over the last 1, 5 and 15 minutes
+    load_averages = sampler.backend.getloadavg()
+    output_dict['load_average_1m'] = round(load_averages[0], 2)
+    output_dict['load_average_5m'] = round(load_averages[1], 2)
+    output_dict['load_average_15m'] = round(load_averages[2], 2)
+
+    # Add current CPU usage percentages since the previous sample
+    output_dict.update(sampler.sample())
 
     return output_dict
 
@@ -125,9 +359,14 @@ def _convert_memory_size(input_memory, input_unit, output_unit):
     return round(output_memory, 2)
 
 
-def get_ram_stats():
+def get_ram_stats(backend=psutil):
     """
     Get RAM statistics
+
+    Inputs:
+        backend: The backend to read the memory counters from; see
+            get_backend()
+
     Returns dictionary with the following keys:
         - total_ram_gb
         - free_ram_gb
@@ -140,7 +379,7 @@ def get_ram_stats():
     """
 
     # Get virtual memory information
-    virtual_memory = psutil.virtual_memory()
+    virtual_memory = backend.virtual_memory()
 
     # Initialize the output dictionary
     output_dict = dict()
@@ -182,7 +421,7 @@ def get_ram_stats():
     )
 
     # Get swap memory information if exist
-    swap_memory = psutil.swap_memory()
+    swap_memory = backend.swap_memory()
 
     # Add total swap memory
     output_dict['total_swap_gb'] = round(
@@ -223,15 +462,163 @@ def get_ram_stats():
     return output_dict
 
 
-def get_disk_stats():
+class PartitionCache:
+    """
+    Cached and filtered partition discovery with hang-proof usage reads
+
+    The partitions are discovered again only when the mount table changes,
+    which `/proc/self/mountinfo` signals through poll() on Linux; elsewhere
+    they are discovered again every `refresh_seconds`. The usage of each
+    partition is read on a worker thread with a timeout, so a dead network
+    mount is reported as unavailable instead of blocking the cycle.
+
+    Inputs:
+        all_partitions: Include virtual file systems, e.g. nfs or overlay
+        include_fstypes: Keep only these file system types, if not empty
+        exclude_fstypes: Skip these file system types
+        include_mountpoints: Keep only mountpoints matching these patterns,
+            if not empty
+        exclude_mountpoints: Skip mountpoints matching these patterns
+        usage_timeout_seconds: The timeout of each partition usage read
+        refresh_seconds: The discovery period without mountinfo polling
+        max_workers: The number of threads reading partition usages
+    """
+
+    mountinfo_path = '/proc/self/mountinfo'
+
+    def __init__(
+            self, all_partitions=False, include_fstypes=None,
+            exclude_fstypes=None, include_mountpoints=None,
+            exclude_mountpoints=None, usage_timeout_seconds=2.0,
+            refresh_seconds=300, max_workers=4
+    ):
+        self.all_partitions = all_partitions
+        self.include_fstypes = set(include_fstypes or [])
+        self.exclude_fstypes = set(exclude_fstypes or [])
+        self.include_mountpoints = list(include_mountpoints or [])
+        self.exclude_mountpoints = list(exclude_mountpoints or [])
+        self.usage_timeout_seconds = usage_timeout_seconds
+        self.refresh_seconds = refresh_seconds
+
+        self._pool = collector.DaemonThreadPool(
+            max_workers=max_workers, name='disk_usage'
+        )
+
+        # Mountpoint -> future of a usage read that outlived its timeout
+        self._pending_usages = dict()
+
+        self._partitions = None
+        self._discovery_time = 0
+
+        # Watch the mount table for changes when the platform supports it
+        self._mountinfo = None
+        self._poller = None
+        if hasattr(select, 'poll') and os.path.exists(self.mountinfo_path):
+            self._mountinfo = open(self.mountinfo_path, 'rb')
+            self._poller = select.poll()
+            self._poller.register(
+                self._mountinfo, select.POLLPRI | select.POLLERR
+            )
+
+    def _mounts_changed(self):
+        if self._poller is not None:
+            # The event is reported once per change of the mount table
+            return bool(self._poller.poll(0))
+        return time.monotonic() - self._discovery_time >= self.refresh_seconds
+
+    def _is_selected(self, partition):
+        if self.include_fstypes and \
+                partition.fstype not in self.include_fstypes:
+            return False
+        if partition.fstype in self.exclude_fstypes:
+            return False
+        if self.include_mountpoints and not any(
+                fnmatch.fnmatch(partition.mountpoint, pattern)
+                for pattern in self.include_mountpoints
+        ):
+            return False
+        return not any(
+            fnmatch.fnmatch(partition.mountpoint, pattern)
+            for pattern in self.exclude_mountpoints
+        )
+
+    def partitions(self):
+        """
+        Returns list of the selected psutil partitions
+        """
+
+        if self._partitions is None or self._mounts_changed():
+            self._partitions = [
+                partition
+                for partition in psutil.disk_partitions(all=self.all_partitions)
+                if self._is_selected(partition)
+            ]
+            self._discovery_time = time.monotonic()
+            log.info('discovered {0} partitions'.format(len(self._partitions)))
+        return self._partitions
+
+    def usages(self, partitions):
+        """
+        Read the usage of the partitions concurrently
+        Returns list of psutil disk usage, or None for unavailable partitions
+        """
+
+        # Start the reads; a mount still stuck from a previous read is skipped
+        futures = []
+        for partition in partitions:
+            pending_future = self._pending_usages.get(partition.mountpoint)
+            if pending_future is not None and not pending_future.done():
+                futures.append(None)
+                continue
+            self._pending_usages.pop(partition.mountpoint, None)
+            futures.append(
+                self._pool.submit(psutil.disk_usage, partition.mountpoint)
+            )
+
+        deadline = time.monotonic() + self.usage_timeout_seconds
+
+        usages_list = []
+        for partition, future in zip(partitions, futures):
+            usage = None
+            if future is not None:
+                try:
+                    usage = future.result(
+                        timeout=max(0.0, deadline - time.monotonic())
+                    )
+                except TimeoutError:
+                    self._pending_usages[partition.mountpoint] = future
+                except OSError as e:
+                    log.warning('could not read {0} usage: {1}'.format(
+                        partition.mountpoint, e
+                    ))
+            if usage is None:
+                log.warning('partition {0} is unavailable'.format(
+                    partition.mountpoint
+                ))
+            usages_list.append(usage)
+        return usages_list
+
+
+# Shared cache of get_disk_stats() calls that do not pass their own
+_default_partition_cache = None
+
+
+def get_disk_stats(partition_cache=None):
     """
     Get storage disk statistics
+
+    Inputs:
+        partition_cache: The PartitionCache to discover the partitions with;
+            defaults to a module-wide cache created on the first call.
+
     Returns dictionary with the following keys:
         - partitions_list: Includes a dictionary of each partition with the
             following keys:
                 - partition_name
                 - partition_mountpoint
                 - partition_fstype
+                - partition_available: False if the usage could not be read
+                    in time; the sizes below are None then
                 - partition_total_gb
                 - partition_used_gb
                 - partition_free_gb
@@ -242,6 +629,13 @@ def get_disk_stats():
         - storage_usage_percent
     """
 
+    global _default_partition_cache
+
+    if partition_cache is None:
+        if _default_partition_cache is None:
+            _default_partition_cache = PartitionCache()
+        partition_cache = _default_partition_cache
+
     # Initialize full disk storage
     total_storage = 0
 
@@ -257,11 +651,12 @@ def get_disk_stats():
     # Initialize the partitions list
     partitions_list = []
 
-    # Get partitions data
-    partitions = psutil.disk_partitions()
+    # Get partitions data and their usages
+    partitions = partition_cache.partitions()
+    partitions_usages = partition_cache.usages(partitions)
 
     # Loop over the partitions
-    for partition in partitions:
+    for partition, partition_disk in zip(partitions, partitions_usages):
 
         # Initialize the partition dictionary
         partition_dict = dict()
@@ -270,13 +665,21 @@ def get_disk_stats():
         partition_dict['partition_name'] = partition.device
 
         # Add the partition Mountpoint
-        partition_dict['partition_mountpoint'] = partition.device
+        partition_dict['partition_mountpoint'] = partition.mountpoint
 
         # Add the partition file system type
         partition_dict['partition_fstype'] = partition.fstype
 
-        # Get the disk usage of the partition
-        partition_disk = psutil.disk_usage(partition.mountpoint)
+        # Add whether the partition usage could be read
+        partition_dict['partition_available'] = partition_disk is not None
+
+        if partition_disk is None:
+            partition_dict['partition_total_gb'] = None
+            partition_dict['partition_used_gb'] = None
+            partition_dict['partition_free_gb'] = None
+            partition_dict['partition_percentage'] = None
+            partitions_list.append(partition_dict)
+            continue
 
         # Add the partition total size
         total_partition_size = partition_disk.total
@@ -368,99 +771,310 @@ def get_disk_stats():
     return output_dict
 
 
-def get_gpu_stats():
+# nvidia-smi query fields -> reading keys and value parsers; the name is
+# queried last since it is the only field that may contain a comma
+_GPU_FIELDS = [
+    ('index', 'index', int),
+    ('uuid', 'uuid', str),
+    ('memory.total', 'memory_total_mb', float),
+    ('memory.used', 'memory_used_mb', float),
+    ('memory.free', 'memory_free_mb', float),
+    ('utilization.gpu', 'utilization_percent', float),
+    ('temperature.gpu', 'temperature', float),
+    ('power.draw', 'power_draw_watts', float),
+    ('name', 'name', str),
+]
+
+
+def parse_gpu_line(line):
+    """
+    Parse one line of `nvidia-smi --query-gpu=... --format=csv,noheader,
+    nounits` queried with the _GPU_FIELDS
+
+    Returns dictionary of the reading keys of _GPU_FIELDS, with None for the
+    values the GPU does not report, or None if the line is not a reading
+    """
+
+    values = line.rstrip('\r\n').split(',', len(_GPU_FIELDS) - 1)
+    if len(values) != len(_GPU_FIELDS):
+        return None
+
+    reading = dict()
+    for (_, key, parser), value in zip(_GPU_FIELDS, values):
+        value = value.strip()
+        if not value or value.startswith('[') or value == 'N/A':
+            reading[key] = None
+            continue
+        try:
+            reading[key] = parser(value)
+        except ValueError:
+            return None
+
+    # A reading without its GPU index cannot be cached
+    if reading['index'] is None:
+        return None
+    return reading
+
+
+class GpuStream:
+    """
+    Latest GPU readings streamed by one long-lived nvidia-smi child
+
+    nvidia-smi prints a line per GPU every `loop_ms`; a reader thread parses
+    each line as it arrives into a cache, which get_gpu_stats() reads
+    without spawning a process per sample. The child is started again if it
+    exits, e.g. after a driver reset.
+
+    Inputs:
+        loop_ms: The nvidia-smi sampling period
+        command: The nvidia-smi executable
+        stale_seconds: Readings older than this are not reported
+        restart_seconds: Delay before starting an exited child again
+    """
+
+    def __init__(
+            self, loop_ms=1000, command='nvidia-smi', stale_seconds=10,
+            restart_seconds=5
+    ):
+        self.loop_ms = loop_ms
+        self.command = command
+        self.stale_seconds = stale_seconds
+        self.restart_seconds = restart_seconds
+
+        self._process = None
+        self._thread = None
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+
+        # GPU index -> (time.monotonic() of the reading, reading)
+        self._readings = dict()
+
+    def _spawn(self):
+        return subprocess.Popen(
+            [
+                self.command,
+                '--query-gpu=' + ','.join(field for field, _, _ in _GPU_FIELDS),
+                '--format=csv,noheader,nounits',
+                '--loop-ms={0}'.format(self.loop_ms)
+            ],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            stdin=subprocess.DEVNULL, text=True, bufsize=1
+        )
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='gpu_stream', daemon=True
+        )
+        self._thread.start()
+
+        # Do not leave the child behind; if this process is killed, the
+        # child gets SIGPIPE on its next line
+        atexit.register(self.close)
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                # Checked under the lock, so close() cannot miss a child
+                with self._lock:
+                    if self._closed.is_set():
+                        return
+                    process = self._process = self._spawn()
+            except OSError as e:
+                log.error('could not start {0}: {1}'.format(self.command, e))
+                return
+
+            for line in process.stdout:
+                self.feed(line)
+
+            process.wait()
+            if self._closed.is_set():
+                return
+            log.warning('{0} exited with code {1}, restarting it in {2} '
+                        'seconds'.format(self.command, process.returncode,
+                                         self.restart_seconds))
+            self._closed.wait(self.restart_seconds)
+
+    def feed(self, line):
+        """
+        Cache the reading of one output line
+        """
+
+        reading = parse_gpu_line(line)
+        if reading is None:
+            if line.strip():
+                log.debug('skipping the GPU line {0!r}'.format(line))
+            return
+        with self._lock:
+            self._readings[reading['index']] = (time.monotonic(), reading)
+
+    def has_readings(self):
+        """
+        Returns True once nvidia-smi printed its first readings
+        """
+
+        with self._lock:
+            return bool(self._readings)
+
+    def latest(self):
+        """
+        Returns list of the fresh readings, ordered by GPU index
+        """
+
+        oldest_time = time.monotonic() - self.stale_seconds
+        with self._lock:
+            return [
+                reading
+                for index, (reading_time, reading)
+                in sorted(self._readings.items())
+                if reading_time >= oldest_time
+            ]
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            process = self._process
+        if process is not None and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def _get_gputil_readings():
+    """
+    Read the GPUs once through GPUtil, which runs nvidia-smi
+    Returns list of readings shaped like parse_gpu_line() outputs
+    """
+
+    # GPUtil is slow to import; only the hosts collecting GPUs pay for it
+    import GPUtil
+
+    readings = []
+    for gpu in GPUtil.getGPUs():
+        readings.append({
+            'index': gpu.id,
+            'uuid': gpu.uuid,
+            'memory_total_mb': gpu.memoryTotal,
+            'memory_used_mb': gpu.memoryUsed,
+            'memory_free_mb': gpu.memoryFree,
+            'utilization_percent': gpu.load * 100,
+            'temperature': gpu.temperature,
+            'power_draw_watts': None,
+            'name': gpu.name,
+        })
+    return readings
+
+
+def get_gpu_stats(stream=None):
     """
     Get GPU statistics
-    Returns dictionary with the following keys:
+
+    Inputs:
+        stream: GpuStream whose latest readings are reported; without it,
+            the GPUs are read through GPUtil
+
+    Returns None while the stream has no readings yet, or else dictionary
+    with the following keys:
         - gpus_list: Includes a dictionary of each GPU with the
             following keys:
-                - partition_name
-                - partition_mountpoint
-                - partition_fstype
-                - partition_total_gb
-                - partition_used_gb
-                - partition_free_gb
-                - partition_percentage
-        - total_storage_gb
-        - used_storage_gb
-        - free_storage_gb
-        - storage_usage_percent
+                - name
+                - id
+                - uuid
+                - total_memory_gb
+                - used_memory_gb
+                - free_memory_gb
+                - usage_percentage: Memory usage
+                - utilization_percent: Compute utilization
+                - temperature
+                - power_draw_watts
+        - gpus_count
+        - gpu_temperature: The highest GPU temperature
+        - total_gpu_gb
+        - total_used_gpu_gb
+        - total_free_gpu_gb
+        - gpu_usage_percentage: Memory usage of all GPUs
+        - gpu_utilization_percent: Average compute utilization
     """
 
     # Initialize the output dictionary
     output_dict = dict()
 
-    # Initialize total GPUs memeory
+    # Initialize total GPUs memory
     total_gpu_memory = 0
 
-    # Initialize used GPUs memeory
+    # Initialize used GPUs memory
     used_gpu_memory = 0
 
-    # Initialize free GPUs memeory
+    # Initialize free GPUs memory
     free_gpu_memory = 0
 
     # Initialize max GPU temperature
     max_gpu_temperature = 0
 
-    # Initialize GPUs count
-    gpus_count = 0
+    # Compute utilizations of the GPUs reporting it
+    utilizations = []
 
-    gpus = GPUtil.getGPUs()
+    if stream is None:
+        readings = _get_gputil_readings()
+    elif not stream.has_readings():
+        # Do not record zero GPUs before nvidia-smi printed anything
+        return None
+    else:
+        readings = stream.latest()
 
     gpus_list = []
 
     # Loop over the available GPUs
-    for gpu in gpus:
+    for reading in readings:
 
         gpu_dict = dict()
 
-        # Add GPU name
-        gpu_dict['name'] = gpu.name
-
-        # Add GPU ID
-        gpu_dict['id'] = gpu.id
-
-        # Add GPU total memory
-        total_gpu_memory += gpu.memoryTotal
-        gpu_dict['total_memory_gb'] = round(
-            _convert_memory_size(
-                input_memory=gpu.memoryTotal,
-                input_unit='MB',
-                output_unit='GB'
-            ),
-            2  # Two di gits after the decimal points
-        )
-
-        # Add GPU used memory
-        used_gpu_memory += gpu.memoryUsed  # MB
-        gpu_dict['used_memory_gb'] = round(
-            _convert_memory_size(
-                input_memory=gpu.memoryUsed,
-                input_unit='MB',
-                output_unit='GB'
-            ),
-            2  # Two di gits after the decimal points
-        )
-
-        # Add GPU free memory
-        free_gpu_memory += gpu.memoryFree  # MB
-        gpu_dict['free_memory_gb'] = round(
-            _convert_memory_size(
-                input_memory=gpu.memoryFree,
-                input_unit='MB',
-                output_unit='GB'
-            ),
-            2  # Two di gits after the decimal points
-        )
-
-        # Add GPU usage percentage
-        gpu_dict['usage_percentage'] = gpu.memoryUtil * 100
+        # Add GPU name and IDs
+        gpu_dict['name'] = reading['name']
+        gpu_dict['id'] = reading['index']
+        gpu_dict['uuid'] = reading['uuid']
+
+        # Add GPU memory; missing values count as zero
+        memory_total = reading['memory_total_mb'] or 0
+        memory_used = reading['memory_used_mb'] or 0
+        memory_free = reading['memory_free_mb'] or 0
+        total_gpu_memory += memory_total
+        used_gpu_memory += memory_used
+        free_gpu_memory += memory_free
+        gpu_dict['total_memory_gb'] = round(_convert_memory_size(
+            input_memory=memory_total, input_unit='MB', output_unit='GB'
+        ), 2)
+        gpu_dict['used_memory_gb'] = round(_convert_memory_size(
+            input_memory=memory_used, input_unit='MB', output_unit='GB'
+        ), 2)
+        gpu_dict['free_memory_gb'] = round(_convert_memory_size(
+            input_memory=memory_free, input_unit='MB', output_unit='GB'
+        ), 2)
+
+        # Add GPU memory usage percentage
+        if memory_total != 0:
+            gpu_dict['usage_percentage'] = round(
+                memory_used / memory_total * 100, 2
+            )
+        else:
+            gpu_dict['usage_percentage'] = 0
+
+        # Add GPU compute utilization
+        gpu_dict['utilization_percent'] = reading['utilization_percent']
+        if reading['utilization_percent'] is not None:
+            utilizations.append(reading['utilization_percent'])
 
         # Add GPU temperature
-        gpu_dict['temperature'] = gpu.temperature  # C degrees
-        if float(gpu_dict['temperature']) > float(max_gpu_temperature):
+        gpu_dict['temperature'] = reading['temperature']  # C degrees
+        if gpu_dict['temperature'] is not None and \
+                gpu_dict['temperature'] > max_gpu_temperature:
             max_gpu_temperature = gpu_dict['temperature']
 
+        # Add GPU power draw
+        gpu_dict['power_draw_watts'] = reading['power_draw_watts']
+
         # Add current GPU dictionary to the GPUs list
         gpus_list.append(gpu_dict)
 
@@ -512,6 +1126,14 @@ def get_gpu_stats():
     else:
         output_dict['gpu_usage_percentage'] = 0
 
+    # Add the average compute utilization
+    if utilizations:
+        output_dict['gpu_utilization_percent'] = round(
+            sum(utilizations) / len(utilizations), 2
+        )
+    else:
+        output_dict['gpu_utilization_percent'] = None
+
     return output_dict
 
 
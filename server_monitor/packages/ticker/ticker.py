@@ -0,0 +1,213 @@
+import math
+import time
+import heapq
+import logging
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+
+class Ticker:
+    """
+    Sampling clock firing every `interval_seconds` without drift
+
+    The ticks are scheduled on the monotonic clock as anchor + n * interval,
+    so neither the cycles run time nor the sleep overshoot accumulate. With
+    `align`, the anchor is the next multiple of the interval on the wall
+    clock, e.g. :00, :10, :20 for 10 seconds, so the hosts sample at the
+    same instants. A cycle overrunning whole ticks skips them, counting
+    them in `missed_count`. When the wall clock is stepped, e.g. by NTP,
+    the ticks are aligned on it again.
+
+    Inputs:
+        interval_seconds: Seconds between two ticks, sub-second included
+        align: Fire on the wall clock multiples of the interval
+        resync_seconds: Align again when the wall clock moved this far from
+            the monotonic clock
+    """
+
+    def __init__(self, interval_seconds, align=True, resync_seconds=1.0):
+        if interval_seconds <= 0:
+            raise ValueError('The interval must be positive')
+
+        self.interval_seconds = interval_seconds
+        self.align = align
+        self.resync_seconds = resync_seconds
+        self.missed_count = 0
+        self._anchor()
+
+    def _anchor(self):
+        monotonic_now = time.monotonic()
+        wall_now = time.time()
+        first_wall = wall_now
+        if self.align:
+            first_wall = math.ceil(wall_now / self.interval_seconds) * \
+                self.interval_seconds
+
+        # Wall clock and monotonic time of tick 0
+        self._anchor_wall = first_wall
+        self._anchor_monotonic = monotonic_now + (first_wall - wall_now)
+        self._index = 0
+
+    def _resync(self):
+        # The wall clock the anchor predicts for now, against the real one
+        expected_wall = self._anchor_wall + \
+            time.monotonic() - self._anchor_monotonic
+        offset = time.time() - expected_wall
+        if abs(offset) > self.resync_seconds:
+            log.warning('the wall clock moved {0} seconds, aligning the '
+                        'ticks again'.format(round(offset, 3)))
+            self._anchor()
+
+    def deadline(self):
+        """
+        Returns the monotonic time of the next tick
+        """
+
+        return self._anchor_monotonic + self._index * self.interval_seconds
+
+    def advance(self):
+        """
+        Consume the next tick, skipping the ticks already overrun
+
+        Returns tuple of (wall clock time of the tick, in seconds since the
+        epoch, number of skipped ticks)
+        """
+
+        missed_count = 0
+        lateness = time.monotonic() - self.deadline()
+        if lateness >= self.interval_seconds:
+            missed_count = int(lateness // self.interval_seconds)
+            self.missed_count += missed_count
+            self._index += missed_count
+
+        tick_wall = self._anchor_wall + self._index * self.interval_seconds
+        self._index += 1
+        self._resync()
+        return tick_wall, missed_count
+
+    def wait(self, stop_event=None):
+        """
+        Sleep until the next tick
+
+        Inputs:
+            stop_event: threading.Event interrupting the sleep
+
+        Returns the wall clock time of the tick, in seconds since the epoch,
+        or None if stop_event was set
+        """
+
+        if not _sleep_until(self.deadline(), stop_event):
+            return None
+
+        tick_wall, missed_count = self.advance()
+        if missed_count:
+            log.warning('missed {0} ticks of {1} seconds'.format(
+                missed_count, self.interval_seconds
+            ))
+        return tick_wall
+
+
+class Scheduler:
+    """
+    Run jobs on their own intervals, from a heap of their next ticks
+
+    Each job has a Ticker; the heap orders them by their next deadline.
+    Every job also runs on the first tick, so that the first samples do
+    not wait for a whole long interval. The jobs falling due on the same
+    tick, within `coalesce_seconds`, are returned together, e.g. a 1 second
+    and a 5 second job every 5 seconds when the ticks are aligned. A job
+    still running past its next ticks misses them; the missed deadlines are
+    logged and counted per job in `missed_counts`.
+
+    Inputs:
+        intervals: Dictionary of job name to its interval seconds; None
+            runs the job on the first tick only
+        align: Fire on the wall clock multiples of each interval
+        resync_seconds: Align again when the wall clock moved this far
+        coalesce_seconds: Jobs due this close to each other run together
+    """
+
+    def __init__(self, intervals, align=True, resync_seconds=1.0,
+                 coalesce_seconds=0.001):
+        self.coalesce_seconds = coalesce_seconds
+        self.missed_counts = {name: 0 for name in intervals}
+
+        # Every job runs on the first tick
+        self._first_names = list(intervals)
+
+        # Heap of (next deadline, job name)
+        self._tickers = dict()
+        self._heap = []
+        for name, interval in intervals.items():
+            if interval is None:
+                continue
+            self._tickers[name] = Ticker(
+                interval_seconds=interval, align=align,
+                resync_seconds=resync_seconds
+            )
+            heapq.heappush(self._heap, (self._tickers[name].deadline(), name))
+
+    def wait(self, stop_event=None):
+        """
+        Sleep until the next jobs fall due
+
+        Inputs:
+            stop_event: threading.Event interrupting the sleep
+
+        Returns tuple of (wall clock time of the tick, list of the due jobs
+        names), or None if stop_event was set; without recurring jobs, the
+        first call returns right away and the next ones wait for the stop
+        """
+
+        if not self._heap:
+            if self._first_names:
+                names, self._first_names = self._first_names, []
+                return time.time(), names
+            if stop_event is not None:
+                stop_event.wait()
+            return None
+
+        deadline = self._heap[0][0]
+        if not _sleep_until(deadline, stop_event):
+            return None
+
+        # Coalesce every job already due, late ones included
+        threshold = max(deadline, time.monotonic()) + self.coalesce_seconds
+        tick_wall = None
+        names = []
+        while self._heap and self._heap[0][0] <= threshold:
+            _, name = heapq.heappop(self._heap)
+            ticker = self._tickers[name]
+            job_tick_wall, missed_count = ticker.advance()
+            if missed_count:
+                self.missed_counts[name] += missed_count
+                log.warning('{0} missed {1} deadlines of {2} seconds'.format(
+                    name, missed_count, ticker.interval_seconds
+                ))
+            tick_wall = job_tick_wall if tick_wall is None \
+                else max(tick_wall, job_tick_wall)
+            names.append(name)
+            heapq.heappush(self._heap, (ticker.deadline(), name))
+
+        if self._first_names:
+            names, self._first_names = self._first_names, []
+        return tick_wall, names
+
+
+def _sleep_until(deadline, stop_event=None):
+    """
+    Sleep until the monotonic `deadline`
+    Returns False if stop_event was set
+    """
+
+    delay = deadline - time.monotonic()
+    if delay > 0:
+        if stop_event is None:
+            time.sleep(delay)
+        elif stop_event.wait(delay):
+            return False
+    elif stop_event is not None and stop_event.is_set():
+        return False
+    return True
@@ -0,0 +1,599 @@
+import time
+import socket
+import struct
+import logging
+import concurrent.futures
+from packages.startup import startup
+from packages.postgredb import postgredb
+
+
+# Import logger
+log = logging.getLogger(__name__)
+
+# Only the aggregator runs asyncio; the agents skip its import
+asyncio = startup.lazy_import('asyncio')
+
+# Frame header: magic, frame type, payload length
+_HEADER = struct.Struct('>4sBI')
+_MAGIC = b'SMW1'
+
+# Frame types; REJECT answers rows that can never be written
+ROWS = 1
+ACK = 2
+NACK = 3
+REJECT = 4
+
+# Value tags of the rows encoding
+_NONE = 0
+_FLOAT = 1
+_INT = 2
+_STR = 3
+_FLOAT_LIST = 4
+_BOOL = 5
+
+_TABLE = struct.Struct('>BI')
+_TABLES_COUNT = struct.Struct('>H')
+_VALUES_COUNT = struct.Struct('>B')
+_TAGGED_FLOAT = struct.Struct('>Bd')
+_TAGGED_INT = struct.Struct('>Bq')
+_TAGGED_BOOL = struct.Struct('>B?')
+_TAGGED_LENGTH = struct.Struct('>BI')
+_TAG = struct.Struct('>B')
+_FLOAT_VALUE = struct.Struct('>d')
+_INT_VALUE = struct.Struct('>q')
+_BOOL_VALUE = struct.Struct('>?')
+_LENGTH = struct.Struct('>I')
+
+
+def _encode_value(value, parts):
+    if value is None:
+        parts.append(_TAG.pack(_NONE))
+    elif isinstance(value, bool):
+        parts.append(_TAGGED_BOOL.pack(_BOOL, value))
+    elif isinstance(value, float):
+        parts.append(_TAGGED_FLOAT.pack(_FLOAT, value))
+    elif isinstance(value, int):
+        parts.append(_TAGGED_INT.pack(_INT, value))
+    elif isinstance(value, str):
+        encoded = value.encode('utf8')
+        parts.append(_TAGGED_LENGTH.pack(_STR, len(encoded)))
+        parts.append(encoded)
+    elif isinstance(value, (list, tuple)):
+        parts.append(_TAGGED_LENGTH.pack(_FLOAT_LIST, len(value)))
+        parts.append(struct.pack('>{0}d'.format(len(value)), *value))
+    else:
+        # e.g. Decimal; sent as a float
+        parts.append(_TAGGED_FLOAT.pack(_FLOAT, float(value)))
+
+
+def encode_frame(frame_type, tables=None):
+    """
+    Encode a frame
+
+    Inputs:
+        frame_type: ROWS, ACK, NACK or REJECT
+        tables: For ROWS frames, dictionary of table name to list of rows;
+            the values of a row are None, bool, int, float, str or a list
+            of floats
+
+    Returns bytes of the frame
+    """
+
+    parts = []
+    if tables:
+        parts.append(_TABLES_COUNT.pack(len(tables)))
+        for table_name, rows in tables.items():
+            encoded_name = table_name.encode('utf8')
+            parts.append(_TABLE.pack(len(encoded_name), len(rows)))
+            parts.append(encoded_name)
+            for values_list in rows:
+                parts.append(_VALUES_COUNT.pack(len(values_list)))
+                for value in values_list:
+                    _encode_value(value, parts)
+
+    payload = b''.join(parts)
+    return _HEADER.pack(_MAGIC, frame_type, len(payload)) + payload
+
+
+class RejectedRowsError(Exception):
+    """
+    The aggregator rejected rows that can never be written, e.g. a value
+    out of its column range; sending them again would fail again
+    """
+
+
+def _merge_frames(frames):
+    """
+    Merge the rows of several frames
+    Returns dictionary of table name to list of rows
+    """
+
+    batch = dict()
+    for tables in frames:
+        for table_name, rows in tables.items():
+            batch.setdefault(table_name, []).extend(rows)
+    return batch
+
+
+def decode_header(header):
+    """
+    Returns tuple of (frame type, payload length)
+    """
+
+    magic, frame_type, length = _HEADER.unpack(header)
+    if magic != _MAGIC:
+        raise ValueError('Not a server_monitor frame')
+    return frame_type, length
+
+
+def decode_rows(payload):
+    """
+    Decode the payload of a ROWS frame
+    Returns dictionary of table name to list of rows
+    """
+
+    view = memoryview(payload)
+    offset = 0
+    tables = dict()
+
+    tables_count, = _TABLES_COUNT.unpack_from(view, offset)
+    offset += _TABLES_COUNT.size
+    for _ in range(tables_count):
+        name_length, rows_count = _TABLE.unpack_from(view, offset)
+        offset += _TABLE.size
+        table_name = bytes(view[offset:offset + name_length]).decode('utf8')
+        offset += name_length
+
+        rows = tables.setdefault(table_name, [])
+        for _ in range(rows_count):
+            values_count, = _VALUES_COUNT.unpack_from(view, offset)
+            offset += _VALUES_COUNT.size
+            values_list = []
+            for _ in range(values_count):
+                tag = view[offset]
+                offset += 1
+                if tag == _NONE:
+                    values_list.append(None)
+                elif tag == _FLOAT:
+                    values_list.append(_FLOAT_VALUE.unpack_from(view, offset)[0])
+                    offset += _FLOAT_VALUE.size
+                elif tag == _INT:
+                    values_list.append(_INT_VALUE.unpack_from(view, offset)[0])
+                    offset += _INT_VALUE.size
+                elif tag == _BOOL:
+                    values_list.append(_BOOL_VALUE.unpack_from(view, offset)[0])
+                    offset += _BOOL_VALUE.size
+                else:
+                    length, = _LENGTH.unpack_from(view, offset)
+                    offset += _LENGTH.size
+                    if tag == _STR:
+                        values_list.append(
+                            bytes(view[offset:offset + length]).decode('utf8')
+                        )
+                        offset += length
+                    elif tag == _FLOAT_LIST:
+                        values_list.append(list(struct.unpack_from(
+                            '>{0}d'.format(length), view, offset
+                        )))
+                        offset += length * _FLOAT_VALUE.size
+                    else:
+                        raise ValueError('Unknown value tag: {0}'.format(tag))
+            rows.append(values_list)
+
+    return tables
+
+
+class AgentConnection:
+    """
+    Connection of an agent to the aggregator, in place of a PostgreSQLDB
+
+    It offers the PostgreSQLDB methods the BufferedWriter and the spool
+    replay use: the rows of a transaction are kept until commit(), which
+    sends them as one frame and waits for the aggregator to acknowledge
+    that they were written.
+
+    Inputs:
+        address: The aggregator host
+        port: The aggregator port
+        connect_timeout: Seconds to wait for the connection
+        ack_timeout: Seconds to wait for the acknowledgement of a frame
+    """
+
+    def __init__(self, address, port, connect_timeout=5, ack_timeout=10):
+        self.address = address
+        self.port = port
+        self._socket = socket.create_connection(
+            (address, port), timeout=connect_timeout
+        )
+        self._socket.settimeout(ack_timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+
+        # Table name -> rows of the current transaction
+        self._pending = dict()
+
+    def insert_rows(self, insert_query, rows, page_size=None,
+                    on_conflict_do_nothing=False, commit=True):
+        table_name = postgredb.parse_insert_query(insert_query)[0]
+        self._pending.setdefault(table_name, []).extend(rows)
+        if commit:
+            self.commit()
+
+    def load_batch(self, queries_rows):
+        for insert_query, rows in queries_rows.items():
+            self.insert_rows(insert_query=insert_query, rows=rows, commit=False)
+        self.commit()
+
+    def _receive_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('The aggregator closed the connection')
+            data += chunk
+        return data
+
+    def commit(self):
+        """
+        Send the rows of the transaction and wait until they are written
+        """
+
+        tables = self._pending
+        self._pending = dict()
+        if not tables:
+            return
+
+        try:
+            self._socket.sendall(encode_frame(ROWS, tables))
+            frame_type, length = decode_header(
+                self._receive_exactly(_HEADER.size)
+            )
+            self._receive_exactly(length)
+        except (OSError, ValueError):
+            self.close()
+            raise
+
+        if frame_type == REJECT:
+            raise RejectedRowsError('The aggregator rejected the rows')
+        if frame_type != ACK:
+            raise RuntimeError('The aggregator could not write the rows')
+
+    def rollback(self):
+        self._pending.clear()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._socket.close()
+
+
+class Aggregator:
+    """
+    asyncio server receiving the agents frames and writing them to
+    PostgreSQL in large batches
+
+    The rows of all connections are merged and loaded with COPY once the
+    batch reaches `batch_rows` or every `flush_interval_seconds`. Each
+    frame is acknowledged after the batch holding it is committed, so an
+    agent spools its rows locally when they were not written. When a batch
+    fails, its frames are written again one by one; only the failing ones
+    are answered with NACK, or with REJECT when their rows can never be
+    written. The database calls run on one worker thread, which also runs
+    `maintenance`.
+
+    Inputs:
+        connect: Callable returning a PostgreSQLDB, or None if the database
+            is unreachable
+        insert_queries: Dictionary of table name to its insert query
+        batch_rows: Write the batch once it has this many rows
+        flush_interval_seconds: Write the batch at least this often
+        maintenance: Optional callable receiving the PostgreSQLDB, e.g. the
+            rollups; run every `maintenance_interval_seconds`
+        maintenance_interval_seconds: The period of `maintenance`
+        on_batch: Optional callable receiving the PostgreSQLDB and each
+            written batch; agents replaying their spool send late rows
+        async_db: Optional AsyncPostgreSQLDB; the batches are then written
+            concurrently through its pool, up to its in-flight limit, and
+            the worker thread only runs `on_batch` and `maintenance`
+        permanent_errors: Tuple of the exception types of rows that can
+            never be written; their frames are answered with REJECT
+    """
+
+    def __init__(
+            self, connect, insert_queries, batch_rows=10000,
+            flush_interval_seconds=1.0, maintenance=None,
+            maintenance_interval_seconds=60, on_batch=None, async_db=None,
+            permanent_errors=()
+    ):
+        self.connect = connect
+        self.insert_queries = insert_queries
+        self.batch_rows = batch_rows
+        self.flush_interval_seconds = flush_interval_seconds
+        self.maintenance = maintenance
+        self.maintenance_interval_seconds = maintenance_interval_seconds
+        self.on_batch = on_batch
+        self.async_db = async_db
+        self.permanent_errors = permanent_errors
+
+        # Table name -> number of values of its rows
+        self._values_counts = {
+            table_name: len(postgredb.get_prepared_insert(insert_query)[1])
+            for table_name, insert_query in insert_queries.items()
+        }
+
+        self.db = None
+        self.connections_count = 0
+        self.rows_count = 0
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='aggregator_db'
+        )
+        self._next_maintenance_time = time.monotonic()
+
+        # Frames of the next batch, as tuples of (tables, future of the
+        # reply frame type)
+        self._batch_frames = []
+        self._batch_rows_count = 0
+        self._batch_full = None
+
+        # Batches being written through the async pool
+        self._write_tasks = set()
+
+    async def _handle_agent(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        self.connections_count += 1
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    return
+                frame_type, length = decode_header(header)
+                payload = await reader.readexactly(length)
+                if frame_type != ROWS:
+                    continue
+
+                tables = decode_rows(payload)
+                unknown_tables = set(tables) - set(self.insert_queries)
+                if unknown_tables:
+                    log.error('{0} sent unknown tables: {1}'.format(
+                        peer, ', '.join(unknown_tables)
+                    ))
+                    writer.write(encode_frame(REJECT))
+                    await writer.drain()
+                    continue
+
+                # A malformed row would fail the COPY of the whole batch
+                malformed_tables = [
+                    table_name for table_name, rows in tables.items()
+                    if any(
+                        not isinstance(values_list, list) or
+                        len(values_list) != self._values_counts[table_name]
+                        for values_list in rows
+                    )
+                ]
+                if malformed_tables:
+                    log.error('{0} sent malformed rows of: {1}'.format(
+                        peer, ', '.join(malformed_tables)
+                    ))
+                    writer.write(encode_frame(REJECT))
+                    await writer.drain()
+                    continue
+
+                # Join the next batch and wait for its commit
+                reply = loop.create_future()
+                self._batch_frames.append((tables, reply))
+                self._batch_rows_count += sum(
+                    len(rows) for rows in tables.values()
+                )
+                if self._batch_rows_count >= self.batch_rows:
+                    self._batch_full.set()
+
+                writer.write(encode_frame(await reply))
+                await writer.drain()
+        except (ConnectionError, ValueError, IndexError, struct.error) as e:
+            log.error('dropping agent {0}: {1}'.format(peer, e))
+        finally:
+            self.connections_count -= 1
+            writer.close()
+
+    def _queries_rows(self, tables):
+        return {
+            self.insert_queries[table_name]: rows
+            for table_name, rows in tables.items()
+        }
+
+    def _write_frames(self, frames):
+        """
+        Write the frames of a failed batch one by one in the database thread
+        Returns list of the reply frame type of each frame
+        """
+
+        replies = []
+        for tables in frames:
+            try:
+                self.db.load_batch(self._queries_rows(tables))
+                if self.on_batch is not None:
+                    self.on_batch(self.db, tables)
+                replies.append(ACK)
+            except self.permanent_errors as e:
+                log.error('rejecting a frame: {0}'.format(e))
+                self.db.rollback()
+                replies.append(REJECT)
+            except Exception as e:
+                log.error('could not write a frame: {0}'.format(e))
+                self.db.rollback()
+                replies.append(NACK)
+        return replies
+
+    def _write_batch(self, frames, loaded=False):
+        """
+        Write the frames of a batch in the database thread
+        Returns list of the reply frame type of each frame: ACK when it was
+        committed, REJECT when its rows can never be written, or else NACK
+
+        Inputs:
+            frames: List of dictionaries of table name to its rows
+            loaded: The rows were already written by the async pool; only
+                run `on_batch` and `maintenance`
+        """
+
+        replies = [NACK] * len(frames)
+        if self.db is not None and self.db.closed:
+            log.error('lost the database connection')
+            self.db = None
+        if self.db is None:
+            self.db = self.connect()
+            if self.db is None:
+                return replies
+
+        batch = _merge_frames(frames)
+        try:
+            if batch:
+                if not loaded:
+                    self.db.load_batch(self._queries_rows(batch))
+                if self.on_batch is not None:
+                    self.on_batch(self.db, batch)
+            replies = [ACK] * len(frames)
+        except Exception as e:
+            log.error('could not write the agents batch: {0}'.format(e))
+            self.db.rollback()
+
+            # One frame may fail the whole batch; find it
+            if not loaded and not self.db.closed:
+                replies = self._write_frames(frames)
+
+        if self.maintenance is not None and \
+                time.monotonic() >= self._next_maintenance_time:
+            self._next_maintenance_time = \
+                time.monotonic() + self.maintenance_interval_seconds
+            try:
+                self.maintenance(self.db)
+            except Exception as e:
+                log.error('aggregator maintenance failed: {0}'.format(e))
+                self.db.rollback()
+        return replies
+
+    def _take_batch(self):
+        pending = self._batch_frames
+        self._batch_frames = []
+        self._batch_rows_count = 0
+        return pending
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._batch_full.wait(), self.flush_interval_seconds
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._batch_full.clear()
+
+            pending = self._take_batch()
+
+            if self.async_db is not None:
+                task = asyncio.create_task(self._write_batch_async(pending))
+                self._write_tasks.add(task)
+                task.add_done_callback(self._write_tasks.discard)
+                continue
+
+            replies = await loop.run_in_executor(
+                self._executor, self._write_batch,
+                [tables for tables, _ in pending]
+            )
+            self._acknowledge(pending, replies)
+
+    def _acknowledge(self, pending, replies):
+        for (tables, reply), frame_type in zip(pending, replies):
+            if frame_type == ACK:
+                self.rows_count += sum(len(rows) for rows in tables.values())
+            if not reply.done():
+                reply.set_result(frame_type)
+
+    async def _write_frames_async(self, frames):
+        """
+        Write the frames of a failed batch one by one through the async pool
+        Returns list of the reply frame type of each frame
+        """
+
+        replies = []
+        for tables in frames:
+            try:
+                await self.async_db.load_batch(self._queries_rows(tables))
+                replies.append(ACK)
+            except self.permanent_errors as e:
+                log.error('rejecting a frame: {0}'.format(e))
+                replies.append(REJECT)
+            except Exception as e:
+                log.error('could not write a frame: {0}'.format(e))
+                replies.append(NACK)
+        return replies
+
+    async def _write_batch_async(self, pending):
+        """
+        Write a batch through the async pool, then run `on_batch` and
+        `maintenance` in the database thread
+        """
+
+        frames = [tables for tables, _ in pending]
+        replies = [ACK] * len(frames)
+        batch = _merge_frames(frames)
+        if batch:
+            try:
+                await self.async_db.load_batch(self._queries_rows(batch))
+            except Exception as e:
+                log.error('could not write the agents batch: {0}'.format(e))
+                replies = await self._write_frames_async(frames)
+        self._acknowledge(pending, replies)
+
+        written_frames = [
+            tables for tables, frame_type in zip(frames, replies)
+            if frame_type == ACK
+        ]
+        if (written_frames or not frames) and \
+                (self.on_batch is not None or self.maintenance is not None):
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._write_batch, written_frames, True
+            )
+
+    async def serve(self, bind_address='0.0.0.0', port=9106, stop_event=None):
+        """
+        Accept agents until `stop_event`, an asyncio.Event, is set
+        """
+
+        self._batch_full = asyncio.Event()
+        if self.async_db is not None:
+            await self.async_db.open()
+        server = await asyncio.start_server(
+            self._handle_agent, bind_address, port, backlog=4096
+        )
+        flush_task = asyncio.create_task(self._flush_loop())
+        log.info('aggregating agents on {0}:{1}'.format(bind_address, port))
+
+        try:
+            async with server:
+                if stop_event is None:
+                    await server.serve_forever()
+                else:
+                    await stop_event.wait()
+        finally:
+            flush_task.cancel()
+
+            # Write what the connected agents already sent
+            pending = self._take_batch()
+            if self.async_db is not None:
+                await asyncio.gather(*self._write_tasks)
+                await self._write_batch_async(pending)
+                await self.async_db.close()
+            else:
+                replies = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._write_batch,
+                    [tables for tables, _ in pending]
+                )
+                self._acknowledge(pending, replies)
+            self._executor.shutdown()
+            if self.db is not None:
+                self.db.close()